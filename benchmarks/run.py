@@ -0,0 +1,330 @@
+"""
+Benchmarks for the DNA kernels (dna_tools.py), the models and the Flask routes, run on a synthetic genome
+    python -m benchmarks.run --out results.json
+    python -m benchmarks.run --baseline results.json --out new_results.json
+
+Without --data-dir, a small synthetic genome is generated in a temporary directory (see synthetic_genome.py)
+Each benchmark is run until it takes long enough to time, a few times over, and we keep the median time per call
+With --baseline, anything that got more than --threshold slower is reported (and the exit code is 1)
+"""
+from benchmarks.synthetic_genome import generate_genome
+import argparse, atexit, json, os, platform, random, shutil, statistics, subprocess, sys, tempfile, time
+
+GENOME = "hg38"
+BENCHMARKS = [] # (name, setup) -- setup() returns the function to time
+
+def benchmark(name):
+    """Register a benchmark (the decorated function sets things up and returns what should be timed)"""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return(setup)
+    return(register)
+
+def time_call(function, repeats: int = 5, min_time: float = 0.2):
+    """Time a function like timeit: find how many loops take at least min_time, then take the median of repeats"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    times = [elapsed / loops]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        times.append((time.perf_counter() - start) / loops)
+    return({"median": statistics.median(times), "min": min(times), "loops": loops, "repeats": repeats})
+
+################################
+# Micro kernels (dna_tools.py) #
+################################
+
+def random_dna(length, seed=0):
+    return("".join(random.Random(seed).choices("ACGT", k=length)))
+
+@benchmark("dna_tools.reverse_complement_1mb")
+def bench_reverse_complement():
+    from server.dna_tools import reverse_complement
+    sequence = random_dna(1_000_000)
+    return(lambda: reverse_complement(sequence))
+
+@benchmark("dna_tools.transcribe_pre_rna_1mb")
+def bench_transcribe():
+    from server.dna_tools import transcribe_pre_rna
+    sequence = random_dna(1_000_000)
+    return(lambda: transcribe_pre_rna(sequence))
+
+@benchmark("dna_tools.splice_rna_2mb_80_exons")
+def bench_splice_rna():
+    from server.dna_tools import splice_rna, transcribe_pre_rna
+    sequence = transcribe_pre_rna(random_dna(2_200_000))
+    exons = [(i * 27_000 + 1, i * 27_000 + 150) for i in range(80)]
+    return(lambda: splice_rna(sequence, exons, reverse=True))
+
+@benchmark("dna_tools.translate_rna_30kb")
+def bench_translate_rna():
+    from server.dna_tools import transcribe_pre_rna, translate_rna
+    sequence = transcribe_pre_rna(random_dna(30_000))
+    return(lambda: translate_rna(sequence))
+
+@benchmark("dna_tools.find_orfs_10kb")
+def bench_find_orfs():
+    from server.dna_tools import find_orfs, transcribe_pre_rna
+    sequence = transcribe_pre_rna(random_dna(10_000))
+    return(lambda: find_orfs(sequence))
+
+##########
+# Models #
+##########
+
+@benchmark("models.load_genome")
+def bench_load_genome():
+    from server.models import Genome
+    return(lambda: Genome(GENOME))
+
+@benchmark("models.search")
+def bench_search():
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    return(lambda: [genome.search(query) for query in ("SYN1", "syn", "dystrophin", "NM_1001", "nothing")])
+
+@benchmark("models.autocomplete")
+def bench_autocomplete():
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    return(lambda: [genome.autocomplete(query) for query in ("SYN1", "syn", "dys", "NM_1001")])
+
+@benchmark("models.get_transcript_by_accession")
+def bench_get_transcript():
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    rng = random.Random(0)
+    genes = rng.sample([gene for gene in genome.genes_by_symbol.values() if gene.transcripts], 100)
+    pairs = [(gene, rng.choice(gene.transcripts)) for gene in genes]
+    return(lambda: [gene.get_transcript_by_accession(accession) for gene, accession in pairs])
+
+@benchmark("models.get_transcripts_many")
+def bench_get_transcripts():
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    gene = genome.get_gene_by_symbol("MANYTX")
+    return(lambda: genome.get_transcripts(gene))
+
+@benchmark("models.transcript_sequences")
+def bench_transcript_sequences():
+    from server.models import Genome, TRANSCRIPT_SEQUENCE_FIELDS
+    genome = Genome.load(GENOME)
+    gene = genome.get_gene_by_symbol("DMD")
+    accessions = gene.transcripts
+    # Fresh transcripts every time, so nothing is cached
+    return(lambda: [genome.get_transcript(gene, accession).summary_dict(fields=TRANSCRIPT_SEQUENCE_FIELDS)
+                    for accession in accessions])
+
+@benchmark("models.transcript_sequences_stored")
+def bench_transcript_sequences_stored():
+    from server.models import Genome
+    from server.derived_store import DerivedStore, DERIVED_FIELDS, build_derived_store
+    genome = Genome(GENOME) # Not the registry's one, so the other benchmarks still compute their sequences
+    if genome.derived is None:
+        out_dir = tempfile.mkdtemp(prefix="easygenedb-bench-derived-")
+        atexit.register(shutil.rmtree, out_dir, True)
+        genome.derived = DerivedStore(build_derived_store(genome, out_path=f"{out_dir}/derived.bin")["path"])
+    gene = genome.get_gene_by_symbol("DMD")
+    accessions = gene.transcripts
+    return(lambda: [genome.get_transcript(gene, accession).summary_dict(fields=DERIVED_FIELDS)
+                    for accession in accessions])
+
+@benchmark("models.gene_sequence_dmd")
+def bench_gene_sequence():
+    from server.models import Genome
+    gene = Genome.load(GENOME).get_gene_by_symbol("DMD")
+    return(lambda: gene.sequence)
+
+@benchmark("models.region_query_1mb")
+def bench_region_query():
+    from server.models import Genome
+    index = Genome.load(GENOME).region_index()
+    return(lambda: [(index.genes_in(chromosome, 1_000_000, 2_000_000), index.exons_in(chromosome, 1_000_000, 2_000_000))
+                    for chromosome in index.chromosomes])
+
+@benchmark("models.map_coordinates_100k")
+def bench_map_coordinates():
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    transcript = genome.get_transcripts(genome.get_gene_by_symbol("DMD"))[0]
+    rng = random.Random(0)
+    positions = [rng.randint(transcript.bounds[0], transcript.bounds[1]) for _ in range(100_000)]
+    return(lambda: transcript.coordinates.map("genomic", positions))
+
+##########
+# Routes #
+##########
+
+def make_client(cached: bool = False):
+    """A Flask test client (with the response cache turned off unless we're benchmarking it)"""
+    from server import create_app
+    from server.response_cache import response_cache
+    app = create_app()
+    if not cached:
+        response_cache.version = None
+    return(app.test_client())
+
+def get_all(client, urls):
+    """Get some URLs and read all of each response (so streamed responses are actually made)"""
+    def run():
+        for url in urls:
+            response = client.get(url)
+            response.get_data()
+            assert response.status_code == 200, (url, response.status_code)
+    return(run)
+
+def sample_transcript():
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    gene = genome.get_gene_by_symbol("SYN5")
+    return(gene, gene.transcripts[0])
+
+@benchmark("routes.browse_gene")
+def bench_browse():
+    return(get_all(make_client(), [f"/browse/{GENOME}/SYN5", f"/browse/{GENOME}/MANYTX", f"/browse/{GENOME}/DMD"]))
+
+@benchmark("routes.browse_gene_cached")
+def bench_browse_cached():
+    return(get_all(make_client(cached=True), [f"/browse/{GENOME}/SYN5", f"/browse/{GENOME}/MANYTX", f"/browse/{GENOME}/DMD"]))
+
+@benchmark("routes.transcript_json")
+def bench_transcript_json():
+    gene, accession = sample_transcript()
+    return(get_all(make_client(), [f"/api/transcripts/{GENOME}/{gene.symbol}/{accession}"]))
+
+@benchmark("routes.search_page")
+def bench_search_page():
+    return(get_all(make_client(), [f"/search/{GENOME}?query=syn1"]))
+
+@benchmark("routes.dynamic_search")
+def bench_dynamic_search():
+    return(get_all(make_client(), [f"/api/dynamic_search/{GENOME}/?query=SYN1"]))
+
+@benchmark("routes.sequence_page_dmd")
+def bench_sequence_page():
+    return(get_all(make_client(), [f"/api/sequence/{GENOME}/DMD?start=0&length=1000000"]))
+
+@benchmark("routes.region_whole_chromosome")
+def bench_region():
+    return(get_all(make_client(), [f"/api/region/{GENOME}/chr2?features=genes,transcripts,exons"]))
+
+@benchmark("routes.fasta_dmd")
+def bench_fasta():
+    return(get_all(make_client(), [f"/api/fasta/{GENOME}/DMD"]))
+
+@benchmark("routes.batch_100")
+def bench_batch():
+    from server.models import Genome
+    client = make_client()
+    accessions = random.Random(0).sample(sorted(Genome.load(GENOME).genes_by_transcript), 100)
+    def run():
+        response = client.post(f"/api/batch/{GENOME}", json={"queries": accessions})
+        response.get_data()
+    return(run)
+
+##############
+# The runner #
+##############
+
+def run_benchmarks(pattern: str = None, repeats: int = 5, min_time: float = 0.2):
+    """Run the benchmarks (whose names contain pattern, if there is one) and return their results by name"""
+    results = {}
+    for name, setup in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        function = setup()
+        function() # Warm up (and load anything that's loaded lazily)
+        results[name] = time_call(function, repeats=repeats, min_time=min_time)
+        print(f"{name:<45} {format_time(results[name]['median'])}")
+    return(results)
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Compare results to a baseline, returning the names of the benchmarks that got more than threshold slower"""
+    regressions = []
+    print(f"\n{'benchmark':<45} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<45} {'-':>10} {format_time(result['median']):>10}      new")
+            continue
+        change = result["median"] / baseline[name]["median"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  SLOWER"
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<45} {format_time(baseline[name]['median']):>10} {format_time(result['median']):>10} {change:>+8.0%}{flag}")
+    return(regressions)
+
+def format_time(seconds: float):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return(f"{seconds / scale:.2f}{unit}")
+    return(f"{seconds / 1e-9:.0f}ns")
+
+def git_commit():
+    try:
+        return(subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None)
+    except OSError:
+        return(None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark EasyGeneDB on a synthetic genome")
+    parser.add_argument("--data-dir", help=f"A DATA_DIR with a {GENOME} genome in it (default: generate one in a temporary directory)")
+    parser.add_argument("--genes", type=int, default=2000, help="Number of genes in the generated genome")
+    parser.add_argument("--filter", help="Only run the benchmarks whose names contain this")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Seconds each timing should take at least")
+    parser.add_argument("--out", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="How much slower counts as a regression (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    if args.data_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix="easygenedb-bench-")
+        args.data_dir = tmp_dir
+        print(f"Generating a synthetic genome with {args.genes} genes in {tmp_dir}")
+        generate_genome(f"{tmp_dir}/{GENOME}", n_genes=args.genes)
+    # The server reads its settings from the environment the first time it uses one, so this has to happen first
+    os.environ["DATA_DIR"] = args.data_dir
+    os.environ.setdefault("FLASK_SECRET_KEY", "benchmarks")
+    os.environ.setdefault("ENVIRONMENT", "local")
+    from server.helper import cache_config
+    cache_dir = tempfile.mkdtemp(prefix="easygenedb-bench-cache-")
+    cache_config["CACHE_DIR"] = cache_dir
+
+    try:
+        results = run_benchmarks(args.filter, repeats=args.repeats, min_time=args.min_time)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    output = {
+        "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "genes": args.genes if tmp_dir is not None else None, "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"\nResults written to {args.out}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) got more than {args.threshold:.0%} slower: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Write a synthetic genome in the same layout as a real one in DATA_DIR (see NOTES.md)
+It's all random sequence, but the shape of the data (and the pathological genes) is realistic enough to benchmark with:
+    - DMD, a 2.2 Mb gene (as long as the real one)
+    - MANYTX, a gene with 120 transcripts
+    - LRFN1, with a duplicated transcript row and an accession that isn't in any shard (like the real data)
+
+    python benchmarks/synthetic_genome.py /tmp/data/hg38 --genes 60000 --chromosomes 24
+"""
+import argparse, os, random
+
+GENES_COLUMNS = ["ncbi_gene_id", "symbol", "name", "type", "locus", "transcripts"]
+TRANSCRIPT_COLUMNS = ["gene", "transcript", "transcript_biotype", "product", "source", "xref",
+                      "transcript_bounds", "exons", "CDSs", "start_codon", "stop_codon"]
+GENE_TYPES = ["protein-coding", "protein-coding", "protein-coding", "ncRNA", "pseudogene", "miRNA", "tRNA", "rRNA"]
+SENSE_CODONS = [a+b+c for a in "ACGT" for b in "ACGT" for c in "ACGT" if a+b+c not in ("TAA", "TAG", "TGA")]
+
+def random_sequence(rng, length):
+    return("".join(rng.choices("ACGT", k=length)))
+
+def write_chromosome(rng, path, length, n_run=10000):
+    """Write a chromosome with N runs at the ends (like telomeres) and some soft-masked repeats"""
+    sequence = list("N"*n_run + random_sequence(rng, length - 2*n_run) + "N"*n_run)
+    for _ in range(length // 50000):
+        start = rng.randrange(n_run, length - n_run - 500)
+        for i in range(start, start + rng.randrange(50, 500)):
+            sequence[i] = sequence[i].lower()
+    with open(path, "w") as f:
+        f.write("".join(sequence))
+
+def make_transcript(rng, gene, accession, biotype, start, end):
+    """Make one row of a transcripts shard with exons (and CDSs for mRNAs) inside [start, end]"""
+    n_exons = max(1, min(rng.randrange(1, 12), (end - start) // 200))
+    cuts = sorted(rng.sample(range(start + 1, end), 2*n_exons - 2)) if n_exons > 1 else []
+    bounds = [start] + cuts + [end]
+    exons = [(bounds[i], bounds[i+1]) for i in range(0, len(bounds), 2)]
+    CDSs = []
+    if biotype == "mRNA":
+        # Trim the outer exons a bit so there are UTRs, then make the total length a multiple of 3
+        CDSs = [list(exon) for exon in exons]
+        CDSs[0][0] = min(CDSs[0][0] + 10, CDSs[0][1])
+        CDSs[-1][1] = max(CDSs[-1][1] - 10, CDSs[-1][0])
+        total = sum(e - s + 1 for s, e in CDSs)
+        CDSs[-1][1] -= total % 3
+        CDSs = [tuple(cds) for cds in CDSs if cds[1] >= cds[0]]
+    return({
+        "gene": gene["symbol"],
+        "transcript": accession,
+        "transcript_biotype": biotype,
+        "product": f"{gene['name']}, transcript variant {accession}",
+        "source": rng.choice(["BestRefSeq", "Gnomon"]) if accession[0] in "NX" else "Curated Genomic",
+        "xref": f"GeneID:{gene['ncbi_gene_id']},HGNC:HGNC:{rng.randrange(1, 99999)}",
+        "transcript_bounds": str((start, end)),
+        "exons": str(exons),
+        "CDSs": str(CDSs),
+        "start_codon": "",
+        "stop_codon": "",
+    })
+
+def write_tsv(path, columns, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\t".join(columns) + "\n")
+        for row in rows:
+            f.write("\t".join(str(row[column]) for column in columns) + "\n")
+
+def generate_genome(out_dir, n_chromosomes=3, chromosome_length=5_000_000, n_genes=2000,
+                    genes_per_shard=100, long_gene_length=2_200_000, many_transcripts=120, seed=0):
+    """Generate a synthetic genome directory and return the list of gene rows"""
+    rng = random.Random(seed)
+    os.makedirs(f"{out_dir}/sequences", exist_ok=True)
+    os.makedirs(f"{out_dir}/transcripts", exist_ok=True)
+    chromosomes = [str(i+1) for i in range(n_chromosomes - 1)] + ["X"]
+    for chromosome in chromosomes:
+        write_chromosome(rng, f"{out_dir}/sequences/chr{chromosome}.txt", chromosome_length)
+
+    genes, transcripts = [], []
+    accession_counter = 100000
+    for i in range(n_genes):
+        gene = {"ncbi_gene_id": str(1000 + i), "symbol": f"SYN{i}", "name": f"synthetic gene {i}",
+                "type": rng.choice(GENE_TYPES)}
+        n_transcripts, length = rng.randrange(1, 6), rng.randrange(1000, 60000)
+        # The pathological genes: one DMD-sized gene and one with a lot of transcripts
+        if i == 0:
+            gene.update(symbol="DMD", name="dystrophin", type="protein-coding")
+            length = min(long_gene_length, chromosome_length - 40000)
+        elif i == 1:
+            gene.update(symbol="MANYTX", name="gene with many transcripts", type="protein-coding")
+            n_transcripts = many_transcripts
+        chromosome = rng.choice(chromosomes)
+        strand = rng.choice(["plus", "minus"])
+        start = rng.randrange(20000, chromosome_length - 20000 - length)
+        end = start + length - 1
+        gene["locus"] = str((chromosome, strand, start, end))
+        accessions = []
+        for _ in range(n_transcripts):
+            accession_counter += 1
+            if gene["type"] == "protein-coding":
+                prefix, biotype = rng.choice([("NM_", "mRNA"), ("XM_", "mRNA")])
+            else:
+                prefix, biotype = rng.choice([("NR_", "transcript"), ("XR_", "transcript")])
+            accession = f"{prefix}{accession_counter}.{rng.randrange(1, 4)}"
+            tx_start = rng.randrange(start, start + length // 4)
+            tx_end = rng.randrange(end - length // 4, end + 1)
+            transcripts.append(make_transcript(rng, gene, accession, biotype, tx_start, tx_end))
+            accessions.append(accession)
+        # Recreate the LRFN1 problem: a duplicated row and an accession that's in genes.tsv but in no shard
+        if i == 2:
+            gene.update(symbol="LRFN1", name="leucine rich repeat and fibronectin type III domain containing 1")
+            for transcript in transcripts[-len(accessions):]:
+                transcript["gene"] = "LRFN1"
+            transcripts.append(dict(transcripts[-1]))
+            accessions.append("XM_017027033.2")
+        gene["transcripts"] = str(accessions)
+        genes.append(gene)
+
+    write_tsv(f"{out_dir}/genes.tsv", GENES_COLUMNS, genes)
+    index_rows = []
+    for shard in range(0, len(genes), genes_per_shard):
+        shard_symbols = set(gene["symbol"] for gene in genes[shard:shard + genes_per_shard])
+        file_index = f"file_{shard // genes_per_shard}"
+        write_tsv(f"{out_dir}/transcripts/{file_index}.tsv", TRANSCRIPT_COLUMNS,
+                  [transcript for transcript in transcripts if transcript["gene"] in shard_symbols])
+        index_rows += [{"gene_symbol": symbol, "file_index": file_index} for symbol in sorted(shard_symbols)]
+    write_tsv(f"{out_dir}/transcripts/index.tsv", ["gene_symbol", "file_index"], index_rows)
+    return(genes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic genome in the DATA_DIR layout")
+    parser.add_argument("out_dir")
+    parser.add_argument("--chromosomes", type=int, default=3)
+    parser.add_argument("--chromosome-length", type=int, default=5_000_000)
+    parser.add_argument("--genes", type=int, default=2000)
+    parser.add_argument("--genes-per-shard", type=int, default=100)
+    parser.add_argument("--long-gene-length", type=int, default=2_200_000)
+    parser.add_argument("--many-transcripts", type=int, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_genome(args.out_dir, args.chromosomes, args.chromosome_length, args.genes,
+                    args.genes_per_shard, args.long_gene_length, args.many_transcripts, args.seed)
@@ -1,13 +1,16 @@
-from flask import Flask
 from datetime import datetime, timezone
 import pytz, json
 
-from server.helper import settings, format_number, count_things, get_unique_gene_types
-# from server.helper import settings, cache_config, cache, scheduler
-from server.models import Genome
-# from server.tasks import 
-
 def create_app():
+    # Imported here so that importing any server module (like server.dna_tools from a script or the CLI)
+    # doesn't run this and pull in Flask
+    from flask import Flask
+    from server.startup import startup
+    from server.helper import settings, format_number, count_things, get_unique_gene_types
+    # from server.helper import settings, cache_config, cache, scheduler
+    from server.response_cache import response_cache
+    from server.metrics import metrics
+    # from server.tasks import 
 
     # Set up Flask app
     app = Flask(__name__)
@@ -20,8 +23,13 @@ def create_app():
     app.jinja_env.globals.update(count_things=count_things)
     app.jinja_env.globals.update(get_unique_gene_types=get_unique_gene_types)
     
-    # Set up cache (object defined in helper.py)
-    # cache.init_app(app, config=cache_config)
+    # Set up cache (object defined in helper.py, and only imported if RESPONSE_DISK_CACHE is on)
+    # It's the shared on-disk tier behind each worker's in-memory cache of responses (see response_cache.py)
+    disk_cache = None
+    if settings.RESPONSE_DISK_CACHE:
+        from server.helper import cache, cache_config
+        cache.init_app(app, config=cache_config)
+        disk_cache = cache
 
     # Set up scheduler (object defined in helper.py)
     # scheduler.init_app(app)
@@ -38,6 +46,16 @@ def create_app():
     #     print("Scheduler started! ⏰")
     #     update_all_portfolio_vals() # To make sure it works! And the server was down during the update time!
 
+    # Server-Timing headers, /metrics and slow request logging (only if METRICS_ENABLED is set)
+    metrics.init_app(app, enabled=settings.METRICS_ENABLED, slow_request_ms=settings.SLOW_REQUEST_MS)
+
+    # Load the genomes (and their indexes) now so it happens once (in the gunicorn master with --preload) and not
+    # on a request, and add /ready (WARMUP and WARM_INDEXES in .env, see startup.py)
+    startup.init_app(app, mode=settings.WARMUP, indexes=settings.WARM_INDEXES)
+    response_cache.init_app(app, disk_cache=disk_cache, data_dir=settings.DATA_DIR,
+                            memory_max_bytes=int(settings.RESPONSE_CACHE_MB * 2**20))
+    print(f"Caching responses for data version {response_cache.version} 🗄️")
+
     # Blueprint for main routes from routes/main.py
     from .routes.main import main as main_blueprint
     app.register_blueprint(main_blueprint)
@@ -49,5 +67,6 @@ def create_app():
     # Make sure the app is running with the correct settings
     print("Routes registered! 🌐")
     print(f"The current environment is {settings.ENVIRONMENT} 🌎")
+    startup.app_created()
 
     return(app)
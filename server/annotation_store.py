@@ -0,0 +1,221 @@
+"""
+Compiled (binary) version of a genome's annotations: genes.tsv + transcripts/*.tsv in one file
+Everything is stored as flat arrays that we memory-map, so loading it doesn't parse anything
+Strings are interned in a string table and everything else refers to them by index
+
+Build it from the TSV layout with:
+    python -m server.cli compile-annotation hg38
+
+File layout (numbers are in the byte order of the machine that built it):
+    MAGIC (8 bytes) | FORMAT_VERSION (uint32) | header length (uint32) | header (JSON) | sections...
+The header has the source fingerprint and where each section (array) starts
+"""
+from server.helper import load_tsv_data, file_fingerprint
+from server.transcript_index import TranscriptIndex
+from server.sequence_store import sequence_files
+import ast, json, mmap, os, struct, sys
+from array import array
+
+MAGIC = b"EGDBANNO"
+FORMAT_VERSION = 1
+FILENAME = "annotation.bin"
+
+# Typecodes for each section -- "I" for string IDs and offsets, "i" for coordinates
+SECTIONS = {
+    "string_offsets": "Q", "string_data": "B",
+    "gene_id": "I", "gene_symbol": "I", "gene_name": "I", "gene_type": "I",
+    "gene_chromosome": "I", "gene_strand": "I", "gene_start": "i", "gene_end": "i",
+    "gene_accession_offsets": "I", "gene_accessions": "I", "gene_transcript_offsets": "I",
+    "transcript_accession": "I", "transcript_biotype": "I", "transcript_product": "I",
+    "transcript_source": "I", "transcript_xref": "I", "transcript_start": "i", "transcript_end": "i",
+    "transcript_exon_offsets": "I", "exons": "i", "transcript_cds_offsets": "I", "CDSs": "i",
+}
+
+def source_files(genome_dir):
+    """The TSV files the compiled store is built from (to tell when it's stale)"""
+    transcripts_dir = f"{genome_dir}/transcripts"
+    shards = sorted(f for f in os.listdir(transcripts_dir) if f.endswith(".tsv")) if os.path.isdir(transcripts_dir) else []
+    return([f"{genome_dir}/genes.tsv"] + [f"{transcripts_dir}/{shard}" for shard in shards])
+
+def data_fingerprint(genome_dir):
+    """Fingerprint of the annotations and the chromosome sequences, for the files built from both
+    (the k-mer index and the derived sequences) -- the compiled annotations only need source_files
+    """
+    return(file_fingerprint(source_files(genome_dir) + sequence_files(genome_dir)))
+
+class AnnotationStore():
+    def __init__(self, path: str, expected_fingerprint: str = None):
+        """Memory-map a compiled annotation file (raises ValueError if it's the wrong version or stale)"""
+        self.path = path
+        self.mmap, self.header, self.arrays = open_sections(path, SECTIONS, "compiled annotation", expected_fingerprint)
+        self.gene_count = len(self.arrays["gene_symbol"])
+        self.transcript_count = len(self.arrays["transcript_accession"])
+
+    def string(self, string_id: int):
+        """Get a string from the string table"""
+        offsets = self.arrays["string_offsets"]
+        return(bytes(self.arrays["string_data"][offsets[string_id]:offsets[string_id+1]]).decode("utf-8"))
+
+    def gene(self, i: int):
+        """Get the fields of the i-th gene (as keyword arguments for a Gene object)"""
+        a, string = self.arrays, self.string
+        accessions = a["gene_accessions"][a["gene_accession_offsets"][i]:a["gene_accession_offsets"][i+1]]
+        return({
+            "ncbi_gene_id": string(a["gene_id"][i]),
+            "symbol": string(a["gene_symbol"][i]),
+            "name": string(a["gene_name"][i]),
+            "type": string(a["gene_type"][i]),
+            "locus": (string(a["gene_chromosome"][i]), string(a["gene_strand"][i]), a["gene_start"][i], a["gene_end"][i]),
+            "transcripts": [string(accession) for accession in accessions],
+        })
+
+    def gene_transcripts(self, i: int):
+        """Get the range of transcript indexes that belong to the i-th gene"""
+        offsets = self.arrays["gene_transcript_offsets"]
+        return(range(offsets[i], offsets[i+1]))
+
+    def transcript_accession(self, j: int):
+        """Get just the accession of the j-th transcript"""
+        return(self.string(self.arrays["transcript_accession"][j]))
+
+    def transcript(self, j: int):
+        """Get the fields of the j-th transcript (as keyword arguments for a Transcript object)"""
+        a, string = self.arrays, self.string
+        return({
+            "transcript": string(a["transcript_accession"][j]),
+            "transcript_biotype": string(a["transcript_biotype"][j]),
+            "product": string(a["transcript_product"][j]),
+            "source": string(a["transcript_source"][j]),
+            "xref": string(a["transcript_xref"][j]),
+            "transcript_bounds": (a["transcript_start"][j], a["transcript_end"][j]),
+            "exons": self._bounds("exons", "transcript_exon_offsets", j),
+            "CDSs": self._bounds("CDSs", "transcript_cds_offsets", j),
+        })
+
+    def _bounds(self, name, offsets_name, j):
+        """Turn a flat run of (start, end, start, end, ...) into a list of tuples"""
+        offsets = self.arrays[offsets_name]
+        flat = self.arrays[name][2*offsets[j]:2*offsets[j+1]]
+        return(list(zip(flat[0::2], flat[1::2])))
+
+    @classmethod
+    def open(cls, genome_dir: str):
+        """Open the compiled store for a genome if there's a fresh one (otherwise None and we use the TSVs)"""
+        path = f"{genome_dir}/{FILENAME}"
+        if not os.path.isfile(path):
+            return(None)
+        try:
+            return(cls(path, expected_fingerprint=file_fingerprint(source_files(genome_dir))))
+        except ValueError as e:
+            print(f"Not using the compiled annotations: {e} ⚠️")
+            return(None)
+
+def compile_annotation(genome_dir: str, out_path: str = None):
+    """Compile the TSV annotations of a genome into a single binary file"""
+    out_path = out_path or f"{genome_dir}/{FILENAME}"
+    arrays = {name: array(typecode) for name, typecode in SECTIONS.items()}
+    strings = {}
+    arrays["string_offsets"].append(0)
+    def intern(string):
+        if string not in strings:
+            strings[string] = len(strings)
+            arrays["string_data"].frombytes(string.encode("utf-8"))
+            arrays["string_offsets"].append(len(arrays["string_data"]))
+        return(strings[string])
+
+    # The transcript index sorts out duplicated and missing accessions for us
+    transcript_index = TranscriptIndex(genome_dir)
+
+    arrays["gene_accession_offsets"].append(0)
+    arrays["gene_transcript_offsets"].append(0)
+    arrays["transcript_exon_offsets"].append(0)
+    arrays["transcript_cds_offsets"].append(0)
+    for gene in load_tsv_data(f"{genome_dir}/genes.tsv"):
+        chromosome, strand, start, end = ast.literal_eval(gene["locus"])
+        for column, value in [("gene_id", gene["ncbi_gene_id"]), ("gene_symbol", gene["symbol"]),
+                              ("gene_name", gene["name"]), ("gene_type", gene["type"]),
+                              ("gene_chromosome", chromosome), ("gene_strand", strand)]:
+            arrays[column].append(intern(value))
+        arrays["gene_start"].append(int(start))
+        arrays["gene_end"].append(int(end))
+        accessions = transcript_index.gene_accessions(gene["symbol"], ast.literal_eval(gene["transcripts"]))
+        arrays["gene_accessions"].extend(intern(accession) for accession in accessions)
+        arrays["gene_accession_offsets"].append(len(arrays["gene_accessions"]))
+
+        for row in transcript_index.read_rows(accessions):
+            for column, key in [("transcript_accession", "transcript"), ("transcript_biotype", "transcript_biotype"),
+                                ("transcript_product", "product"), ("transcript_source", "source"),
+                                ("transcript_xref", "xref")]:
+                arrays[column].append(intern(row[key]))
+            start, end = ast.literal_eval(row["transcript_bounds"])
+            arrays["transcript_start"].append(int(start))
+            arrays["transcript_end"].append(int(end))
+            for name, offsets_name, key in [("exons", "transcript_exon_offsets", "exons"),
+                                            ("CDSs", "transcript_cds_offsets", "CDSs")]:
+                for bound in ast.literal_eval(row[key] or "[]"):
+                    arrays[name].extend((int(bound[0]), int(bound[1])))
+                arrays[offsets_name].append(len(arrays[name]) // 2)
+        arrays["gene_transcript_offsets"].append(len(arrays["transcript_accession"]))
+
+    write_sections(out_path, arrays, {
+        "genome": os.path.basename(os.path.normpath(genome_dir)),
+        "fingerprint": file_fingerprint(source_files(genome_dir)),
+        "byteorder": sys.byteorder,
+    })
+    return(out_path)
+
+def open_sections(path, typecodes, description, expected_fingerprint=None, magic=MAGIC, version=FORMAT_VERSION):
+    """Memory-map a file written by write_sections() and get (mmap, header, arrays by section name)
+    Raises ValueError if it's not the right kind of file, the wrong version, or stale
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:8] != magic:
+        raise ValueError(f"{path} is not a {description} file")
+    file_version, header_length = struct.unpack_from("II", mapped, 8)
+    if file_version != version:
+        raise ValueError(f"{path} is format version {file_version} but we need version {version} (rebuild it)")
+    header = json.loads(mapped[16:16+header_length])
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError(f"{path} was built on a {header['byteorder']}-endian machine (rebuild it)")
+    if expected_fingerprint is not None and header["fingerprint"] != expected_fingerprint:
+        raise ValueError(f"{path} is stale (the files it was built from changed since)")
+
+    # Each section is a zero-copy memoryview of the right type over the mmap
+    buffer = memoryview(mapped)
+    arrays = {}
+    for name, (offset, count) in header["sections"].items():
+        itemsize = struct.calcsize(typecodes[name])
+        arrays[name] = buffer[offset:offset + count*itemsize].cast(typecodes[name])
+    return((mapped, header, arrays))
+
+def layout_sections(sizes, header, magic=MAGIC, version=FORMAT_VERSION):
+    """Work out where write_sections() puts each section, from {section name: (count, itemsize)} (in file order)
+    Returns (the bytes that go before the sections, {section name: file offset}, file size)
+    """
+    # The header has to know the offsets, which depend on the header length, so we pad it to a fixed size
+    sections, offset = {}, 0
+    for name, (count, itemsize) in sizes.items():
+        sections[name] = [offset, count]
+        offset += -(-count*itemsize // 8) * 8
+    header = dict(header, sections=sections)
+    header_length = len(json.dumps(header)) + 32*len(sections) + 64
+    start = -(-(16 + header_length) // 8) * 8
+    for name in sections:
+        sections[name][0] += start
+    header_bytes = json.dumps(header).encode("utf-8").ljust(header_length)
+    prefix = magic + struct.pack("II", version, header_length) + header_bytes
+    return((prefix, {name: section_offset for name, (section_offset, _) in sections.items()}, start + offset))
+
+def write_sections(out_path, arrays, header, magic=MAGIC, version=FORMAT_VERSION):
+    """Write the arrays (8-byte aligned) after the magic, version and JSON header (in native byte order)"""
+    prefix, offsets, size = layout_sections({name: (len(values), values.itemsize) for name, values in arrays.items()},
+                                            header, magic=magic, version=version)
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(prefix)
+        for name, values in arrays.items():
+            f.seek(offsets[name])
+            values.tofile(f)
+        f.truncate(size)
+    os.replace(tmp_path, out_path) # So a running worker never sees a half-written file
@@ -0,0 +1,141 @@
+"""
+Command line tools for building and managing the data in DATA_DIR (run from the root of the project)
+    python -m server.cli compile-annotation hg38
+    python -m server.cli pack-sequences hg38 --verify
+    python -m server.cli export-sequences hg38 proteins --gzip --nm-only
+    python -m server.cli ingest hg38 --gff genomic.gff.gz --fasta genomic.fna.gz
+    python -m server.cli build-kmer-index hg38
+    python -m server.cli build-derived-sequences hg38
+"""
+from server.helper import settings
+import argparse, os
+
+def compile_annotation_command(args):
+    from server.annotation_store import compile_annotation
+    path = compile_annotation(f"{settings.DATA_DIR}/{args.genome}")
+    print(f"Compiled annotations written to {path} 📦")
+
+def pack_sequences_command(args):
+    from server.sequence_store import pack_genome_sequences
+    packed = pack_genome_sequences(f"{settings.DATA_DIR}/{args.genome}", verify=args.verify)
+    print(f"Packed {len(packed)} chromosome sequences into 2-bit files 🧬")
+
+def export_sequences_command(args):
+    from server.export import export_sequences
+    extension = ".fa.gz" if args.gzip else ".fa"
+    result = export_sequences(args.genome, args.kind, args.output or f"{args.genome}_{args.kind}{extension}",
+                              processes=args.processes, compress=args.gzip, nm_only=args.nm_only,
+                              biotypes=args.biotype, gene_types=args.gene_type,
+                              line_width=args.line_width, restart=args.restart)
+    if result["skipped"]:
+        print(f"Skipped {len(result['skipped'])} transcripts whose sequences couldn't be made (e.g. {result['skipped'][0]})")
+    print(f"Exported {args.kind} to {result['path']} 📤")
+
+def ingest_command(args):
+    from server.ingest import ingest_genome
+    genome_dir = f"{settings.DATA_DIR}/{args.genome}"
+    report = ingest_genome(genome_dir, args.gff, args.fasta, processes=args.processes, force=args.force)
+    print(f"Ingested {report['genes']} genes on {len(report['chromosomes'])} chromosomes into {genome_dir} 🧬")
+    print(f"    Skipped {len(report['skipped_sequences'])} alt/patch/unplaced sequences, "
+          f"{len(report['duplicate_accessions'])} duplicate accessions and {len(report['duplicate_symbols'])} duplicate gene symbols "
+          f"(see {genome_dir}/.ingest/report.json)")
+    if report["rebuilt_annotations"] and os.path.isfile(f"{genome_dir}/annotation.bin"):
+        print("    The annotations changed, so run compile-annotation again")
+    if (report["rebuilt_annotations"] or report["rebuilt_sequences"]) and os.path.isfile(f"{genome_dir}/kmers.bin"):
+        print("    Run build-kmer-index again too")
+    if (report["rebuilt_annotations"] or report["rebuilt_sequences"]) and os.path.isfile(f"{genome_dir}/derived.bin"):
+        print("    Run build-derived-sequences again too")
+    if report["rebuilt_sequences"]:
+        print("    Some sequences changed (and their 2-bit files were removed), so run pack-sequences again if you use them")
+
+def load_genome(name):
+    from server.models import Genome
+    genome = Genome.load(name)
+    if genome is None:
+        raise SystemExit(f"Genome {name} not found in {settings.DATA_DIR}")
+    return(genome)
+
+def build_kmer_index_command(args):
+    from server.kmer_index import build_kmer_index
+    genome = load_genome(args.genome)
+    result = build_kmer_index(genome)
+    if result["skipped"]:
+        print(f"Skipped {len(result['skipped'])} sequences that couldn't be made (e.g. {result['skipped'][0]})")
+    print(f"Indexed {result['nucleotide']} transcripts and {result['peptide']} proteins into {result['path']} 🔎")
+
+def print_validation(result):
+    for key, field in result["mismatches"][:10]:
+        print(f"    {key}: {field}" if field else f"    {key}")
+    if result["mismatches"]:
+        raise SystemExit(f"{len(result['mismatches'])} of the stored sequences don't match computing them (rebuild them) ❌")
+    print(f"Checked the stored sequences of {result['checked']} transcripts against computing them ✅")
+
+def build_derived_sequences_command(args):
+    from server.derived_store import build_derived_store, validate_derived_store, DerivedStore
+    genome = load_genome(args.genome)
+    result = build_derived_store(genome)
+    if result["skipped"]:
+        print(f"Skipped {len(result['skipped'])} sequences that couldn't be made (e.g. {result['skipped'][0]})")
+    print(f"Stored the derived sequences of {result['transcripts']} transcripts in {result['path']} 💾")
+    if not args.skip_validation:
+        print_validation(validate_derived_store(genome, DerivedStore(result["path"])))
+
+def validate_derived_sequences_command(args):
+    from server.derived_store import validate_derived_store
+    genome = load_genome(args.genome)
+    if genome.derived is None:
+        raise SystemExit(f"Genome {args.genome} doesn't have (fresh) derived sequences, run build-derived-sequences")
+    print_validation(validate_derived_store(genome, genome.derived))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m server.cli", description="Build and manage the data in DATA_DIR")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compile_parser = subparsers.add_parser("compile-annotation", help="Compile a genome's TSV annotations into a binary file")
+    compile_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    compile_parser.set_defaults(func=compile_annotation_command)
+
+    pack_parser = subparsers.add_parser("pack-sequences", help="Convert a genome's chr*.txt sequences into 2-bit chr*.2bit files")
+    pack_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    pack_parser.add_argument("--verify", action="store_true", help="Check that every packed file decodes back to the original")
+    pack_parser.set_defaults(func=pack_sequences_command)
+
+    export_parser = subparsers.add_parser("export-sequences", help="Export every transcript's RNA, CDS or protein sequence to FASTA")
+    export_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    export_parser.add_argument("kind", choices=["transcripts", "cds", "proteins"], help="Which sequences to export")
+    export_parser.add_argument("-o", "--output", help="Where to write the FASTA file (default: GENOME_KIND.fa in the current directory)")
+    export_parser.add_argument("--processes", type=int, help="Number of worker processes (default: one per CPU)")
+    export_parser.add_argument("--gzip", action="store_true", help="Write a gzipped FASTA file")
+    export_parser.add_argument("--nm-only", action="store_true", help="Only export curated mRNAs (NM_ accessions)")
+    export_parser.add_argument("--biotype", action="append", help="Only export transcripts with this biotype (can be repeated)")
+    export_parser.add_argument("--gene-type", action="append", help="Only export genes of this type (can be repeated)")
+    export_parser.add_argument("--line-width", type=int, default=70, help="Bases per FASTA line (default: 70)")
+    export_parser.add_argument("--restart", action="store_true", help="Don't reuse chromosomes finished by an earlier run")
+    export_parser.set_defaults(func=export_sequences_command)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Build (or update) a genome from a RefSeq GFF3 and genome FASTA")
+    ingest_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    ingest_parser.add_argument("--gff", required=True, help="The GFF3 annotations (can be gzipped)")
+    ingest_parser.add_argument("--fasta", required=True, help="The genome sequence FASTA (can be gzipped)")
+    ingest_parser.add_argument("--processes", type=int, help="Number of worker processes (default: one per CPU)")
+    ingest_parser.add_argument("--force", action="store_true", help="Rebuild every chromosome, even if it didn't change")
+    ingest_parser.set_defaults(func=ingest_command)
+
+    kmer_parser = subparsers.add_parser("build-kmer-index", help="Index a genome's transcript and protein sequences for /api/sequence_search")
+    kmer_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    kmer_parser.set_defaults(func=build_kmer_index_command)
+
+    derived_parser = subparsers.add_parser("build-derived-sequences", help="Precompute every transcript's spliced RNA, CDS and protein sequences")
+    derived_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    derived_parser.add_argument("--skip-validation", action="store_true", help="Don't check the stored sequences against computing them")
+    derived_parser.set_defaults(func=build_derived_sequences_command)
+
+    validate_parser = subparsers.add_parser("validate-derived-sequences", help="Check a genome's precomputed sequences against computing them")
+    validate_parser.add_argument("genome", help="Name of the genome directory in DATA_DIR (e.g. hg38)")
+    validate_parser.set_defaults(func=validate_derived_sequences_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Mapping positions between a transcript's coordinate systems (all 1-based):
+    - genomic: a position on the chromosome
+    - transcript: a position in the spliced exonic RNA (exonic_sequence), 5' to 3'
+    - cds: a position in the coding sequence (coding_sequence), 5' to 3'
+    - protein: an amino acid of the protein (amino_acid_sequence), and codon_position is which base of its codon (1-3)
+
+Each set of regions (exons or CDSs) keeps its starts, ends and the cumulative length before each one in sorted arrays,
+so mapping one position either way is a binary search. On the minus strand the 5' end is the last base of the last
+region, so positions are counted from the plus strand side and flipped (length - position + 1)
+The *_many() versions map a whole list at once (e.g. every variant in a VCF) with the lookups kept in local variables
+"""
+from array import array
+from bisect import bisect_right
+
+COORDINATE_SYSTEMS = ["genomic", "transcript", "cds", "protein"]
+
+class SplicedMap():
+    def __init__(self, regions: list, minus: bool = False):
+        """Map between genomic positions and positions along regions (1-based, inclusive, not overlapping) spliced together"""
+        regions = sorted((int(start), int(end)) for start, end in regions)
+        self.minus = minus
+        self.starts = array("i", (start for start, _ in regions))
+        self.ends = array("i", (end for _, end in regions))
+        self.offsets = array("q") # Bases in the regions before each one (counting from the plus strand side)
+        self.length = 0
+        for start, end in regions:
+            self.offsets.append(self.length)
+            self.length += end - start + 1
+
+    def to_spliced(self, position: int):
+        """Get the spliced position of a genomic position (None if it's not in any of the regions)"""
+        i = bisect_right(self.starts, position) - 1
+        if i < 0 or position > self.ends[i]:
+            return(None)
+        spliced = self.offsets[i] + position - self.starts[i] + 1
+        return(self.length - spliced + 1 if self.minus else spliced)
+
+    def to_genomic(self, position: int):
+        """Get the genomic position of a spliced position (None if it's past either end)"""
+        if not 1 <= position <= self.length:
+            return(None)
+        if self.minus:
+            position = self.length - position + 1
+        i = bisect_right(self.offsets, position - 1) - 1
+        return(self.starts[i] + position - 1 - self.offsets[i])
+
+    def to_spliced_many(self, positions):
+        """to_spliced() for a list of genomic positions (None for the ones that aren't in the regions)"""
+        starts, ends, offsets, length, minus = self.starts, self.ends, self.offsets, self.length, self.minus
+        mapped = []
+        append = mapped.append
+        for position in positions:
+            if position is None:
+                append(None)
+                continue
+            i = bisect_right(starts, position) - 1
+            if i < 0 or position > ends[i]:
+                append(None)
+                continue
+            spliced = offsets[i] + position - starts[i] + 1
+            append(length - spliced + 1 if minus else spliced)
+        return(mapped)
+
+    def to_genomic_many(self, positions):
+        """to_genomic() for a list of spliced positions (None for the ones that are out of range)"""
+        starts, offsets, length, minus = self.starts, self.offsets, self.length, self.minus
+        mapped = []
+        append = mapped.append
+        for position in positions:
+            if position is None or not 1 <= position <= length:
+                append(None)
+                continue
+            if minus:
+                position = length - position + 1
+            i = bisect_right(offsets, position - 1) - 1
+            append(starts[i] + position - 1 - offsets[i])
+        return(mapped)
+
+class CoordinateMap():
+    def __init__(self, exons: list, CDSs: list, minus: bool = False):
+        """Map positions between the coordinate systems of one transcript (see COORDINATE_SYSTEMS)
+        exons and CDSs are the (clipped) genomic regions the transcript's sequences are made from -- CDSs can be empty
+        """
+        self.exons = SplicedMap(exons, minus)
+        self.CDSs = SplicedMap(CDSs, minus) if CDSs else None
+
+    def to_genomic(self, system: str, positions: list):
+        """Map a list of positions in one coordinate system to genomic positions
+        A protein position maps to the first (5') base of its codon
+        """
+        if system not in COORDINATE_SYSTEMS:
+            raise ValueError(f"Unknown coordinate system {system} (it has to be one of {', '.join(COORDINATE_SYSTEMS)})")
+        if system == "genomic":
+            return(list(positions))
+        if system == "transcript":
+            return(self.exons.to_genomic_many(positions))
+        if self.CDSs is None:
+            return([None] * len(positions))
+        if system == "protein":
+            positions = [3 * (position - 1) + 1 if position is not None and position > 0 else None for position in positions]
+        return(self.CDSs.to_genomic_many(positions))
+
+    def map(self, system: str, positions: list):
+        """Map a list of positions from one coordinate system to all of them
+        Returns a dictionary of lists (genomic, transcript, cds, protein and codon_position), with None where a position
+        doesn't map (like a genomic position in an intron, or anything outside the CDS for cds/protein)
+        """
+        genomic = self.to_genomic(system, positions)
+        cds = self.CDSs.to_spliced_many(genomic) if self.CDSs is not None else [None] * len(genomic)
+        return({
+            "genomic": genomic,
+            "transcript": self.exons.to_spliced_many(genomic),
+            "cds": cds,
+            "protein": [(position - 1) // 3 + 1 if position is not None else None for position in cds],
+            "codon_position": [(position - 1) % 3 + 1 if position is not None else None for position in cds],
+        })
@@ -0,0 +1,195 @@
+"""
+Every transcript's derived sequences (spliced RNA, coding sequence and protein), computed once and stored in one file
+so the models can read them instead of splicing and translating on every request (see Transcript._stored)
+
+Build it (after compile-annotation/pack-sequences if you use them -- it reads the sequences through the models) with:
+    python -m server.cli build-derived-sequences hg38
+It checks every stored sequence against the on-the-fly computation after writing the file (skip that with
+--skip-validation), and validate-derived-sequences runs the same check on its own
+The file is ignored once the annotations or the chromosome sequences change (see data_fingerprint), so rebuild it then
+
+Transcripts are keyed by accession, chromosome and bounds (some accessions are on more than one chromosome, like in the
+pseudoautosomal regions), and the keys are sorted so finding one is a binary search. Each field has its sequences end
+to end with an offset array, so getting one is a binary search and a single slice of the memory-mapped file
+A transcript that's not in the store (or a sequence that couldn't be made when it was built) is just computed like before
+"""
+from server.annotation_store import open_sections, layout_sections, data_fingerprint
+from array import array
+import os, sys
+
+MAGIC = b"EGDBSEQS"
+FORMAT_VERSION = 1
+FILENAME = "derived.bin"
+
+# The Transcript properties that are stored (the pre-RNA isn't, since it's just the genomic sequence transcribed)
+DERIVED_FIELDS = ["exonic_sequence", "coding_sequence", "amino_acid_sequence"]
+
+SECTIONS = {"key_offsets": "Q", "key_data": "B"}
+for field in DERIVED_FIELDS:
+    SECTIONS.update({f"{field}_stored": "B", f"{field}_offsets": "Q", f"{field}_data": "B"})
+
+def transcript_key(transcript):
+    """The key a transcript's sequences are stored under"""
+    return(f"{transcript.ncbi_accession} {transcript.locus[0]}:{transcript.bounds[0]}-{transcript.bounds[1]}".encode("utf-8"))
+
+def compute_fields(transcript):
+    """Compute a transcript's derived sequences (None for the ones it doesn't have or that can't be made)"""
+    sequences = {}
+    for field in DERIVED_FIELDS:
+        try:
+            sequences[field] = getattr(transcript, field)
+        except (KeyError, ValueError): # Bases or codons we can't handle (e.g. IUPAC codes, partial CDSs)
+            sequences[field] = None
+    return(sequences)
+
+def _should_have(transcript, field):
+    """Whether a transcript has the field at all (so a None means it couldn't be made)"""
+    if field == "exonic_sequence":
+        return(len(transcript.exons) > 0)
+    return(len(transcript.CDSs) > 0 and transcript.biotype == "mRNA")
+
+def computing(genome):
+    """Iterate over a genome's transcripts with the derived store turned off, so every sequence is computed"""
+    store, genome.derived = genome.derived, None
+    try:
+        yield from genome.iter_transcripts()
+    finally:
+        genome.derived = store
+
+def build_derived_store(genome, out_path: str = None):
+    """Compute the derived sequences of every transcript of a Genome object (see models.py) and write them to one file
+    Returns a dictionary with the path, how many transcripts went in, and the sequences that couldn't be made
+    The whole transcriptome doesn't fit in memory twice (or even once, for big genomes), so it's two passes:
+    the first only keeps each sequence's length (to sort the keys and work out the offsets), and the second computes
+    them again and writes each one straight to its place in the file
+    """
+    out_path = out_path or f"{genome.dir}/{FILENAME}"
+    lengths, skipped = {}, [] # Key -> length of each field's sequence (None if it's not stored)
+    for transcript in computing(genome):
+        key = transcript_key(transcript)
+        if key in lengths: # The same transcript under two genes (the first one wins, like everywhere else)
+            continue
+        sequences = compute_fields(transcript)
+        for field, sequence in sequences.items():
+            if sequence is None and _should_have(transcript, field):
+                skipped.append(f"{transcript.ncbi_accession} ({field})")
+        lengths[key] = [None if sequence is None else len(sequence) for sequence in sequences.values()]
+
+    # Everything but the sequences themselves is small enough to make in memory
+    keys = sorted(lengths)
+    arrays = {name: array(typecode) for name, typecode in SECTIONS.items() if not name.endswith("_data")}
+    arrays["key_offsets"].append(0)
+    for field in DERIVED_FIELDS:
+        arrays[f"{field}_offsets"].append(0)
+    for key in keys:
+        arrays["key_offsets"].append(arrays["key_offsets"][-1] + len(key))
+        for field, length in zip(DERIVED_FIELDS, lengths[key]):
+            arrays[f"{field}_stored"].append(length is not None)
+            arrays[f"{field}_offsets"].append(arrays[f"{field}_offsets"][-1] + (length or 0))
+    arrays["key_data"] = array("B", b"".join(keys))
+    sizes = {name: (len(arrays[name]), arrays[name].itemsize) for name in arrays}
+    for field in DERIVED_FIELDS:
+        sizes[f"{field}_data"] = (arrays[f"{field}_offsets"][-1], 1)
+    sizes = {name: sizes[name] for name in SECTIONS} # In file order
+
+    genome_dir = genome.dir
+    prefix, section_offsets, size = layout_sections(sizes, {
+        "genome": os.path.basename(os.path.normpath(genome_dir)),
+        "fingerprint": data_fingerprint(genome_dir),
+        "byteorder": sys.byteorder,
+        "fields": DERIVED_FIELDS,
+    }, magic=MAGIC, version=FORMAT_VERSION)
+    records = {key: i for i, key in enumerate(keys)}
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(prefix)
+        for name, values in arrays.items():
+            f.seek(section_offsets[name])
+            values.tofile(f)
+        written = set()
+        for transcript in computing(genome):
+            key = transcript_key(transcript)
+            if key in written:
+                continue
+            written.add(key)
+            sequences = compute_fields(transcript)
+            if [None if sequence is None else len(sequence) for sequence in sequences.values()] != lengths.get(key):
+                raise ValueError(f"The sequences of {key.decode('utf-8')} changed while the file was being built")
+            i = records[key]
+            for field, sequence in sequences.items():
+                if sequence is not None:
+                    f.seek(section_offsets[f"{field}_data"] + arrays[f"{field}_offsets"][i])
+                    f.write(sequence.encode("ascii"))
+        f.truncate(size)
+    os.replace(tmp_path, out_path) # So a running worker never sees a half-written file
+    return({"path": out_path, "transcripts": len(keys), "skipped": skipped})
+
+def validate_derived_store(genome, store):
+    """Check every stored sequence against computing it on the fly
+    Returns a dictionary with how many transcripts were checked and a list of (key, field) that don't match
+    (including transcripts or sequences that should be in the store but aren't)
+    """
+    checked, mismatches, seen = 0, [], set()
+    for transcript in computing(genome):
+        key = transcript_key(transcript)
+        if key in seen:
+            continue
+        seen.add(key)
+        checked += 1
+        i = store.find(key)
+        for field, sequence in compute_fields(transcript).items():
+            stored = store.sequence(i, field) if i is not None else None
+            if stored != sequence:
+                mismatches.append((key.decode("utf-8"), field))
+    if checked != store.transcript_count:
+        mismatches.append((f"{store.transcript_count} transcripts stored but {checked} in the genome", None))
+    return({"checked": checked, "mismatches": mismatches})
+
+class DerivedStore():
+    def __init__(self, path: str, expected_fingerprint: str = None):
+        """Memory-map a derived sequence file (raises ValueError if it's the wrong version or stale)"""
+        self.path = path
+        self.mmap, self.header, self.arrays = open_sections(path, SECTIONS, "derived sequence", expected_fingerprint,
+                                                            magic=MAGIC, version=FORMAT_VERSION)
+        if self.header["fields"] != DERIVED_FIELDS:
+            raise ValueError(f"{path} has different fields (rebuild it)")
+        self.transcript_count = len(self.arrays["key_offsets"]) - 1
+
+    def _key(self, i: int):
+        offsets = self.arrays["key_offsets"]
+        return(self.arrays["key_data"][offsets[i]:offsets[i+1]].tobytes())
+
+    def find(self, key: bytes):
+        """Get the record number of a key (see transcript_key), or None if it's not in the store"""
+        low, high = 0, self.transcript_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return(low if low < self.transcript_count and self._key(low) == key else None)
+
+    def sequence(self, i: int, field: str):
+        """Get one of the sequences of a record (None if it wasn't stored)"""
+        if not self.arrays[f"{field}_stored"][i]:
+            return(None)
+        offsets = self.arrays[f"{field}_offsets"]
+        return(str(self.arrays[f"{field}_data"][offsets[i]:offsets[i+1]], "ascii"))
+
+    def get(self, transcript, field: str):
+        """Get one of a Transcript's derived sequences (see DERIVED_FIELDS), or None if it's not in the store"""
+        i = self.find(transcript_key(transcript))
+        return(None if i is None else self.sequence(i, field))
+
+    @classmethod
+    def open(cls, genome_dir: str):
+        """Open the derived sequences of a genome if there's a fresh file (otherwise None and they're computed)"""
+        path = f"{genome_dir}/{FILENAME}"
+        if not os.path.isfile(path):
+            return(None)
+        try:
+            return(cls(path, expected_fingerprint=data_fingerprint(genome_dir)))
+        except ValueError as e:
+            print(f"Not using the derived sequences: {e} ⚠️")
+            return(None)
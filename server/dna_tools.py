@@ -3,28 +3,62 @@ This is just a bunch of helper functions for manipulating DNA sequences, etc
 NOTE: ALL REINDEXING SHOULD BE HANDLED BY THE FUNCTIONS THEMSELVES
 We will treat all sequences as 1-indexed in other contexts.
 The only OTHER reindexing that happens outside of this script is in Genome.get_sequence_by_coord()
+
+Everything is table-driven (str.translate and dict lookups) and the tables are built once when this is imported,
+so the per-base work happens in C instead of Python loops -- this matters for megabase genes like DMD
 """
+from server.metrics import timed
+import re
+
+# Complement tables (anything not in them isn't a valid base)
+DNA_COMPLEMENT = {"A": "T", "T": "A", "C": "G", "G": "C", "N": "N",
+                  "a": "t", "t": "a", "c": "g", "g": "c", "n": "n"}
+RNA_COMPLEMENT = dict(DNA_COMPLEMENT, U="A", u="a", A="U", a="u")
+DNA_COMPLEMENT_TABLE = str.maketrans(DNA_COMPLEMENT)
+RNA_COMPLEMENT_TABLE = str.maketrans(RNA_COMPLEMENT)
+# Translating with these deletes every valid base, so whatever is left over is invalid
+DNA_VALID_TABLE = str.maketrans("", "", "".join(DNA_COMPLEMENT))
+RNA_VALID_TABLE = str.maketrans("", "", "".join(RNA_COMPLEMENT))
+TRANSCRIBE_TABLE = str.maketrans("Tt", "Uu")
+
+CODON_TABLE = {
+    "UUU": "F", "UUC": "F", "UUA": "L", "UUG": "L",
+    "UCU": "S", "UCC": "S", "UCA": "S", "UCG": "S",
+    "UAU": "Y", "UAC": "Y", "UAA": "*", "UAG": "*",
+    "UGU": "C", "UGC": "C", "UGA": "*", "UGG": "W",
+    "CUU": "L", "CUC": "L", "CUA": "L", "CUG": "L",
+    "CCU": "P", "CCC": "P", "CCA": "P", "CCG": "P",
+    "CAU": "H", "CAC": "H", "CAA": "Q", "CAG": "Q",
+    "CGU": "R", "CGC": "R", "CGA": "R", "CGG": "R",
+    "AUU": "I", "AUC": "I", "AUA": "I", "AUG": "M",
+    "ACU": "T", "ACC": "T", "ACA": "T", "ACG": "T",
+    "AAU": "N", "AAC": "N", "AAA": "K", "AAG": "K",
+    "AGU": "S", "AGC": "S", "AGA": "R", "AGG": "R",
+    "GUU": "V", "GUC": "V", "GUA": "V", "GUG": "V",
+    "GCU": "A", "GCC": "A", "GCA": "A", "GCG": "A",
+    "GAU": "D", "GAC": "D", "GAA": "E", "GAG": "E",
+    "GGU": "G", "GGC": "G", "GGA": "G", "GGG": "G"
+}
 
 def order_bounds(bounds: list):
     """Order a list of bounds by their start positions"""
     return(sorted(bounds, key=lambda x: x[0]))
 
+@timed("reverse_complement")
 def reverse_complement(sequence: str, rna: bool = False):
     """Get the reverse complement of a DNA or RNA sequence"""
-    complement = {"A": "T", "T": "A", "C": "G", "G": "C", "N": "N",
-                  "a": "t", "t": "a", "c": "g", "g": "c", "n": "n"}
-    if rna:
-        complement["U"] = "A"
-        complement["u"] = "a"
-        complement["A"] = "U"
-        complement["a"] = "u"
-    return("".join([complement[base] for base in reversed(sequence)]))
+    invalid = sequence.translate(RNA_VALID_TABLE if rna else DNA_VALID_TABLE)
+    if invalid:
+        raise KeyError(invalid[0])
+    return(sequence.translate(RNA_COMPLEMENT_TABLE if rna else DNA_COMPLEMENT_TABLE)[::-1])
 
+@timed("transcribe_pre_rna")
 def transcribe_pre_rna(dna_sequence: str):
     """Transcribe a DNA sequence into pre-RNA without splicing etc."""
-    rna_sequence = dna_sequence.replace("T", "U").replace("t", "u")
+    rna_sequence = dna_sequence.translate(TRANSCRIBE_TABLE)
     return(rna_sequence)
 
+@timed("splice_rna")
 def splice_rna(rna_sequence: str, exon_bounds: list, reindex: int = 0, reverse: bool = False):
     """Splice an RNA sequence into the exonic regions only
     This should also work for getting the CDS sequence (replace exons_bounds with cds_bounds)
@@ -34,42 +68,119 @@ def splice_rna(rna_sequence: str, exon_bounds: list, reindex: int = 0, reverse:
     reindex: int - The transcript coordinate offset (set to 0 to not reindex)
     """
     exons = []
-    exon_bounds = order_bounds(exon_bounds)
-    if reverse: # Reverse the sequence if the gene is on the minus strand (else the bounds are flipped)
-        rna_sequence = reverse_complement(rna_sequence, rna=True)
-    for bounds in exon_bounds:
-        bounds = (bounds[0]-reindex, bounds[1]-reindex+1) # REMEMBER TO REINDEX 
-        # (I'm doing this empirically) I still don't get why we need to add 1 to the end bound
-        exons.append(rna_sequence[bounds[0]:bounds[1]])
-    spliced_sequence = "".join(exons)
-    if reverse: # Reverse the sequence back
-        spliced_sequence = reverse_complement(spliced_sequence, rna=True)
-    return(spliced_sequence)
-
-def translate_rna(cds_sequence: str):
-    """Translate an RNA sequence into a protein sequence"""
-    codon_table = {
-        "UUU": "F", "UUC": "F", "UUA": "L", "UUG": "L",
-        "UCU": "S", "UCC": "S", "UCA": "S", "UCG": "S",
-        "UAU": "Y", "UAC": "Y", "UAA": "*", "UAG": "*",
-        "UGU": "C", "UGC": "C", "UGA": "*", "UGG": "W",
-        "CUU": "L", "CUC": "L", "CUA": "L", "CUG": "L",
-        "CCU": "P", "CCC": "P", "CCA": "P", "CCG": "P",
-        "CAU": "H", "CAC": "H", "CAA": "Q", "CAG": "Q",
-        "CGU": "R", "CGC": "R", "CGA": "R", "CGG": "R",
-        "AUU": "I", "AUC": "I", "AUA": "I", "AUG": "M",
-        "ACU": "T", "ACC": "T", "ACA": "T", "ACG": "T",
-        "AAU": "N", "AAC": "N", "AAA": "K", "AAG": "K",
-        "AGU": "S", "AGC": "S", "AGA": "R", "AGG": "R",
-        "GUU": "V", "GUC": "V", "GUA": "V", "GUG": "V",
-        "GCU": "A", "GCC": "A", "GCA": "A", "GCG": "A",
-        "GAU": "D", "GAC": "D", "GAA": "E", "GAG": "E",
-        "GGU": "G", "GGC": "G", "GGA": "G", "GGG": "G"
-    }
-    protein = ""
-    for i in range(0, len(cds_sequence), 3):
-        codon = cds_sequence[i:i+3]
-        if len(codon) < 3:
-            raise ValueError(f"Invalid codon: {codon}")
-        protein += codon_table[codon.upper()]
-    return(protein)
\ No newline at end of file
+    length = len(rna_sequence)
+    for bounds in order_bounds(exon_bounds):
+        # REMEMBER TO REINDEX -- the bounds are inclusive, which is why the end gets a +1
+        start, end = max(bounds[0] - reindex, 0), min(bounds[1] - reindex + 1, length)
+        exons.append((start, end))
+    if reverse:
+        # The sequence is on the minus strand, so position i (on the plus strand) is at length-1-i
+        # Slicing it backwards like this is the same as reverse complementing, splicing and reverse complementing again
+        return("".join(rna_sequence[length - end:length - start] for start, end in reversed(exons)))
+    return("".join(rna_sequence[start:end] for start, end in exons))
+
+@timed("translate_rna")
+def translate_rna(cds_sequence: str, unknown: str = None):
+    """Translate an RNA sequence into a protein sequence
+    Codons that aren't in the codon table (like ones with Ns) raise a KeyError, unless unknown is set (e.g. "X")
+    """
+    if len(cds_sequence) % 3 != 0:
+        raise ValueError(f"Invalid codon: {cds_sequence[-(len(cds_sequence) % 3):]}")
+    if not cds_sequence.isupper(): # Skip the copy if it's already uppercase
+        cds_sequence = cds_sequence.upper()
+    codons = [cds_sequence[i:i+3] for i in range(0, len(cds_sequence), 3)]
+    if unknown is None:
+        return("".join([CODON_TABLE[codon] for codon in codons]))
+    return("".join([CODON_TABLE.get(codon, unknown) for codon in codons]))
+
+#####################################################
+# Batch versions (many sequences or bounds at once) #
+#####################################################
+
+def reverse_complement_many(sequences: list, rna: bool = False):
+    """Reverse complement many sequences at once"""
+    return([reverse_complement(sequence, rna=rna) for sequence in sequences])
+
+def transcribe_many(dna_sequences: list):
+    """Transcribe many DNA sequences at once"""
+    return([dna_sequence.translate(TRANSCRIBE_TABLE) for dna_sequence in dna_sequences])
+
+def splice_rna_many(rna_sequence: str, bound_sets: list, reindex: int = 0, reverse: bool = False):
+    """Splice the same RNA sequence with many sets of bounds (e.g. all the transcripts of a gene)"""
+    return([splice_rna(rna_sequence, bounds, reindex=reindex, reverse=reverse) for bounds in bound_sets])
+
+def translate_many(cds_sequences: list, unknown: str = None):
+    """Translate many RNA sequences at once"""
+    return([translate_rna(cds_sequence, unknown=unknown) for cds_sequence in cds_sequences])
+
+#############################################
+# Streaming (a chunk of sequence at a time) #
+#############################################
+
+def translate_chunks(cds_chunks, unknown: str = None):
+    """Translate an RNA sequence that comes in chunks, yielding protein chunks (codons can span chunks)"""
+    carry = ""
+    for chunk in cds_chunks:
+        chunk = carry + chunk
+        usable = len(chunk) - len(chunk) % 3
+        carry = chunk[usable:]
+        if usable:
+            yield translate_rna(chunk[:usable], unknown=unknown)
+    if carry:
+        translate_rna(carry) # Raises the same ValueError as translating the whole thing would
+
+def format_fasta(header: str, chunks, line_width: int = 70):
+    """Yield a FASTA record (header line, then the sequence in lines of line_width) from chunks of sequence
+    Set line_width to 0 to put the whole sequence on one line
+    """
+    yield f">{header}\n"
+    carry = ""
+    for chunk in chunks:
+        if not line_width:
+            yield chunk
+            continue
+        chunk = carry + chunk
+        usable = len(chunk) - len(chunk) % line_width
+        carry = chunk[usable:]
+        if usable:
+            yield "\n".join(chunk[i:i+line_width] for i in range(0, usable, line_width)) + "\n"
+    if carry or not line_width:
+        yield carry + "\n"
+
+###########################
+# Reading frames and ORFs #
+###########################
+
+ORF_PATTERN = re.compile(r"M[^*]*\*")
+
+def reading_frames(rna_sequence: str, both_strands: bool = True):
+    """Translate the 3 (or 6, with the reverse complement) reading frames of an RNA sequence
+    Returns a list of (strand, frame, protein) where frame is 0, 1 or 2 and unknown codons are X
+    """
+    strands = [("+", rna_sequence)]
+    if both_strands:
+        strands.append(("-", reverse_complement(rna_sequence, rna=True)))
+    frames = []
+    for strand, sequence in strands:
+        for frame in range(3):
+            in_frame = sequence[frame:]
+            frames.append((strand, frame, translate_rna(in_frame[:len(in_frame) - len(in_frame) % 3], unknown="X")))
+    return(frames)
+
+def find_orfs(rna_sequence: str, min_length: int = 30, both_strands: bool = True):
+    """Find open reading frames (AUG to a stop codon) at least min_length amino acids long (not counting the stop)
+    Start and end are 1-indexed and inclusive, on the strand the ORF is on (so - strand ORFs count from the 3' end)
+    """
+    orfs = []
+    for strand, frame, protein in reading_frames(rna_sequence, both_strands=both_strands):
+        for match in ORF_PATTERN.finditer(protein):
+            if match.end() - match.start() - 1 < min_length:
+                continue
+            orfs.append({
+                "strand": strand,
+                "frame": frame,
+                "start": frame + 3*match.start() + 1,
+                "end": frame + 3*match.end(),
+                "protein": match.group(),
+            })
+    return(sorted(orfs, key=lambda orf: orf["end"] - orf["start"], reverse=True))
@@ -0,0 +1,140 @@
+"""
+Whole-genome FASTA exports (every transcript's spliced RNA, coding sequence or protein) for downloading in bulk
+    python -m server.cli export-sequences hg38 proteins --gzip --nm-only
+
+The work is split up by chromosome and fanned out over a process pool:
+    - Each chromosome is written to its own part file (in OUTPUT.parts/), one transcript at a time,
+      so a worker only ever holds one gene's transcripts in memory
+    - Part files are written to a .tmp file and renamed when they're done, so if the export is stopped
+      (or crashes) running it again skips the chromosomes that are already finished
+    - At the end the parts are joined in chromosome order (gzip files can just be joined end to end)
+Records are always in the same order: chromosomes (1, 2, ..., 22, X, Y, then the rest), then genes by position,
+then each gene's transcripts in the order genes.tsv lists them -- so exports of the same data are identical
+"""
+from server.dna_tools import format_fasta
+from server.models import Genome
+import gzip, io, json, multiprocessing, os, shutil
+
+# What can be exported, and the Transcript property each one comes from
+EXPORT_KINDS = {
+    "transcripts": "exonic_sequence",
+    "cds": "coding_sequence",
+    "proteins": "amino_acid_sequence",
+}
+
+SEX_AND_MITOCHONDRIAL_CHROMOSOMES = ["X", "Y", "M", "MT"]
+
+def chromosome_sort_key(chromosome: str):
+    """Sort chromosomes like 1, 2, ..., 22, X, Y, M, then everything else (e.g. unplaced contigs) alphabetically"""
+    if chromosome.isdigit():
+        return((0, int(chromosome), ""))
+    if chromosome in SEX_AND_MITOCHONDRIAL_CHROMOSOMES:
+        return((1, SEX_AND_MITOCHONDRIAL_CHROMOSOMES.index(chromosome), ""))
+    return((2, 0, chromosome))
+
+def plan_export(genome: Genome, gene_types: list = None):
+    """Get the symbols of the genes to export, by chromosome (in export order)"""
+    by_chromosome = {}
+    for gene in genome.genes_by_symbol.values():
+        if gene_types and gene.type not in gene_types:
+            continue
+        by_chromosome.setdefault(gene.locus[0], []).append(gene)
+    return({chromosome: [gene.symbol for gene in sorted(by_chromosome[chromosome], key=lambda gene: (int(gene.locus[2]), gene.symbol))]
+            for chromosome in sorted(by_chromosome, key=chromosome_sort_key)})
+
+def keep_transcript(transcript, nm_only: bool = False, biotypes: list = None):
+    """Check a transcript against the export's filters"""
+    if nm_only and not transcript.ncbi_accession.startswith("NM_"):
+        return(False)
+    if biotypes and transcript.biotype not in biotypes:
+        return(False)
+    return(True)
+
+def text_writer(raw, compress: bool):
+    """Wrap a binary file for writing text (gzipped without a name or timestamp, so the same data gives the same bytes)"""
+    if compress:
+        raw = gzip.GzipFile(filename="", mode="wb", compresslevel=6, fileobj=raw, mtime=0)
+    return(io.TextIOWrapper(raw, encoding="utf-8"))
+
+def export_chromosome(task: dict):
+    """Write one chromosome's part file (this runs in the worker processes)
+    Returns (chromosome, number of records written, accessions skipped because their sequence couldn't be made)
+    """
+    genome = Genome.load(task["genome"])
+    field = EXPORT_KINDS[task["kind"]]
+    written, skipped = 0, []
+    tmp_path = f"{task['path']}.tmp"
+    with open(tmp_path, "wb") as raw, text_writer(raw, task["gzip"]) as f:
+        for symbol in task["genes"]:
+            gene = genome.get_gene_by_symbol(symbol)
+            for transcript in genome.get_transcripts(gene):
+                if not keep_transcript(transcript, task["nm_only"], task["biotypes"]):
+                    continue
+                try:
+                    sequence = getattr(transcript, field)
+                except (KeyError, ValueError): # Bases or codons we can't handle (e.g. IUPAC codes, partial CDSs)
+                    skipped.append(transcript.ncbi_accession)
+                    continue
+                if sequence is None: # e.g. no CDS for the cds/proteins exports
+                    continue
+                header = f"{transcript.ncbi_accession} {gene.symbol} {transcript.product}".strip()
+                f.writelines(format_fasta(header, [sequence], line_width=task["line_width"]))
+                written += 1
+    os.replace(tmp_path, task["path"])
+    return((task["chromosome"], written, skipped))
+
+def export_sequences(genome_name: str, kind: str, out_path: str, processes: int = None, compress: bool = False,
+                     nm_only: bool = False, biotypes: list = None, gene_types: list = None,
+                     line_width: int = 70, restart: bool = False):
+    """Export one kind of sequence (see EXPORT_KINDS) for a whole genome to a FASTA file
+    Finished chromosomes from an earlier run with the same settings are reused unless restart is set
+    Returns a dictionary with the output path, the number of records written this run and the accessions skipped
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"Can't export {kind} (it has to be one of {', '.join(EXPORT_KINDS)})")
+    genome = Genome.load(genome_name)
+    if genome is None:
+        raise ValueError(f"Genome {genome_name} not found")
+    # The genome is loaded before the pool starts, so forked workers share it instead of loading their own
+    plan = plan_export(genome, gene_types)
+
+    # Start over if the settings changed since the part files were written
+    parts_dir = f"{out_path}.parts"
+    settings = {"genome": genome_name, "kind": kind, "gzip": compress, "nm_only": nm_only,
+                "biotypes": sorted(biotypes or []), "gene_types": sorted(gene_types or []), "line_width": line_width}
+    settings_path = f"{parts_dir}/settings.json"
+    previous = None
+    if os.path.isfile(settings_path):
+        with open(settings_path) as f:
+            previous = json.load(f)
+    if os.path.isdir(parts_dir) and (restart or previous != settings):
+        shutil.rmtree(parts_dir)
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(settings_path, "w") as f:
+        f.write(json.dumps(settings))
+
+    extension = ".fa.gz" if compress else ".fa"
+    tasks = [dict(settings, chromosome=chromosome, genes=symbols, path=f"{parts_dir}/chr{chromosome}{extension}")
+             for chromosome, symbols in plan.items()]
+    todo = [task for task in tasks if not os.path.isfile(task["path"])]
+    print(f"Exporting {kind} for {len(tasks)} chromosomes ({len(tasks) - len(todo)} already done)")
+
+    records, skipped = 0, []
+    if todo:
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        with context.Pool(processes or os.cpu_count()) as pool:
+            # Biggest chromosomes first so one big one doesn't hold up the end of the run
+            for chromosome, written, chromosome_skipped in pool.imap_unordered(
+                    export_chromosome, sorted(todo, key=lambda task: -len(task["genes"]))):
+                records += written
+                skipped += chromosome_skipped
+                print(f"    chr{chromosome}: {written} records")
+
+    # Join the parts in chromosome order (renamed into place at the end, like the parts)
+    with open(f"{out_path}.tmp", "wb") as out:
+        for task in tasks:
+            with open(task["path"], "rb") as part:
+                shutil.copyfileobj(part, out)
+    os.replace(f"{out_path}.tmp", out_path)
+    shutil.rmtree(parts_dir)
+    return({"path": out_path, "chromosomes": len(tasks), "records": records, "skipped": skipped})
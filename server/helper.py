@@ -1,17 +1,34 @@
-from pydantic_settings import BaseSettings
-from flask import request
-from flask_caching import Cache
-from flask_apscheduler import APScheduler
-import csv
+from datetime import datetime, timezone
+from server.metrics import timed
+from array import array
+from itertools import islice
+import csv, functools, hashlib, mmap, os, sys, types
 
 # Load settings from .env file
-class Settings(BaseSettings):
-    FLASK_SECRET_KEY:str
-    ENVIRONMENT:str
-    DATA_DIR:str
-    class Config:
-        env_file = ".env"
-settings = Settings()
+# pydantic is slow to import, so the settings are only read the first time one of them is used
+@functools.cache
+def load_settings():
+    from pydantic_settings import BaseSettings
+    class Settings(BaseSettings):
+        FLASK_SECRET_KEY:str
+        ENVIRONMENT:str
+        DATA_DIR:str
+        METRICS_ENABLED:bool = False # Server-Timing headers and /metrics (see metrics.py)
+        GENOME_MEMORY_MB:float = 0 # Genomes are unloaded (least recently used first) to stay under this, per worker (0 = no limit)
+        RESPONSE_CACHE_MB:float = 16 # Each worker's in-memory cache of responses (see response_cache.py, 0 = only the disk cache)
+        SLOW_REQUEST_MS:float = 1000 # Requests slower than this are logged (when metrics are enabled)
+        WARMUP:str = "blocking" # Load the data before serving ("blocking"), while serving ("background") or on demand ("off")
+        WARM_INDEXES:bool = True # Build the region index (etc.) of every genome when warming up, not on first use
+        RESPONSE_DISK_CACHE:bool = True # Share cached responses between workers on disk (see response_cache.py)
+        class Config:
+            env_file = ".env"
+    return(Settings())
+
+class LazySettings():
+    """Stands in for the Settings object until a setting is actually read"""
+    def __getattr__(self, name):
+        return(getattr(load_settings(), name))
+settings = LazySettings()
 
 # Connect to MongoDB users database
 # users_db = client[settings.USERS_DB_NAME]
@@ -26,10 +43,19 @@ cache_config = {
     "CACHE_THRESHOLD": 1000,
     "CACHE_DIR": "./server/temp/cache"
 }
-cache = Cache()
 
-# Scheduler for initializing in __init__.py
-scheduler = APScheduler()
+# The cache (and the scheduler, for initializing in __init__.py) are made the first time they're imported,
+# so flask_caching and APScheduler aren't imported at all if nothing uses them
+def __getattr__(name):
+    if name == "cache":
+        from flask_caching import Cache
+        globals()["cache"] = Cache()
+    elif name == "scheduler":
+        from flask_apscheduler import APScheduler
+        globals()["scheduler"] = APScheduler()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return(globals()[name])
 
 ###########################
 # Helper functions below! #
@@ -60,19 +86,22 @@ def clear_game_caches(game_id, paths=GAME_PATHS_CACHED):
     # I found a big issue!
     # Filesystem caches store the hash of the key in the filename
     # There's no way to retrieve the keys from the cache unless I write a function to do it
+    from server.helper import cache
     cache.clear()
 
 # This is to log server errors
 def log_error(error_msg, path="./server/logs/errors"):
     # Save this to an output log file
     time = datetime.now(timezone.utc)
-    filename = f"{path}/{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    filename = f"{path}/{time.strftime('%Y%m%d-%H%M%S-%f')}.txt"
     try:
+        os.makedirs(path, exist_ok=True)
         with open(filename, "w") as f:
             f.write(error_msg)
     except:
         print("Couldn't write to log file!")
 
+@timed("load_tsv")
 def load_tsv_data(filename, delimiter="\t"):
     """Load data from a TSV file as a csv object"""
     data = []
@@ -81,3 +110,47 @@ def load_tsv_data(filename, delimiter="\t"):
         for row in reader:
             data.append(row)
     return(data)
+
+def file_fingerprint(paths):
+    """Hash the names, sizes and modification times of some files (to tell if the data changed since something was built)
+    Nothing is read, so it's cheap enough to check every time a genome is loaded (like response_cache.data_version)
+    Copying the files without keeping their modification times makes anything built from them look stale
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        digest.update(os.path.basename(path).encode("utf-8"))
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        digest.update(f"\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode("utf-8"))
+    return(digest.hexdigest())
+
+
+def estimate_size(obj, seen: set = None, sample: int = 100):
+    """Roughly how many bytes an object takes up in memory, counting everything it refers to
+    Objects in seen (and ones we've already counted) aren't counted again, and big containers are estimated from
+    a sample of their items, so this is quick even for a whole genome's tables
+    Memory-mapped files don't count (an mmap or a memoryview of one is just its header)
+    """
+    seen = set() if seen is None else seen
+    if obj is None or id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+        return(0)
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, array, memoryview, mmap.mmap)):
+        return(size)
+    if isinstance(obj, dict):
+        items = [item for pair in islice(obj.items(), sample) for item in pair]
+        scale = len(obj) / min(len(obj), sample) if obj else 0
+    elif isinstance(obj, (list, tuple)):
+        step = max(len(obj) // sample, 1)
+        items, scale = obj[::step], step
+    elif isinstance(obj, (set, frozenset)):
+        items = list(islice(obj, sample))
+        scale = len(obj) / len(items) if items else 0
+    else:
+        items = [vars(obj)] if hasattr(obj, "__dict__") else []
+        items += [getattr(obj, slot) for cls in type(obj).__mro__ for slot in getattr(cls, "__slots__", ())
+                  if hasattr(obj, slot)]
+        scale = 1
+    return(size + int(scale * sum(estimate_size(item, seen, sample) for item in items)))
@@ -0,0 +1,348 @@
+"""
+Build a genome directory in DATA_DIR (genes.tsv, transcripts/, sequences/) from a RefSeq GFF3 and genome FASTA
+    python -m server.cli ingest hg38 --gff GCF_000001405.40_GRCh38.p14_genomic.gff.gz \
+                                     --fasta GCF_000001405.40_GRCh38.p14_genomic.fna.gz
+Both files can be gzipped, and they're streamed (never loaded into memory all at once)
+
+How it works:
+    1. The GFF3 is split into one file per sequence (RefSeq GFF3s are grouped by sequence already),
+       hashing each chromosome's lines as it goes
+    2. Chromosomes whose lines changed since the last run are parsed in parallel worker processes, each one writing
+       its own transcript shard (transcripts/file_<chromosome>.tsv) -- the others are left alone.
+       At the same time, the FASTA is streamed into sequences/chr*.txt (only the chromosomes whose sequence changed
+       are replaced)
+    3. The genes of every chromosome are merged into genes.tsv and transcripts/index.tsv
+
+Only the primary assembly is ingested (the NC_ chromosomes, including MT): transcripts on alt loci, patches and
+unplaced/unlocalized scaffolds (NT_/NW_) are skipped. If a GFF3 has no region lines (so we can't tell), every
+sequence is treated as a chromosome, named after its ID without any "chr" prefix
+Duplicates are handled explicitly (see LRFN1 in NOTES.md), and everything skipped is listed in .ingest/report.json:
+    - A transcript accession that shows up more than once only keeps its first row (in chromosome order)
+    - A gene symbol that shows up more than once (e.g. in the X/Y pseudoautosomal regions) only keeps its first gene
+"""
+from server.export import chromosome_sort_key
+from server.helper import load_tsv_data
+import ast, csv, filecmp, gzip, hashlib, json, multiprocessing, os, shutil
+from urllib.parse import unquote
+
+INGEST_VERSION = 1 # Bump this when the parsing changes, so everything gets rebuilt
+PRIMARY_GENOMES = {"chromosome": None, "mitochondrion": "MT"} # region genome= values we keep (and their names)
+
+GENES_COLUMNS = ["ncbi_gene_id", "symbol", "name", "type", "locus", "transcripts"]
+TRANSCRIPT_COLUMNS = ["gene", "transcript", "transcript_biotype", "product", "source", "xref",
+                      "transcript_bounds", "exons", "CDSs", "start_codon", "stop_codon"]
+GENE_FEATURES = {"gene", "pseudogene"}
+# RefSeq gene_biotype -> the gene types we use (anything else is kept as it is)
+GENE_TYPES = {"protein_coding": "protein-coding", "lncRNA": "ncRNA", "ncRNA": "ncRNA",
+              "transcribed_pseudogene": "pseudogene", "pseudogene": "pseudogene"}
+
+def open_text(path: str):
+    """Open a (maybe gzipped) text file for reading"""
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return(gzip.open(path, "rt", encoding="utf-8") if gzipped else open(path, "r", encoding="utf-8"))
+
+def parse_attributes(column: str):
+    """Parse the 9th column of a GFF3 line (key=value;key=value, with %-escapes)"""
+    attributes = {}
+    for pair in column.strip().split(";"):
+        if "=" in pair:
+            key, value = pair.split("=", 1)
+            attributes[key] = value
+    return(attributes)
+
+def parse_dbxrefs(value: str):
+    """Parse a Dbxref attribute (DB:ID,DB:ID, with %-escapes) into (DB, ID) pairs -- anything without a : is skipped"""
+    xrefs = [unquote(xref) for xref in value.split(",")]
+    return([tuple(xref.split(":", 1)) for xref in xrefs if ":" in xref])
+
+def tsv_value(value):
+    """A value as it's written to a TSV: the %-escapes we decoded can be tabs and newlines, and the shards are
+    read a line at a time (see transcript_index.py), so those become spaces -- quotes are handled by csv
+    """
+    return(str(value).replace("\r\n", " ").replace("\t", " ").replace("\r", " ").replace("\n", " "))
+
+def write_tsv(path: str, columns: list, rows):
+    """Write rows (dicts) to a TSV file (renamed into place when it's done)
+    If the file is already there with exactly the same contents it's left alone, so its modification time
+    (which the compiled annotations and the response cache look at) only changes when the data does
+    """
+    with open(f"{path}.tmp", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([tsv_value(row[column]) for column in columns])
+    if os.path.isfile(path) and filecmp.cmp(f"{path}.tmp", path, shallow=False):
+        os.remove(f"{path}.tmp")
+    else:
+        os.replace(f"{path}.tmp", path)
+
+#####################################
+# 1. Splitting the GFF3 by sequence #
+#####################################
+
+def split_gff(gff_path: str, split_dir: str):
+    """Split a GFF3 into one file per sequence ID, hashing each one's lines
+    Returns ({sequence ID: chromosome name, or None if it's not part of the primary assembly}, {sequence ID: hash})
+    """
+    os.makedirs(split_dir, exist_ok=True)
+    chromosomes, hashes, digests = {}, {}, {}
+    current_id, current_file = None, None
+    with open_text(gff_path) as gff:
+        for line in gff:
+            if line.startswith("#") or not line.strip():
+                continue
+            sequence_id, _, feature, _ = line.split("\t", 3)
+            if sequence_id != current_id:
+                if current_file is not None:
+                    current_file.close()
+                # Append, in case a sequence's lines aren't all together
+                current_id, current_file = sequence_id, open(f"{split_dir}/{sequence_id}.gff", "a", encoding="utf-8")
+                if sequence_id not in digests:
+                    digests[sequence_id] = hashlib.blake2b(digest_size=16)
+            if feature == "region" and sequence_id not in chromosomes:
+                attributes = parse_attributes(line.rsplit("\t", 1)[-1])
+                genome = attributes.get("genome")
+                primary = genome in PRIMARY_GENOMES and sequence_id.startswith("NC_")
+                chromosomes[sequence_id] = (PRIMARY_GENOMES[genome] or unquote(attributes.get("chromosome", sequence_id))) if primary else None
+            digests[sequence_id].update(line.encode("utf-8"))
+            current_file.write(line)
+    if current_file is not None:
+        current_file.close()
+    if not chromosomes: # No region lines, so every sequence is a chromosome
+        chromosomes = {sequence_id: sequence_id[3:] if sequence_id.lower().startswith("chr") else sequence_id
+                       for sequence_id in digests}
+    for sequence_id in digests:
+        chromosomes.setdefault(sequence_id, None)
+        hashes[sequence_id] = digests[sequence_id].hexdigest()
+    return(chromosomes, hashes)
+
+#########################################
+# 2a. Parsing a chromosome (in workers) #
+#########################################
+
+def parse_chromosome(gff_path: str, chromosome: str):
+    """Parse one chromosome's GFF3 lines into gene rows and transcript rows (like genes.tsv and the shards)
+    Returns (gene rows, transcript rows, accessions that were duplicated on this chromosome)
+    """
+    genes, transcripts = {}, {} # GFF ID -> row (in file order)
+    with open(gff_path, encoding="utf-8") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 9:
+                continue
+            _, source, feature, start, end, _, strand, _, attribute_column = columns
+            attributes = parse_attributes(attribute_column)
+            start, end = int(start), int(end)
+            feature_id, parent = attributes.get("ID"), attributes.get("Parent", "").split(",")[0]
+            if feature in GENE_FEATURES:
+                dbxrefs = dict(parse_dbxrefs(attributes.get("Dbxref", "")))
+                biotype = attributes.get("gene_biotype", feature)
+                genes[feature_id] = {
+                    "ncbi_gene_id": dbxrefs.get("GeneID", ""),
+                    "symbol": unquote(attributes.get("Name", attributes.get("gene", feature_id))),
+                    "name": unquote(attributes.get("description", "")),
+                    "type": GENE_TYPES.get(biotype, biotype),
+                    "locus": (chromosome, "minus" if strand == "-" else "plus", start, end),
+                    "transcripts": [],
+                }
+            elif "transcript_id" in attributes and parent in genes:
+                transcripts[feature_id] = {
+                    "gene": genes[parent]["symbol"],
+                    "gene_id": parent,
+                    "transcript": attributes["transcript_id"],
+                    "transcript_biotype": feature,
+                    "product": unquote(attributes.get("product", "")),
+                    "source": source,
+                    "xref": ",".join(f"{db}:{id}" for db, id in parse_dbxrefs(attributes.get("Dbxref", ""))),
+                    "transcript_bounds": (start, end),
+                    "exons": [],
+                    "CDSs": [],
+                    "strand": strand,
+                }
+            elif feature in ("exon", "CDS") and parent in transcripts:
+                transcripts[parent]["exons" if feature == "exon" else "CDSs"].append((start, end))
+
+    gene_rows, transcript_rows, duplicates, seen = [], [], [], set()
+    for transcript in transcripts.values():
+        if transcript["transcript"] in seen:
+            duplicates.append(transcript["transcript"])
+            continue
+        seen.add(transcript["transcript"])
+        transcript["exons"], transcript["CDSs"] = sorted(set(transcript["exons"])), sorted(set(transcript["CDSs"]))
+        transcript["start_codon"], transcript["stop_codon"] = codon_bounds(transcript["CDSs"], transcript["strand"])
+        genes[transcript["gene_id"]]["transcripts"].append(transcript["transcript"])
+        transcript_rows.append(transcript)
+    for gene in genes.values():
+        gene_rows.append(dict(gene, locus=str(gene["locus"]), transcripts=str(gene["transcripts"])))
+    for transcript in transcript_rows:
+        for column in ("transcript_bounds", "exons", "CDSs"):
+            transcript[column] = str(transcript[column])
+    return(gene_rows, transcript_rows, duplicates)
+
+def codon_bounds(CDSs: list, strand: str):
+    """The (start, end) of the start and stop codons (blank if there's no CDS or a codon is split between exons)"""
+    if not CDSs:
+        return("", "")
+    first, last = (CDSs[0][0], CDSs[0][0] + 2), (CDSs[-1][1] - 2, CDSs[-1][1])
+    if first[1] > CDSs[0][1] or last[0] < CDSs[-1][0]:
+        return("", "")
+    return((str(last), str(first)) if strand == "-" else (str(first), str(last)))
+
+def ingest_chromosome(task: dict):
+    """Parse one chromosome and write its transcript shard and gene rows (this runs in the worker processes)"""
+    gene_rows, transcript_rows, duplicates = parse_chromosome(task["gff_path"], task["chromosome"])
+    write_tsv(task["shard_path"], TRANSCRIPT_COLUMNS, transcript_rows)
+    write_tsv(task["genes_path"], GENES_COLUMNS, gene_rows)
+    return((task["chromosome"], len(gene_rows), len(transcript_rows), duplicates))
+
+###########################################
+# 2b. Streaming the FASTA into sequences/ #
+###########################################
+
+def write_sequences(fasta_path: str, chromosomes: dict, sequences_dir: str, previous_hashes: dict):
+    """Stream a FASTA into sequences/chr*.txt (one line of bases per chromosome), only keeping the chromosomes
+    (sequence ID -> name) we want. A chromosome is only replaced if its sequence changed
+    Returns ({chromosome name: sequence hash}, [names of the chromosomes that were replaced])
+    """
+    os.makedirs(sequences_dir, exist_ok=True)
+    hashes, changed = {}, []
+    name, out, digest = None, None, None
+
+    def finish():
+        if out is None:
+            return
+        out.close()
+        hashes[name] = digest.hexdigest()
+        path = f"{sequences_dir}/chr{name}.txt"
+        if hashes[name] == previous_hashes.get(name) and os.path.isfile(path):
+            os.remove(f"{path}.tmp")
+            return
+        os.replace(f"{path}.tmp", path)
+        changed.append(name)
+        # A 2-bit file would be read instead of the new sequence, so it has to go (pack it again afterwards)
+        if os.path.isfile(f"{sequences_dir}/chr{name}.2bit"):
+            os.remove(f"{sequences_dir}/chr{name}.2bit")
+
+    with open_text(fasta_path) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                finish()
+                sequence_id = line[1:].split(None, 1)[0]
+                name = chromosomes.get(sequence_id)
+                out, digest = None, None
+                if name is not None:
+                    out = open(f"{sequences_dir}/chr{name}.txt.tmp", "w", encoding="ascii")
+                    digest = hashlib.blake2b(digest_size=16)
+            elif out is not None:
+                bases = line.strip()
+                out.write(bases)
+                digest.update(bases.encode("ascii"))
+        finish()
+    return(hashes, changed)
+
+########################################
+# 3. Merging everything into genes.tsv #
+########################################
+
+def merge_genes(chromosome_order: list, genes_dir: str, shard_names: dict):
+    """Merge the gene rows of every chromosome (in order), dropping genes and accessions we've already seen
+    Returns (gene rows, index rows, what was dropped)
+    """
+    gene_rows, index_rows, symbols, accessions = [], [], set(), set()
+    dropped = {"duplicate_symbols": [], "duplicate_accessions": []}
+    for chromosome in chromosome_order:
+        for gene in load_tsv_data(f"{genes_dir}/genes_{chromosome}.tsv"):
+            if gene["symbol"] in symbols:
+                dropped["duplicate_symbols"].append(f"{gene['symbol']} (chr{chromosome})")
+                continue
+            symbols.add(gene["symbol"])
+            kept = []
+            for accession in eval_list(gene["transcripts"]):
+                if accession in accessions:
+                    dropped["duplicate_accessions"].append(f"{accession} (chr{chromosome})")
+                else:
+                    accessions.add(accession)
+                    kept.append(accession)
+            gene_rows.append(dict(gene, transcripts=str(kept)))
+            index_rows.append({"gene_symbol": gene["symbol"], "file_index": shard_names[chromosome]})
+    return(gene_rows, index_rows, dropped)
+
+def eval_list(text: str):
+    """Parse a list of accessions written by str() (like "['NM_1.1', 'NM_2.1']")"""
+    return(ast.literal_eval(text) if text else [])
+
+def ingest_genome(genome_dir: str, gff_path: str, fasta_path: str, processes: int = None, force: bool = False):
+    """Build (or update) a genome directory from a GFF3 and a FASTA file
+    Only chromosomes whose annotations or sequences changed since the last run are rebuilt, unless force is set
+    Returns the report (what was rebuilt and what was skipped), which is also saved in .ingest/report.json
+    """
+    work_dir = f"{genome_dir}/.ingest"
+    split_dir = f"{work_dir}/gff"
+    transcripts_dir = f"{genome_dir}/transcripts"
+    os.makedirs(transcripts_dir, exist_ok=True)
+    shutil.rmtree(split_dir, ignore_errors=True)
+    manifest_path = f"{work_dir}/manifest.json"
+    manifest = {}
+    if os.path.isfile(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if manifest.get("version") != INGEST_VERSION:
+        manifest = {"version": INGEST_VERSION, "annotations": {}, "sequences": {}, "duplicates": {}}
+
+    print("Splitting the GFF3 by sequence...")
+    sequence_chromosomes, gff_hashes = split_gff(gff_path, split_dir)
+    primary = {sequence_id: name for sequence_id, name in sequence_chromosomes.items() if name is not None}
+    chromosome_order = sorted(set(primary.values()), key=chromosome_sort_key)
+    shard_names = {chromosome: f"file_{chromosome}" for chromosome in chromosome_order}
+    skipped_sequences = sorted(sequence_id for sequence_id, name in sequence_chromosomes.items() if name is None)
+
+    tasks = []
+    for sequence_id, chromosome in primary.items():
+        task = {"chromosome": chromosome, "gff_path": f"{split_dir}/{sequence_id}.gff",
+                "shard_path": f"{transcripts_dir}/{shard_names[chromosome]}.tsv", "genes_path": f"{work_dir}/genes_{chromosome}.tsv"}
+        unchanged = manifest["annotations"].get(chromosome) == gff_hashes[sequence_id]
+        if not (unchanged and os.path.isfile(task["shard_path"]) and os.path.isfile(task["genes_path"])):
+            tasks.append(task)
+    print(f"Rebuilding the annotations of {len(tasks)} of {len(primary)} chromosomes "
+          f"(skipping {len(skipped_sequences)} alt/patch/unplaced sequences)")
+
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    with context.Pool(processes or os.cpu_count()) as pool:
+        # The workers parse annotations while this process streams the FASTA
+        results = pool.map_async(ingest_chromosome, sorted(tasks, key=lambda task: -os.path.getsize(task["gff_path"])))
+        print("Writing sequences...")
+        sequence_hashes, changed_sequences = write_sequences(fasta_path, primary, f"{genome_dir}/sequences", manifest["sequences"])
+        for chromosome, n_genes, n_transcripts, chromosome_duplicates in results.get():
+            print(f"    chr{chromosome}: {n_genes} genes, {n_transcripts} transcripts")
+            manifest["duplicates"][chromosome] = chromosome_duplicates
+
+    gene_rows, index_rows, dropped = merge_genes(chromosome_order, work_dir, shard_names)
+    write_tsv(f"{genome_dir}/genes.tsv", GENES_COLUMNS, gene_rows)
+    write_tsv(f"{transcripts_dir}/index.tsv", ["gene_symbol", "file_index"], index_rows)
+    # Shards of chromosomes that aren't in the annotations anymore
+    for filename in os.listdir(transcripts_dir):
+        if filename.startswith("file_") and filename.endswith(".tsv") and filename[:-len(".tsv")] not in shard_names.values():
+            os.remove(f"{transcripts_dir}/{filename}")
+
+    manifest["annotations"] = {chromosome: gff_hashes[sequence_id] for sequence_id, chromosome in primary.items()}
+    manifest["sequences"] = sequence_hashes
+    manifest["duplicates"] = {chromosome: manifest["duplicates"].get(chromosome, []) for chromosome in chromosome_order}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(split_dir, ignore_errors=True)
+
+    report = {
+        "chromosomes": chromosome_order,
+        "rebuilt_annotations": sorted((task["chromosome"] for task in tasks), key=chromosome_sort_key),
+        "rebuilt_sequences": sorted(changed_sequences, key=chromosome_sort_key),
+        "genes": len(gene_rows),
+        "skipped_sequences": skipped_sequences,
+        "missing_sequences": [chromosome for chromosome in chromosome_order if chromosome not in sequence_hashes],
+        "duplicate_accessions": [f"{accession} (chr{chromosome})" for chromosome, accessions in manifest["duplicates"].items()
+                                 for accession in accessions] + dropped["duplicate_accessions"],
+        "duplicate_symbols": dropped["duplicate_symbols"],
+    }
+    with open(f"{work_dir}/report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return(report)
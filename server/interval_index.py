@@ -0,0 +1,124 @@
+"""
+Interval index for finding the genes, transcripts and exons that overlap a region of a chromosome (used by /api/region)
+Each chromosome's intervals are kept in sorted arrays (start, end, value) and searched with bisect:
+    - Everything that overlaps [start, end] starts at or before end, and no earlier than start - (the longest interval),
+      so two binary searches give a window of candidates and we only have to check their ends
+    - One huge interval (like DMD, 2.2 Mb) would make that window huge for every query, so intervals are split into
+      tiers by length (1-3 bp, 4-15 bp, 16-63 bp, ...), each with its own longest length. In a tier, everything in the
+      window is at least a quarter as long as the longest interval, so few of them can end before the region starts
+So a query is a couple of binary searches per tier plus about the number of results, even for a whole chromosome
+Values are ints (positions in whatever list the caller keeps), so the index is a handful of compact arrays
+
+RegionIndex puts three of these together for a genome: genes, transcripts and exons
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+
+class IntervalTier():
+    __slots__ = ("starts", "ends", "values", "max_length")
+
+    def __init__(self, intervals: list):
+        """Index a list of (start, end, value) intervals (1-based, inclusive coordinates)"""
+        intervals.sort()
+        self.starts = array("i", (start for start, _, _ in intervals))
+        self.ends = array("i", (end for _, end, _ in intervals))
+        self.values = array("I", (value for _, _, value in intervals))
+        self.max_length = max((end - start + 1 for start, end, _ in intervals), default=0)
+
+    def overlapping(self, start: int, end: int):
+        """Yield the (start, end, value) of every interval that overlaps [start, end], sorted by start"""
+        i = bisect_left(self.starts, start - self.max_length + 1)
+        last = bisect_right(self.starts, end)
+        starts, ends, values = self.starts, self.ends, self.values
+        for j in range(i, last):
+            if ends[j] >= start:
+                yield (starts[j], ends[j], values[j])
+
+class IntervalIndex():
+    def __init__(self, intervals):
+        """Build the index from (chromosome, start, end, value) tuples (in any order)"""
+        tiers = {} # Chromosome -> tier number -> intervals
+        for chromosome, start, end, value in intervals:
+            start, end = int(start), int(end)
+            if end < start:
+                start, end = end, start
+            tier = ((end - start + 1).bit_length() - 1) // 2 # Lengths 4^tier to 4^(tier + 1) - 1
+            tiers.setdefault(chromosome, {}).setdefault(tier, []).append((start, end, value))
+        self.tiers = {chromosome: [IntervalTier(by_tier[tier]) for tier in sorted(by_tier)]
+                      for chromosome, by_tier in tiers.items()}
+
+    @property
+    def chromosomes(self):
+        return(list(self.tiers))
+
+    def __len__(self):
+        return(sum(len(tier.starts) for tiers in self.tiers.values() for tier in tiers))
+
+    def overlapping(self, chromosome: str, start: int, end: int):
+        """Yield the (start, end, value) of every interval on a chromosome that overlaps [start, end] (1-based, inclusive)
+        They come out sorted by start (then end)
+        """
+        return(merge(*[tier.overlapping(start, end) for tier in self.tiers.get(chromosome, [])]))
+
+class RegionIndex():
+    def __init__(self, genes, transcripts):
+        """Index a genome's genes (Gene objects) and transcripts (Transcript objects, with their exons)
+        Only what /api/region sends back is kept, so we don't hold on to every Transcript object
+        """
+        self.genes = list(genes)
+        gene_positions = {gene.symbol: i for i, gene in enumerate(self.genes)}
+        self.genes_index = IntervalIndex((gene.locus[0], gene.locus[2], gene.locus[3], i) for i, gene in enumerate(self.genes))
+
+        self.transcripts = [] # (gene position, accession, biotype) of each transcript
+        self.exon_transcripts = array("I") # Which transcript each exon belongs to
+        self.exon_numbers = array("H") # Exon numbers count from the 5' end (so backwards on the minus strand)
+        biotypes = {} # So every transcript with the same biotype shares one string
+        transcript_intervals, exon_intervals = [], []
+        for transcript in transcripts:
+            chromosome, orientation = transcript.locus[0], transcript.locus[1]
+            i = len(self.transcripts)
+            self.transcripts.append((gene_positions[transcript.gene.symbol], transcript.ncbi_accession,
+                                     biotypes.setdefault(transcript.biotype, transcript.biotype)))
+            transcript_intervals.append((chromosome, transcript.bounds[0], transcript.bounds[1], i))
+            exons = sorted(transcript.exons)
+            for number, (start, end) in enumerate(exons, start=1):
+                if orientation == "minus":
+                    number = len(exons) - number + 1
+                exon_intervals.append((chromosome, start, end, len(self.exon_numbers)))
+                self.exon_transcripts.append(i)
+                self.exon_numbers.append(number)
+        self.transcripts_index = IntervalIndex(transcript_intervals)
+        self.exons_index = IntervalIndex(exon_intervals)
+
+    @property
+    def chromosomes(self):
+        return(self.genes_index.chromosomes)
+
+    def genes_in(self, chromosome: str, start: int, end: int):
+        """Get (summaries of) the genes that overlap a region, sorted by start"""
+        genes = []
+        for _, _, i in self.genes_index.overlapping(chromosome, start, end):
+            gene = self.genes[i]
+            genes.append({"symbol": gene.symbol, "ncbi_gene_id": gene.ncbi_gene_id, "name": gene.name,
+                          "type": gene.type, "locus": gene.locus})
+        return(genes)
+
+    def transcripts_in(self, chromosome: str, start: int, end: int):
+        """Get (summaries of) the transcripts that overlap a region, sorted by start"""
+        transcripts = []
+        for transcript_start, transcript_end, i in self.transcripts_index.overlapping(chromosome, start, end):
+            gene_position, accession, biotype = self.transcripts[i]
+            gene = self.genes[gene_position]
+            transcripts.append({"ncbi_accession": accession, "gene_symbol": gene.symbol, "biotype": biotype,
+                                "strand": gene.locus[1], "bounds": [transcript_start, transcript_end]})
+        return(transcripts)
+
+    def exons_in(self, chromosome: str, start: int, end: int):
+        """Get the exons (of every transcript) that overlap a region, sorted by start"""
+        exons = []
+        for exon_start, exon_end, i in self.exons_index.overlapping(chromosome, start, end):
+            gene_position, accession, _ = self.transcripts[self.exon_transcripts[i]]
+            exons.append({"ncbi_accession": accession, "gene_symbol": self.genes[gene_position].symbol,
+                          "number": self.exon_numbers[i], "bounds": [exon_start, exon_end]})
+        return(exons)
@@ -0,0 +1,207 @@
+"""
+k-mer index over every transcript's spliced exonic sequence, and a peptide index over every protein,
+for finding which transcripts contain a primer, motif or peptide (used by /api/sequence_search)
+
+Build it (after compile-annotation/pack-sequences if you use them -- it reads the sequences through the models) with:
+    python -m server.cli build-kmer-index hg38
+
+Each index has the sequences joined end to end (with a newline between them, so a match can't run from one
+into the next), and the positions of every step-th k-mer of each sequence, grouped by k-mer:
+    - buckets[code] to buckets[code + 1] is where k-mer number code's positions are in postings (a counting sort)
+    - A query at least k + step - 1 long has a sampled k-mer in its first step positions, wherever it is, so we look up
+      those k-mers (seeds), line each position up with the start of the query and compare the whole query (verify)
+    - Shorter queries (or ones with letters that aren't in the alphabet, like N or X) are found by scanning all the sequences
+Everything is in one file of flat arrays (written like annotation.bin) that we memory-map, so opening it doesn't parse anything
+Nucleotide queries find the reverse complement too (since a primer can bind either strand)
+"""
+from server.annotation_store import open_sections, write_sections, data_fingerprint
+from server.dna_tools import reverse_complement
+from array import array
+from bisect import bisect_right
+import os, re, sys
+
+MAGIC = b"EGDBKMER"
+FORMAT_VERSION = 1
+FILENAME = "kmers.bin"
+SEPARATOR = b"\n"
+
+# The alphabet of each index, k, and how often k-mers are sampled (every step-th position of a sequence)
+# Queries of at least k + step - 1 letters use the index (18 bases or 5 amino acids), anything shorter is a scan
+INDEX_KINDS = {
+    "nucleotide": {"alphabet": "ACGT", "k": 11, "step": 8},
+    "peptide": {"alphabet": "ACDEFGHIKLMNPQRSTVWY", "k": 4, "step": 2},
+}
+DIGITS = "0123456789abcdefghij" # A k-mer is a number in base len(alphabet), and int() can read it in these digits
+
+SECTIONS = {"accessions": "B"}
+for kind in INDEX_KINDS:
+    SECTIONS.update({f"{kind}_sequence": "B", f"{kind}_record_starts": "Q", f"{kind}_record_transcripts": "I",
+                     f"{kind}_buckets": "I", f"{kind}_postings": "I"})
+
+DIGIT_TABLES = {kind: str.maketrans(settings["alphabet"], DIGITS[:len(settings["alphabet"])])
+                for kind, settings in INDEX_KINDS.items()}
+
+def encode_kmer(kmer: str, kind: str):
+    """Get the number of a k-mer (all of its letters have to be in the alphabet)"""
+    return(int(kmer.translate(DIGIT_TABLES[kind]), len(INDEX_KINDS[kind]["alphabet"])))
+
+def kmer_codes(sequence: str, kind: str, offset: int = 0):
+    """Yield (position + offset, code) for every step-th k-mer of a sequence that's all in the alphabet"""
+    settings = INDEX_KINDS[kind]
+    alphabet, k, step = settings["alphabet"], settings["k"], settings["step"]
+    for run in re.finditer(f"[{alphabet}]{{{k},}}", sequence):
+        digits = run.group().translate(DIGIT_TABLES[kind])
+        first = -(-run.start() // step) * step # The first sampled position in the run
+        for i in range(first - run.start(), len(digits) - k + 1, step):
+            yield (run.start() + i + offset, int(digits[i:i+k], len(alphabet)))
+
+def normalize_query(query: str, kind: str):
+    """Uppercase a query (and turn U into T for nucleotides), raising ValueError if it has anything but letters (and * for stops)
+    Nucleotide queries can only be A, C, G, T and N, since anything else (IUPAC codes, or a peptide without
+    type=peptide) can't be reverse complemented
+    """
+    query = query.strip().upper()
+    if kind == "nucleotide":
+        query = query.replace("U", "T")
+        if not re.fullmatch(r"[ACGTN]+", query):
+            raise ValueError("Nucleotide queries can only have A, C, G, T (or U) and N (add type=peptide to search the proteins)")
+    if not re.fullmatch(r"[A-Z*]+", query):
+        raise ValueError("Queries can only have letters" + (" (and * for stop codons)" if kind == "peptide" else ""))
+    return(query)
+
+def build_kmer_index(genome, out_path: str = None):
+    """Build the k-mer and peptide indexes of a Genome object (see models.py) and write them to one file
+    Returns a dictionary with the path and how many sequences went into each index
+    """
+    out_path = out_path or f"{genome.dir}/{FILENAME}"
+    arrays = {name: array(typecode) for name, typecode in SECTIONS.items()}
+    accessions, sequences, skipped = [], {kind: bytearray() for kind in INDEX_KINDS}, []
+    for transcript in genome.iter_transcripts():
+        for kind, field in (("nucleotide", "exonic_sequence"), ("peptide", "amino_acid_sequence")):
+            try:
+                sequence = getattr(transcript, field)
+            except (KeyError, ValueError): # Bases or codons we can't handle (e.g. IUPAC codes, partial CDSs)
+                skipped.append(f"{transcript.ncbi_accession} ({kind})")
+                continue
+            if sequence is None:
+                continue
+            if kind == "nucleotide":
+                sequence = sequence.upper().replace("U", "T")
+            arrays[f"{kind}_record_starts"].append(len(sequences[kind]))
+            arrays[f"{kind}_record_transcripts"].append(len(accessions))
+            sequences[kind] += sequence.encode("ascii") + SEPARATOR
+        accessions.append(transcript.ncbi_accession)
+    arrays["accessions"].frombytes("\n".join(accessions).encode("utf-8"))
+
+    for kind, settings in INDEX_KINDS.items():
+        sequence = sequences[kind]
+        if len(sequence) >= 2**32:
+            raise ValueError(f"The {kind} sequences are too long to index ({len(sequence)} letters)")
+        arrays[f"{kind}_record_starts"].append(len(sequence))
+        arrays[f"{kind}_sequence"].frombytes(sequence)
+        # Counting sort: count each k-mer, add the counts up into bucket offsets, then put each position in its bucket
+        positions, codes = array("I"), array("I")
+        text = sequence.decode("ascii")
+        starts = arrays[f"{kind}_record_starts"]
+        for r in range(len(starts) - 1):
+            for position, code in kmer_codes(text[starts[r]:starts[r+1] - 1], kind, offset=starts[r]):
+                positions.append(position)
+                codes.append(code)
+        buckets = array("I", bytes(4 * (len(settings["alphabet"]) ** settings["k"] + 1)))
+        for code in codes:
+            buckets[code + 1] += 1
+        for code in range(1, len(buckets)):
+            buckets[code] += buckets[code - 1]
+        cursors = array("I", buckets[:-1])
+        postings = array("I", bytes(4 * len(positions)))
+        for position, code in zip(positions, codes):
+            postings[cursors[code]] = position
+            cursors[code] += 1
+        arrays[f"{kind}_buckets"] = buckets
+        arrays[f"{kind}_postings"] = postings
+
+    genome_dir = genome.dir
+    write_sections(out_path, arrays, {
+        "genome": os.path.basename(os.path.normpath(genome_dir)),
+        "fingerprint": data_fingerprint(genome_dir),
+        "byteorder": sys.byteorder,
+        "kinds": INDEX_KINDS,
+    }, magic=MAGIC, version=FORMAT_VERSION)
+    return({"path": out_path, "transcripts": len(accessions), "skipped": skipped,
+            **{kind: len(arrays[f"{kind}_record_starts"]) - 1 for kind in INDEX_KINDS}})
+
+class KmerIndex():
+    def __init__(self, path: str, expected_fingerprint: str = None):
+        """Memory-map a k-mer index file (raises ValueError if it's the wrong version or stale)"""
+        self.path = path
+        self.mmap, self.header, self.arrays = open_sections(path, SECTIONS, "k-mer index", expected_fingerprint,
+                                                            magic=MAGIC, version=FORMAT_VERSION)
+        if self.header["kinds"] != INDEX_KINDS:
+            raise ValueError(f"{path} was built with different settings (rebuild it)")
+        self.accessions = bytes(self.arrays["accessions"]).decode("utf-8").split("\n")
+
+    def search(self, query: str, kind: str, max_hits: int = 1000, reverse_complement_too: bool = True):
+        """Find every exact match of a query in the transcripts (nucleotide) or proteins (peptide)
+        Returns (hits, method, truncated): hits are (accession, strand, start, end) sorted by accession and position,
+        with 1-based inclusive positions in the exonic/protein sequence. Nucleotide hits on the - strand are where the
+        reverse complement of the query is. method is "index" or "scan" (for short queries), and truncated is True if
+        there were more than max_hits hits
+        """
+        query = normalize_query(query, kind)
+        queries = [("+", query)]
+        if kind == "nucleotide" and reverse_complement_too:
+            complement = reverse_complement(query)
+            if complement != query:
+                queries.append(("-", complement))
+        settings = INDEX_KINDS[kind]
+        indexed = len(query) >= settings["k"] + settings["step"] - 1 and set(query) <= set(settings["alphabet"])
+
+        positions = []
+        for strand, text in queries:
+            found = self._seed_and_verify(text, kind) if indexed else self._scan(text, kind, max_hits + 1)
+            positions += [(position, strand) for position in found]
+        truncated = len(positions) > max_hits
+
+        starts, transcripts = self.arrays[f"{kind}_record_starts"], self.arrays[f"{kind}_record_transcripts"]
+        hits = []
+        for position, strand in sorted(positions)[:max_hits]:
+            r = bisect_right(starts, position) - 1
+            start = position - starts[r] + 1
+            hits.append((self.accessions[transcripts[r]], strand, start, start + len(query) - 1))
+        return((hits, "index" if indexed else "scan", truncated))
+
+    def _seed_and_verify(self, query: str, kind: str):
+        """Get the positions (in the joined sequences) where the query is, using its first step k-mers as seeds"""
+        settings = INDEX_KINDS[kind]
+        sequence, buckets, postings = self.arrays[f"{kind}_sequence"], self.arrays[f"{kind}_buckets"], self.arrays[f"{kind}_postings"]
+        encoded, k, found = query.encode("ascii"), settings["k"], set()
+        # Exactly one of the query's first step positions is a sampled position, wherever the query is
+        for j in range(settings["step"]):
+            code = encode_kmer(query[j:j+k], kind)
+            for p in postings[buckets[code]:buckets[code + 1]]:
+                start = p - j
+                if start >= 0 and sequence[start:start + len(encoded)] == encoded:
+                    found.add(start)
+        return(sorted(found))
+
+    def _scan(self, query: str, kind: str, max_hits: int):
+        """Get the positions where the query is by searching all the sequences (for queries too short for the index)"""
+        offset, count = self.header["sections"][f"{kind}_sequence"]
+        encoded, found = query.encode("ascii"), []
+        i = self.mmap.find(encoded, offset, offset + count)
+        while i != -1 and len(found) < max_hits:
+            found.append(i - offset)
+            i = self.mmap.find(encoded, i + 1, offset + count)
+        return(found)
+
+    @classmethod
+    def open(cls, genome_dir: str):
+        """Open the k-mer index of a genome if there's a fresh one (otherwise None)"""
+        path = f"{genome_dir}/{FILENAME}"
+        if not os.path.isfile(path):
+            return(None)
+        try:
+            return(cls(path, expected_fingerprint=data_fingerprint(genome_dir)))
+        except ValueError as e:
+            print(f"Not using the k-mer index: {e} ⚠️")
+            return(None)
@@ -0,0 +1,202 @@
+"""
+Lightweight request instrumentation (turned on with METRICS_ENABLED=true in .env)
+    - @timed("name") times a function, and count("name", n) adds to a counter
+    - Each response gets a Server-Timing header with where the time went (TSV parsing, sequence reads,
+      reverse complementing, template rendering, ...) -- the browser dev tools show it next to the request
+    - /metrics has histograms (request latency, sequence bytes read per request, timers) and counters
+      (like response cache hits) in the Prometheus text format
+    - Requests slower than SLOW_REQUEST_MS are written to the error log with their breakdown
+When it's off, a timed function costs one extra call and an if, and nothing is recorded
+Every gunicorn worker keeps its own numbers, so /metrics shows the worker that answered
+Streamed responses (like /api/fasta) are timed up to when they start streaming
+Flask is only imported by the parts that deal with requests, so @timed (in dna_tools.py, helper.py, ...)
+doesn't pull it in for scripts and the CLI
+"""
+from functools import wraps
+from time import perf_counter
+import threading
+
+# Histogram buckets (upper bounds)
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+class Histogram():
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str):
+        """The Prometheus text lines for this histogram (buckets are cumulative)"""
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return(lines)
+
+class Metrics():
+    def __init__(self):
+        self.enabled = False
+        self.slow_request_ms = None
+        self.lock = threading.Lock()
+        self.current = threading.local() # The timings of the request this thread is handling
+        self.histograms = {} # (metric name, labels) -> Histogram
+        self.counters = {} # (metric name, labels) -> value
+        self.gauges = {} # Metric name -> function that gets its value now (like memory use)
+
+    def init_app(self, app, enabled: bool = False, slow_request_ms: float = None):
+        """Turn instrumentation on for an app (if enabled) and add the /metrics endpoint"""
+        self.enabled = enabled
+        self.slow_request_ms = slow_request_ms
+        if not enabled:
+            return
+        from flask import before_render_template, template_rendered
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._start_template, app, weak=False)
+        template_rendered.connect(self._finish_template, app, weak=False)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    #############################
+    # Recording (from anywhere) #
+    #############################
+
+    def record(self, name: str, seconds: float):
+        """Add a timing to the current request's breakdown and to the name's histogram"""
+        timings = getattr(self.current, "timings", None)
+        if timings is not None:
+            timing = timings.setdefault(name, [0, 0]) # Seconds, calls
+            timing[0] += seconds
+            timing[1] += 1
+        self.observe("egdb_timer_seconds", f'name="{name}"', seconds, SECONDS_BUCKETS)
+
+    def observe(self, metric: str, labels: str, value, buckets: tuple):
+        with self.lock:
+            histogram = self.histograms.get((metric, labels))
+            if histogram is None:
+                histogram = self.histograms[(metric, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, metric: str, labels: str = "", amount=1):
+        with self.lock:
+            self.counters[(metric, labels)] = self.counters.get((metric, labels), 0) + amount
+
+    def add_gauge(self, metric: str, function):
+        """Add a gauge to /metrics (function is called each time /metrics is)"""
+        self.gauges[metric] = function
+
+    def add_bytes_read(self, amount: int):
+        """Count sequence bytes read (for the request and in total)"""
+        if hasattr(self.current, "bytes_read"):
+            self.current.bytes_read += amount
+        self.increment("egdb_sequence_bytes_read_total", "", amount)
+
+    ############
+    # Requests #
+    ############
+
+    def _start_request(self):
+        self.current.timings = {}
+        self.current.bytes_read = 0
+        self.current.start = perf_counter()
+
+    def _finish_request(self, response):
+        timings = getattr(self.current, "timings", None)
+        if timings is None:
+            return(response)
+        from flask import request
+        total = perf_counter() - self.current.start
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        self.observe("egdb_request_duration_seconds", f'endpoint="{endpoint}"', total, SECONDS_BUCKETS)
+        self.observe("egdb_request_sequence_bytes", f'endpoint="{endpoint}"', self.current.bytes_read, BYTES_BUCKETS)
+
+        entries = [f"total;dur={total * 1000:.2f}", f'bytes_read;desc="{self.current.bytes_read} sequence bytes"']
+        for name, (seconds, calls) in sorted(timings.items(), key=lambda item: -item[1][0]):
+            entries.append(f'{name};dur={seconds * 1000:.2f};desc="{calls} calls"')
+        response.headers["Server-Timing"] = ", ".join(entries)
+
+        if self.slow_request_ms is not None and total * 1000 > self.slow_request_ms:
+            from server.helper import log_error
+            log_error(f"Slow request ({total * 1000:.0f} ms): {request.method} {request.full_path}\n"
+                      + "\n".join(entries[1:]) + "\n")
+        return(response)
+
+    def _teardown_request(self, exception=None):
+        self.current.timings = None
+
+    def _start_template(self, sender, template, context, **extra):
+        self.current.template_start = perf_counter()
+
+    def _finish_template(self, sender, template, context, **extra):
+        start = getattr(self.current, "template_start", None)
+        if start is not None:
+            self.record(f"render_{(template.name or 'template').replace('.html', '')}", perf_counter() - start)
+            self.current.template_start = None
+
+    ############
+    # /metrics #
+    ############
+
+    def render(self):
+        """Everything we've recorded, in the Prometheus text format"""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines, typed = [], set()
+        for (metric, labels), histogram in histograms:
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            lines += histogram.lines(metric, labels)
+        for (metric, labels), value in counters:
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+        for metric, function in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {function()}")
+        return("\n".join(lines) + "\n")
+
+    def metrics_view(self):
+        from flask import Response
+        return(Response(self.render(), mimetype="text/plain; version=0.0.4"))
+
+metrics = Metrics()
+
+def timed(name: str):
+    """Decorator that times a function (when metrics are enabled)"""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return(function(*args, **kwargs))
+            start = perf_counter()
+            try:
+                return(function(*args, **kwargs))
+            finally:
+                metrics.record(name, perf_counter() - start)
+        return(wrapper)
+    return(decorate)
+
+def count(metric: str, labels: str = "", amount=1):
+    """Add to a counter (when metrics are enabled)"""
+    if metrics.enabled:
+        metrics.increment(metric, labels, amount)
+
+def count_bytes_read(amount: int):
+    """Count sequence bytes read from the chromosome files (when metrics are enabled)"""
+    if metrics.enabled:
+        metrics.add_bytes_read(amount)
@@ -1,84 +1,467 @@
-from server.helper import settings, load_tsv_data
-from server.dna_tools import reverse_complement, transcribe_pre_rna, splice_rna, translate_rna
+from server.helper import settings, load_tsv_data, estimate_size
+from server.dna_tools import DNA_VALID_TABLE, order_bounds, reverse_complement, transcribe_pre_rna, translate_rna, translate_chunks, format_fasta
+from server.annotation_store import AnnotationStore
+from server.transcript_index import TranscriptIndex
+from server.search_index import SearchIndex
+from server.interval_index import RegionIndex
+from server.coordinates import CoordinateMap
+from server.kmer_index import KmerIndex
+from server.derived_store import DerivedStore, DERIVED_FIELDS
+from server.sequence_store import SequencePool
+from server.metrics import timed, count, count_bytes_read
+from collections import OrderedDict
+import ast, gc, os, random, threading, time
+
+CHUNK_SIZE = 1 << 20 # Bases per chunk when streaming sequences (see Genome.iter_sequence)
 
 class Genome():
     def __init__(self, name: str):
         self.name = name
         self.dir = f"{settings.DATA_DIR}/{name}"
 
-        # Load in a table of genes for this genome from a TSV file
-        # There should be some error handling here eventually
-        genome_dir = f"{settings.DATA_DIR}/{name}"
-        self.genes_table = load_tsv_data(f"{genome_dir}/genes.tsv")
+        # Use the compiled annotations if they've been built (see annotation_store.py)
+        # Otherwise, load in the table of genes for this genome from a TSV file
+        # and index where each transcript is in the shards (see transcript_index.py)
+        self.annotation = AnnotationStore.open(self.dir)
+        self.transcript_index = None
+        if self.annotation is not None:
+            genes = (Gene(genome=self, store_index=i, **self.annotation.gene(i))
+                     for i in range(self.annotation.gene_count))
+        else:
+            self.transcript_index = TranscriptIndex(self.dir)
+            genes = (Gene.from_row(self, row) for row in load_tsv_data(f"{self.dir}/genes.tsv"))
+
+        # Build the Gene objects once and index them so lookups don't scan the whole table
+        # (if a symbol/ID/accession shows up more than once, the first gene in the table wins)
+        self.genes_by_symbol = {}
+        self.genes_by_id = {}
+        self.genes_by_transcript = {}
+        self.genes_by_type = {} # Lists of gene symbols by gene type (for /random)
+        for gene in genes:
+            if gene.symbol in self.genes_by_symbol:
+                continue
+            if self.transcript_index is not None: # Only keep the transcripts that we can actually find
+                gene.transcripts = self.transcript_index.gene_accessions(gene.symbol, gene.transcripts)
+            self.genes_by_symbol[gene.symbol] = gene
+            self.genes_by_id.setdefault(gene.ncbi_gene_id, gene)
+            for accession in gene.transcripts:
+                self.genes_by_transcript.setdefault(accession, gene)
+            self.genes_by_type.setdefault(gene.type, []).append(gene.symbol)
+
+        # Trigram index (and sorted symbols/accessions) for searching
+        self.search_index = SearchIndex(list(self.genes_by_symbol.values()))
+
+        # Chromosome sequences get memory-mapped the first time they're needed
+        self.sequences = SequencePool(f"{self.dir}/sequences")
+        # Precomputed spliced/coding/protein sequences, if they've been built (see derived_store.py)
+        self.derived = DerivedStore.open(self.dir)
+
+        # Interval index over the genes, transcripts and exons (it reads every transcript, so it's built on first use)
+        self.regions = None
+        self.kmers = None # The k-mer/peptide index (False if there isn't one, see kmer_index())
+        self.lock = threading.Lock()
 
     def get_gene_by_symbol(self, symbol):
         """Get a Gene object by its Gene Symbol"""
-        data = next((gene for gene in self.genes_table if gene["symbol"] == symbol), None)
-        if data is not None:
-            # This acts as a pointer to the Genome object!
-            data["genome"] = self 
-            return Gene(**data)
-        
+        return(self.genes_by_symbol.get(symbol))
+
+    def get_gene_by_id(self, ncbi_gene_id):
+        """Get a Gene object by its NCBI Gene ID"""
+        return(self.genes_by_id.get(str(ncbi_gene_id)))
+
+    def get_gene_by_transcript(self, accession):
+        """Get the Gene object that a transcript accession belongs to"""
+        return(self.genes_by_transcript.get(accession))
+
+    def random_gene(self, gene_types):
+        """Pick a random Gene (uniformly) out of all the genes of the given types"""
+        symbol_lists = [self.genes_by_type.get(gene_type, []) for gene_type in gene_types]
+        # Pick an index into all the lists as if they were concatenated (so we don't copy them)
+        i = random.randrange(sum(len(symbols) for symbols in symbol_lists) or 1)
+        for symbols in symbol_lists:
+            if i < len(symbols):
+                return(self.genes_by_symbol[symbols[i]])
+            i -= len(symbols)
+        return(None)
+
+    def get_transcript(self, gene, accession):
+        """Get one of a gene's Transcript objects by its NCBI accession"""
+        if accession not in gene.transcripts:
+            return(None)
+        if self.annotation is not None:
+            for j in self.annotation.gene_transcripts(gene.store_index):
+                if self.annotation.transcript_accession(j) == accession:
+                    return(Transcript(genome=self, gene=gene, **self.annotation.transcript(j)))
+            return(None)
+        rows = self.transcript_index.read_rows([accession])
+        return(Transcript.from_row(self, gene, rows[0]) if rows else None)
+
+    def get_transcripts(self, gene):
+        """Get all of a gene's Transcript objects at once (one read for the whole gene)"""
+        if self.annotation is not None:
+            return([Transcript(genome=self, gene=gene, **self.annotation.transcript(j))
+                    for j in self.annotation.gene_transcripts(gene.store_index)])
+        return([Transcript.from_row(self, gene, row) for row in self.transcript_index.read_rows(gene.transcripts)])
+
+    def find_transcripts(self, queries):
+        """Look up lots of gene symbols and transcript accessions at once (a gene symbol means all of its transcripts)
+        Returns a list of (query, Transcript) pairs and a list of the queries that weren't found
+        Every row is read in one pass (one read per shard), instead of once per query
+        """
+        wanted = {} # Accession -> gene, in the order they were asked for
+        pairs, missing = [], []
+        for query in queries:
+            gene = self.get_gene_by_symbol(query)
+            accessions = gene.transcripts if gene is not None else [query]
+            if gene is None:
+                gene = self.get_gene_by_transcript(query)
+            if gene is None:
+                missing.append(query)
+                continue
+            for accession in accessions:
+                wanted.setdefault(accession, gene)
+                pairs.append((query, accession))
+
+        transcripts = {}
+        if self.annotation is not None:
+            for gene in {id(gene): gene for gene in wanted.values()}.values():
+                for j in self.annotation.gene_transcripts(gene.store_index):
+                    if self.annotation.transcript_accession(j) in wanted:
+                        transcript = Transcript(genome=self, gene=gene, **self.annotation.transcript(j))
+                        transcripts[transcript.ncbi_accession] = transcript
+        else:
+            for row in self.transcript_index.read_rows(list(wanted)):
+                transcripts[row["transcript"]] = Transcript.from_row(self, wanted[row["transcript"]], row)
+        return([(query, transcripts[accession]) for query, accession in pairs if accession in transcripts], missing)
+
+    def coalesce_sequence_reads(self, transcripts):
+        """Read the genomic sequence of lots of transcripts with as few reads as possible
+        Transcripts are grouped by chromosome and sorted, and overlapping (or touching) ones are merged into clusters,
+        so each stretch of the chromosome is only read once and every transcript's sequence is a slice of it
+        Yields the clusters (lists of transcripts) one at a time with the genomic sequence already in their caches,
+        and empties their caches again before reading the next one, so only one cluster's sequence is ever in memory
+        """
+        by_chromosome = {}
+        for transcript in transcripts:
+            by_chromosome.setdefault(transcript.locus[0], []).append(transcript)
+        for chromosome in sorted(by_chromosome):
+            for cluster, cluster_start, cluster_end in merge_regions(by_chromosome[chromosome]):
+                sequence = self.get_sequence_by_coord(chromosome, cluster_start, cluster_end)
+                for transcript in cluster:
+                    start, end = transcript.bounds[0] - cluster_start, transcript.bounds[1] - cluster_start + 1
+                    transcript._cached("genomic", lambda: sequence[start:end])
+                yield cluster
+                for transcript in cluster:
+                    transcript._cache = None
+
+    def iter_transcripts(self):
+        """Yield every transcript in the genome (each one once), reading a gene or a shard at a time"""
+        if self.annotation is not None:
+            for gene in self.genes_by_symbol.values():
+                yield from self.get_transcripts(gene)
+            return
+        by_shard = {}
+        for gene in self.genes_by_symbol.values():
+            by_shard.setdefault(self.transcript_index.file_indexes.get(gene.symbol), []).append(gene.symbol)
+        seen = set()
+        for symbols in by_shard.values():
+            pairs, _ = self.find_transcripts(symbols)
+            for _, transcript in pairs:
+                if transcript.ncbi_accession not in seen:
+                    seen.add(transcript.ncbi_accession)
+                    yield transcript
+
+    def region_index(self):
+        """Get the interval index over the genes, transcripts and exons (see interval_index.py), building it the first time"""
+        if self.regions is None:
+            with self.lock:
+                if self.regions is None:
+                    self.regions = RegionIndex(self.genes_by_symbol.values(), self.iter_transcripts())
+            genomes.resized(self)
+        return(self.regions)
+
+    def kmer_index(self):
+        """Get the k-mer/peptide index (see kmer_index.py) if it's been built, opening it the first time (None if not)"""
+        if self.kmers is None:
+            with self.lock:
+                if self.kmers is None:
+                    self.kmers = KmerIndex.open(self.dir) or False
+        return(self.kmers or None)
+
+    def memory_size(self):
+        """Roughly how many bytes of memory the genome's tables and indexes take up (not counting memory-mapped files)"""
+        seen = {id(self)}
+        size = estimate_size(self.genes_by_symbol, seen)
+        # The other tables point to the same genes (and their strings), which are only estimated from a sample,
+        # so mark them all as counted
+        for gene in self.genes_by_symbol.values():
+            seen.update((id(gene), id(gene.symbol), id(gene.ncbi_gene_id), id(gene.transcripts)))
+            seen.update(id(accession) for accession in gene.transcripts)
+        return(size + sum(estimate_size(part, seen) for part in (
+            self.genes_by_id, self.genes_by_transcript, self.genes_by_type,
+            self.search_index, self.transcript_index, self.regions)))
+
+    def mapped_size(self):
+        """How many bytes of files the genome has memory-mapped (shared between workers through the page cache)"""
+        mapped = [self.annotation, self.kmers or None, self.derived] + list(self.sequences.sequences.values())
+        return(sum(len(part.mmap) for part in mapped if part is not None))
+
+    def chromosome_length(self, chromosome: str):
+        """Get the length of a chromosome (None if we don't have its sequence)"""
+        try:
+            return(self.sequences.get(chromosome).length)
+        except ValueError:
+            return(None)
+
+    def warm_indexes(self):
+        """Build/open everything that's otherwise made on first use: the region index, the k-mer index and the chromosome files"""
+        for chromosome in self.region_index().chromosomes:
+            self.chromosome_length(chromosome) # Opens (memory-maps) it
+        self.kmer_index()
+
     def search_transcripts_index(self, gene_symbol):
         """Search the index file for a gene symbol and return the file index for its transcripts"""
-        index_file = load_tsv_data(f"{self.dir}/transcripts/index.tsv")
-        for row in index_file:
-            if row["gene_symbol"] == gene_symbol:
-                return(row["file_index"])
-        return(None)
+        if self.transcript_index is None:
+            return(None)
+        return(self.transcript_index.file_indexes.get(gene_symbol))
     
     def get_sequence_by_coord(self, chromosome:str, start_coord:int, end_coord:int):
-        """Get a sequence from the genome by reading specific bytes from the file"""
-        # Find the right file and the start and end bytes
-        chromosome_fname = f"{self.dir}/sequences/chr{chromosome}.txt"
-        # Each character is a byte in an ASCII-encoded file
-        start_bytes = start_coord - 1 # REMEMBER! 0-based indexing
-        end_bytes = end_coord
-        # Read the file
-        sequence = None
-        with open(chromosome_fname, "r") as f:
-            f.seek(start_bytes)
-            sequence = f.read(end_bytes - start_bytes)
-        if sequence is None:
-            raise ValueError(f"Sequence not found for {chromosome}:{start_coord}-{end_coord}")
+        """Get a sequence from the genome (1-based, inclusive coordinates)"""
+        # Sequences are memory-mapped and read from the ASCII or 2-bit files (see sequence_store.py)
+        return(str(self.get_sequence_bytes(chromosome, start_coord, end_coord), "ascii"))
+
+    @timed("sequence_read")
+    def get_sequence_bytes(self, chromosome:str, start_coord:int, end_coord:int):
+        """Get a sequence from the genome as bytes (zero-copy out of the mapped file when possible)"""
+        sequence = self.sequences.read_bytes(chromosome, start_coord - 1, end_coord) # REMEMBER! 0-based indexing
+        count_bytes_read(len(sequence))
         return(sequence)
+
+    @timed("sequence_read")
+    def get_sequences_by_coords(self, chromosome:str, regions:list):
+        """Get the sequences of many (start, end) regions of one chromosome at once (1-based, inclusive)"""
+        pieces = self.sequences.read_many(chromosome, [(int(start) - 1, int(end)) for start, end in regions])
+        count_bytes_read(sum(len(piece) for piece in pieces))
+        return([str(piece, "ascii") for piece in pieces])
+
+    def iter_sequence(self, chromosome:str, regions:list, minus:bool = False, chunk_size:int = CHUNK_SIZE):
+        """Yield the sequence of some (start, end) regions joined together, at most chunk_size bases at a time
+        On the minus strand the regions are read from the last base backwards and each chunk is reverse complemented,
+        so the chunks always come out 5' to 3' and nothing bigger than a chunk is ever in memory
+        """
+        regions = order_bounds(regions)
+        for start, end in (reversed(regions) if minus else regions):
+            start, end = int(start), int(end)
+            if minus:
+                for chunk_end in range(end, start - 1, -chunk_size):
+                    yield reverse_complement(self.get_sequence_by_coord(chromosome, max(chunk_end - chunk_size + 1, start), chunk_end))
+            else:
+                for chunk_start in range(start, end + 1, chunk_size):
+                    yield self.get_sequence_by_coord(chromosome, chunk_start, min(chunk_start + chunk_size - 1, end))
+
+    def invalid_base(self, chromosome:str, regions:list):
+        """Get the first base in some regions that can't be reverse complemented (like an IUPAC code), or None"""
+        for chunk in self.iter_sequence(chromosome, regions):
+            invalid = chunk.translate(DNA_VALID_TABLE)
+            if invalid:
+                return(invalid[0])
+        return(None)
     
     def search(self, query, max_results=50):
         """Search the genome for a gene symbol, gene name, or transcript accession"""
-        query = query.lower()
-        results = []
-        for gene in self.genes_table:
-            if query in gene["symbol"].lower() or query in gene["name"].lower():
-                if gene["type"] != "pseudogene":
-                    results.append(self.get_gene_by_symbol(gene["symbol"]))
-            if max_results > 0 and len(results) >= max_results:
-                break
-        return(results)
+        # Exact matches come first, then prefix matches, then substring matches (see search_index.py)
+        return(self.search_index.search(query, max_results))
+
+    def autocomplete(self, query, max_results=50):
+        """Like search() but faster for search-as-you-type (prefix matches are enough if there are plenty)"""
+        return(self.search_index.autocomplete(query, max_results))
 
     @classmethod
     def load(cls, name):
-        """Load a Genome object into memory"""
-        return(cls(name=name))
+        """Get a Genome object from the registry (it's only loaded into memory the first time)"""
+        return(genomes.get(name))
+
+def merge_regions(transcripts):
+    """Group transcripts (all on one chromosome) into clusters that overlap or touch, in order
+    Yields (transcripts, start, end) for each cluster
+    """
+    cluster = []
+    for transcript in sorted(transcripts, key=lambda transcript: transcript.bounds[0]):
+        if cluster and transcript.bounds[0] > cluster_end + 1:
+            yield (cluster, cluster[0].bounds[0], cluster_end)
+            cluster = []
+        cluster_end = max(cluster_end, transcript.bounds[1]) if cluster else transcript.bounds[1]
+        cluster.append(transcript)
+    if cluster:
+        yield (cluster, cluster[0].bounds[0], cluster_end)
+
+class GenomeRegistry():
+    """All the genomes loaded in this process, so we only parse the tables once per worker
+    Under gunicorn --preload, warm() runs in the master and the workers share it after fork
+    Genomes are loaded the first time they're asked for, and if their (estimated) sizes add up to more than
+    GENOME_MEMORY_MB, the least recently used ones are unloaded until they fit (they're loaded again if they're needed)
+    """
+    def __init__(self):
+        self.genomes = OrderedDict() # Least recently used first
+        self.stats = {} # Name -> hits, loads, evictions, size, ... (kept after a genome is unloaded)
+        self.lock = threading.Lock() # For the bookkeeping
+        self.load_lock = threading.Lock() # Only one genome loads at a time (without holding up the others)
+
+    @property
+    def budget_bytes(self):
+        """GENOME_MEMORY_MB in bytes (None for no limit)"""
+        return(int(settings.GENOME_MEMORY_MB * 2**20) if settings.GENOME_MEMORY_MB > 0 else None)
+
+    def available(self):
+        """List the names of the genomes in DATA_DIR (any directory with a genes.tsv)"""
+        if not os.path.isdir(settings.DATA_DIR):
+            return([])
+        return(sorted(name for name in os.listdir(settings.DATA_DIR)
+                      if os.path.isfile(f"{settings.DATA_DIR}/{name}/genes.tsv")))
+
+    def _hit(self, name):
+        """Get a genome if it's loaded (and count it as used)"""
+        with self.lock:
+            genome = self.genomes.get(name)
+            if genome is not None:
+                self.genomes.move_to_end(name)
+                self.stats[name]["hits"] += 1
+                self.stats[name]["last_used"] = time.time()
+            return(genome)
+
+    def get(self, name):
+        """Get a loaded Genome by name (or None if there's no such genome)"""
+        genome = self._hit(name)
+        if genome is not None:
+            return(genome)
+        # Only names we actually found in DATA_DIR get this far (so no funny paths)
+        if name not in self.available():
+            return(None)
+        with self.load_lock:
+            genome = self._hit(name)
+            if genome is not None: # Another thread loaded it while we waited
+                return(genome)
+            start = time.perf_counter()
+            genome = Genome(name)
+            size = genome.memory_size()
+            with self.lock:
+                self.genomes[name] = genome
+                stats = self.stats.setdefault(name, {"hits": 0, "loads": 0, "evictions": 0})
+                stats.update(loads=stats["loads"] + 1, size_bytes=size, load_seconds=round(time.perf_counter() - start, 3),
+                             last_used=time.time())
+            count("egdb_genome_loads_total", f'genome="{name}"')
+            self.enforce_budget(keep=name)
+            return(genome)
+
+    def resized(self, genome):
+        """Measure a loaded genome again (e.g. after it built another index) and unload others if it's over budget now"""
+        size = genome.memory_size()
+        with self.lock:
+            if self.genomes.get(genome.name) is not genome:
+                return
+            self.stats[genome.name]["size_bytes"] = size
+        self.enforce_budget(keep=genome.name)
+
+    def loaded_bytes(self):
+        return(sum(self.stats[name]["size_bytes"] for name in self.genomes))
+
+    def enforce_budget(self, keep: str = None):
+        """Unload the least recently used genomes (but not keep) until the loaded ones fit in the budget"""
+        if self.budget_bytes is None:
+            return
+        evicted = False
+        with self.lock:
+            for name in list(self.genomes):
+                if self.loaded_bytes() <= self.budget_bytes:
+                    break
+                if name == keep:
+                    continue
+                # Requests that are using it keep their reference, so it's only freed once they're done
+                del self.genomes[name]
+                self.stats[name]["evictions"] += 1
+                count("egdb_genome_evictions_total", f'genome="{name}"')
+                evicted = True
+            over_budget = self.loaded_bytes() > self.budget_bytes
+        if evicted:
+            gc.collect() # Genes and transcripts point back to their genome, so it's only freed by the cycle collector
+        if over_budget:
+            print(f"Genome {keep} doesn't fit in GENOME_MEMORY_MB on its own ({self.loaded_bytes() / 2**20:.0f} MB) ⚠️")
+
+    def status(self):
+        """What's loaded (and how big it is), for /api/status/genomes"""
+        with self.lock:
+            loaded = {name: genome.mapped_size() for name, genome in self.genomes.items()}
+            genomes = {}
+            for name in self.available():
+                stats = dict(self.stats.get(name, {"hits": 0, "loads": 0, "evictions": 0}), loaded=name in loaded)
+                if name in loaded:
+                    stats["mapped_bytes"] = loaded[name]
+                genomes[name] = stats
+            return({
+                "budget_bytes": self.budget_bytes,
+                "loaded_bytes": self.loaded_bytes(),
+                "loaded": list(self.genomes), # Least recently used first
+                "genomes": genomes,
+            })
+
+    def warm(self, indexes: bool = False):
+        """Load every available genome now instead of on the first request (until the budget is full)
+        With indexes, build their indexes too (see Genome.warm_indexes)
+        """
+        for name in self.available():
+            genome = self.get(name)
+            if indexes and genome is not None:
+                genome.warm_indexes()
+            if self.budget_bytes is not None and self.loaded_bytes() >= self.budget_bytes:
+                break
+        return(list(self.genomes))
+
+genomes = GenomeRegistry()
 
 class Gene():
-    def __init__(self, genome: str,
+    # There are a lot of these in memory (one per gene), so no __dict__
+    __slots__ = ("genome", "ncbi_gene_id", "symbol", "name", "type", "locus", "transcripts", "store_index")
+
+    def __init__(self, genome: Genome,
                  ncbi_gene_id: str, symbol: str, name: str, type: str,
-                 locus: tuple, transcripts: list):
+                 locus: tuple, transcripts: list, store_index: int = None):
         self.genome = genome
         self.ncbi_gene_id = ncbi_gene_id
         self.symbol = symbol
         self.name = name
         self.type = type
-        self.locus = eval(locus) # (chromosome, orientation, start, end)
-        self.transcripts = list(set(eval(transcripts))) # List of NCBI transcript accession numbers
-        self.nm_transcripts = [transcript for transcript in self.transcripts if transcript.startswith("NM_")]
-        self.nr_transcripts = [transcript for transcript in self.transcripts if transcript.startswith("NR_")]
-        self.xm_transcripts = [transcript for transcript in self.transcripts if transcript.startswith("XM_")]
-        self.xr_transcripts = [transcript for transcript in self.transcripts if transcript.startswith("XR_")]
+        self.locus = tuple(locus) # (chromosome, orientation, start, end)
+        self.transcripts = list(dict.fromkeys(transcripts)) # List of NCBI transcript accession numbers (no duplicates)
+        self.store_index = store_index # Row in the compiled annotations (if we're using them)
+
+    @classmethod
+    def from_row(cls, genome, row):
+        """Make a Gene from a row of genes.tsv (the locus and transcripts columns are Python literals)"""
+        return(cls(genome=genome, ncbi_gene_id=row["ncbi_gene_id"], symbol=row["symbol"],
+                   name=row["name"], type=row["type"],
+                   locus=ast.literal_eval(row["locus"]), transcripts=ast.literal_eval(row["transcripts"])))
+
+    @property
+    def nm_transcripts(self):
+        return([transcript for transcript in self.transcripts if transcript.startswith("NM_")])
+
+    @property
+    def nr_transcripts(self):
+        return([transcript for transcript in self.transcripts if transcript.startswith("NR_")])
+
+    @property
+    def xm_transcripts(self):
+        return([transcript for transcript in self.transcripts if transcript.startswith("XM_")])
+
+    @property
+    def xr_transcripts(self):
+        return([transcript for transcript in self.transcripts if transcript.startswith("XR_")])
 
     @property
     def summary_dict(self):
-        """Return a dictionary of the gene's summary information to pass to JavaScript"""
+        """Return a dictionary of the gene's summary information to pass to JavaScript
+        This is only metadata -- the sequence is loaded separately from /api/sequence (it can be megabases long)
+        """
         return({
             "genome_name": self.genome.name,
             "ncbi_gene_id": self.ncbi_gene_id,
@@ -86,47 +469,67 @@ class Gene():
             "name": self.name,
             "type": self.type,
             "locus": self.locus,
+            "length": self.length,
             "transcripts": self.transcripts,
-            "sequence": self.sequence
         })
     
     def get_transcripts_metadata(self):
         """Return a list of dictionaries with the names (and other metadata) of the transcripts"""
-        transcripts = set([self.get_transcript_by_accession(transcript) for transcript in self.transcripts])
-        transcripts_metadata = [transcript.metadata_dict() for transcript in transcripts if transcript is not None]
+        transcripts_metadata = [transcript.metadata_dict() for transcript in self.genome.get_transcripts(self)]
         return(transcripts_metadata)
     
     def get_transcript_by_accession(self, accession):
         """Get a specific Transcript object by its NCBI accession"""
-        # Find and load the right file
-        file_index = self.genome.search_transcripts_index(self.symbol)
-        if file_index is None:
-            raise ValueError(f"Gene symbol {self.symbol} not found in index")
-        file = load_tsv_data(f"{self.genome.dir}/transcripts/{file_index}.tsv", delimiter="\t")
-        # Get the data (row) for the specific transcript
-        data = next((row for row in file if row["transcript"] == accession), None)
-        if data is None:
-            return(None)
-        # Remove unused keys then create the Transcript object
-        keys_to_remove = ["gene", "start_codon", "stop_codon"]
-        for key in keys_to_remove:
-            data.pop(key, None)
-        return Transcript(genome=self.genome, gene=self, **data)
+        return(self.genome.get_transcript(self, accession))
         # Returning None is handled in the routes I have :)
 
+    @property
+    def length(self):
+        """Get the length of the gene (in bp)"""
+        return(int(self.locus[3]) - int(self.locus[2]) + 1)
+
     @property
     def sequence(self):
         """Get the sequence of the gene from the genome"""
+        return(self.sequence_range(0, self.length))
+
+    def sequence_range(self, offset: int, length: int):
+        """Get part of the gene's sequence (5' to 3' on its own strand), starting at a 0-based offset
+        Only that part is read (and reverse complemented on the minus strand), so this is cheap for huge genes
+        """
+        chromosome, orientation, start, end = self.locus
+        offset, length = max(int(offset), 0), max(min(int(length), self.length - int(offset)), 0)
+        if length == 0:
+            return("")
+        if orientation == "minus": # The 5' end of the gene is its end coordinate
+            return(reverse_complement(self.genome.get_sequence_by_coord(
+                chromosome, int(end) - offset - length + 1, int(end) - offset)))
+        return(self.genome.get_sequence_by_coord(chromosome, int(start) + offset, int(start) + offset + length - 1))
+
+    def iter_sequence(self, chunk_size: int = CHUNK_SIZE):
+        """Yield the gene's sequence a chunk at a time (5' to 3'), for streaming genes that are too big to hold"""
         chromosome, orientation, start, end = self.locus
-        seq = self.genome.get_sequence_by_coord(chromosome, start, end)
-        if orientation == "minus":
-            seq = reverse_complement(seq)
-        return(seq)
+        return(self.genome.iter_sequence(chromosome, [(start, end)], minus=orientation == "minus", chunk_size=chunk_size))
+
+    def sequence_error(self):
+        """Why the gene's sequence can't be streamed (see Transcript.sequence_error), or None if it can"""
+        chromosome, orientation, start, end = self.locus
+        if orientation == "minus" and (base := self.genome.invalid_base(chromosome, [(start, end)])) is not None:
+            return(f"The sequence has a base that can't be reverse complemented ({base})")
+        return(None)
+
+    def fasta_header(self):
+        """The header line of the gene's FASTA record (without the >)"""
+        chromosome, orientation, start, end = self.locus
+        return(f"{self.symbol} {self.name} chr{chromosome}:{start}-{end}({'-' if orientation == 'minus' else '+'})")
 
 class Transcript():
+    __slots__ = ("genome", "gene", "ncbi_accession", "biotype", "product", "predicted", "source", "xrefs",
+                 "bounds", "locus", "exons", "CDSs", "_cache")
+
     def __init__(self, genome: Genome, gene: Gene,
                 transcript: str, transcript_biotype: str, product: str, source: str, xref: str,
-                 transcript_bounds: tuple, exons: str, CDSs: str):
+                 transcript_bounds: tuple, exons: list, CDSs: list):
         # Parent objects
         self.genome = genome
         self.gene = gene
@@ -137,34 +540,47 @@ class Transcript():
         self.product = product
         self.predicted = True if self.ncbi_accession.startswith("X") else False
         self.source = source
-        self.xrefs = {k:v for k,v in [x.split(":", 1) for x in xref.split(",")]}
+        self.xrefs = {k:v for k,v in [x.split(":", 1) for x in xref.split(",") if ":" in x]}
 
         # Sequence information 
-        self.bounds = [int(bound) for bound in list(eval(transcript_bounds))]
+        self.bounds = [int(bound) for bound in transcript_bounds]
         self.locus = [gene.locus[0], gene.locus[1], self.bounds[0], self.bounds[1]]
-        self.exons = [(int(bound[0]), int(bound[1])) for bound in list(eval(exons))]
-        self.CDSs = [(int(bound[0]), int(bound[1])) for bound in list(eval(CDSs))]
+        self.exons = [(int(bound[0]), int(bound[1])) for bound in exons]
+        self.CDSs = [(int(bound[0]), int(bound[1])) for bound in CDSs]
+        self._cache = None # Sequences we've already computed (see _cached)
 
-    def summary_dict(self):
-        """Return a dictionary of the transcript's summary information to pass to JavaScript"""
-        return({
-            "genome_name": self.genome.name,
-            "gene_symbol": self.gene.symbol,
-            "ncbi_accession": self.ncbi_accession,
-            "biotype": self.biotype,
-            "product": self.product,
-            "predicted": self.predicted,
-            "source": self.source,
-            "xrefs": self.xrefs,
-            "bounds": self.bounds,
-            "locus": self.locus,
-            "exons": self.exons,
-            "CDSs": self.CDSs,
-            "sequence": self.sequence,
-            "exonic_sequence": self.exonic_sequence,
-            "coding_sequence": self.coding_sequence,
-            "amino_acid_sequence": self.amino_acid_sequence
-        })
+    @classmethod
+    def from_row(cls, genome, gene, row):
+        """Make a Transcript from a row of a transcripts/file_N.tsv shard"""
+        return(cls(genome=genome, gene=gene,
+                   transcript=row["transcript"], transcript_biotype=row["transcript_biotype"],
+                   product=row["product"], source=row["source"], xref=row["xref"],
+                   transcript_bounds=ast.literal_eval(row["transcript_bounds"]),
+                   exons=ast.literal_eval(row["exons"] or "[]"), CDSs=ast.literal_eval(row["CDSs"] or "[]")))
+
+    def summary_dict(self, fields=None):
+        """Return a dictionary of the transcript's summary information to pass to JavaScript
+        Pass a list of fields (see TRANSCRIPT_FIELDS) to only compute those, e.g. just the protein sequence
+        """
+        getters = {
+            "genome_name": lambda: self.genome.name,
+            "gene_symbol": lambda: self.gene.symbol,
+            "ncbi_accession": lambda: self.ncbi_accession,
+            "biotype": lambda: self.biotype,
+            "product": lambda: self.product,
+            "predicted": lambda: self.predicted,
+            "source": lambda: self.source,
+            "xrefs": lambda: self.xrefs,
+            "bounds": lambda: self.bounds,
+            "locus": lambda: self.locus,
+            "exons": lambda: self.exons,
+            "CDSs": lambda: self.CDSs,
+            "sequence": lambda: self.sequence,
+            "exonic_sequence": lambda: self.exonic_sequence,
+            "coding_sequence": lambda: self.coding_sequence,
+            "amino_acid_sequence": lambda: self.amino_acid_sequence
+        }
+        return({field: getters[field]() for field in (fields or getters)})
     
     def metadata_dict(self):
         """Return a dictionary of the transcript's metadata (for Jinja2)"""
@@ -177,31 +593,46 @@ class Transcript():
             "source": self.source,
             "xrefs": self.xrefs,
         })
+
+    # Each sequence is derived from the one before it and cached on the object:
+    # genomic DNA (plus strand, read once) -> pre-RNA / spliced RNA -> coding RNA -> protein
+    def _cached(self, key, compute):
+        """Get a cached value (computing it the first time)"""
+        if self._cache is None:
+            self._cache = {}
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return(self._cache[key])
+
+    def _stored(self, field):
+        """Get one of the derived sequences out of the genome's store (see derived_store.py), or None if it's not there"""
+        if self.genome.derived is None:
+            return(None)
+        return(self.genome.derived.get(self, field))
+
+    @property
+    def genomic_sequence(self):
+        """Get the genomic (plus strand) DNA sequence under the transcript -- it's only read once"""
+        return(self._cached("genomic", lambda: self.genome.get_sequence_by_coord(
+            self.locus[0], int(self.bounds[0]), int(self.bounds[1]))))
     
-    # This is called a lot -- hopefully the files are cached in memory?
-    # I should check :)
     @property
     def sequence(self):
         """Get the transcribed pre-RNA sequence of the transcript"""
-        trancript_seq = transcribe_pre_rna(self.genome.get_sequence_by_coord(
-                self.locus[0], int(self.bounds[0]), int(self.bounds[1])))
-        # Don't forget to reverse complement the sequence if the gene is on the minus strand
-        if self.locus[1] == "minus":
-            trancript_seq = reverse_complement(trancript_seq, rna=True)
-        return(trancript_seq)
+        def compute():
+            trancript_seq = transcribe_pre_rna(self.genomic_sequence)
+            # Don't forget to reverse complement the sequence if the gene is on the minus strand
+            if self.locus[1] == "minus":
+                trancript_seq = reverse_complement(trancript_seq, rna=True)
+            return(trancript_seq)
+        return(self._cached("sequence", compute))
 
     @property
     def exonic_sequence(self):
         """Get the spliced exonic RNA sequence of the transcript"""
         if len(self.exons) < 1:
             return(None)
-        exons = [(int(bound[0]), int(bound[1])) for bound in self.exons]
-        return(splice_rna(
-            rna_sequence=self.sequence, 
-            exon_bounds=exons,
-            reindex=int(self.locus[2]),
-            reverse=True if self.locus[1] == "minus" else False
-        ))
+        return(self._cached("exonic", lambda: self._stored("exonic_sequence") or self.spliced_sequence(self.exons)))
     
     @property
     def coding_sequence(self):
@@ -210,32 +641,125 @@ class Transcript():
             return(None)
         if self.biotype != "mRNA":
             return(None)
-        cds = [(int(bound[0]), int(bound[1])) for bound in self.CDSs]
-        return(splice_rna(
-            rna_sequence=self.sequence, 
-            exon_bounds=cds,
-            reindex=int(self.locus[2]),
-            reverse=True if self.locus[1] == "minus" else False
-        ))
+        return(self._cached("coding", lambda: self._stored("coding_sequence") or self.spliced_sequence(self.CDSs)))
+
+    def spliced_sequence(self, bounds):
+        """Get the RNA sequence of some regions (like exons or CDSs) spliced together
+        It's the same as splice_rna() on the whole pre-RNA, but the regions are cut out of the plus strand
+        so only the spliced sequence gets reverse complemented (on the minus strand)
+        """
+        regions = self._clipped_regions(bounds)
+        if self._cache is not None and "genomic" in self._cache:
+            # We already have the genomic sequence, so just slice it
+            offset = self.bounds[0]
+            pieces = [self._cache["genomic"][start - offset:end - offset + 1] for start, end in regions]
+        else:
+            # Otherwise read just the regions from the genome (no need for the whole pre-RNA)
+            pieces = self.genome.get_sequences_by_coords(self.locus[0], regions)
+        spliced_sequence = transcribe_pre_rna("".join(pieces))
+        if self.locus[1] == "minus":
+            spliced_sequence = reverse_complement(spliced_sequence, rna=True)
+        return(spliced_sequence)
+
+    def _clipped_regions(self, bounds):
+        """Clip regions to the transcript (in order), just like slicing the pre-RNA would"""
+        regions = [(max(int(start), self.bounds[0]), min(int(end), self.bounds[1])) for start, end in order_bounds(bounds)]
+        return([region for region in regions if region[0] <= region[1]])
+
+    def iter_sequence(self, field: str, chunk_size: int = CHUNK_SIZE):
+        """Get a generator of one of the sequences (see TRANSCRIPT_STREAM_FIELDS) a chunk at a time, 5' to 3'
+        It's read straight from the chromosome files, so even megabase transcripts never have to be held in memory
+        Returns None if the transcript doesn't have that sequence (like the properties do)
+        """
+        if field not in TRANSCRIPT_STREAM_FIELDS:
+            raise ValueError(f"Can't stream {field} (it has to be one of {', '.join(TRANSCRIPT_STREAM_FIELDS)})")
+        if field == "exonic_sequence" and len(self.exons) < 1:
+            return(None)
+        if field in ("coding_sequence", "amino_acid_sequence") and (len(self.CDSs) < 1 or self.biotype != "mRNA"):
+            return(None)
+        cache_key = {"genomic_sequence": "genomic", "sequence": "sequence", "exonic_sequence": "exonic",
+                     "coding_sequence": "coding", "amino_acid_sequence": "protein"}[field]
+        cached = self._cache.get(cache_key) if self._cache is not None else None
+        if cached is None and field in DERIVED_FIELDS:
+            cached = self._stored(field)
+        if cached is not None:
+            # Already computed (or precomputed), so just hand out slices of it
+            return(cached[i:i+chunk_size] for i in range(0, len(cached), chunk_size))
+        chromosome, minus = self.locus[0], self.locus[1] == "minus"
+        if field == "genomic_sequence":
+            return(self.genome.iter_sequence(chromosome, [self.bounds], chunk_size=chunk_size))
+        if field == "amino_acid_sequence":
+            return(translate_chunks(self.iter_sequence("coding_sequence", chunk_size)))
+        regions = {"sequence": [self.bounds], "exonic_sequence": self.exons, "coding_sequence": self.CDSs}[field]
+        chunks = self.genome.iter_sequence(chromosome, self._clipped_regions(regions), minus=minus, chunk_size=chunk_size)
+        return(transcribe_pre_rna(chunk) for chunk in chunks)
+
+    def sequence_error(self, field: str):
+        """Why one of the sequences (see TRANSCRIPT_STREAM_FIELDS) can't be made, or None if it can (or there isn't one)
+        A stream can't report an error once it's started (the 200 has already been sent), so check before streaming:
+        only the minus strand has bases to complement, and only the protein has codons to translate
+        """
+        chunks = self.iter_sequence(field)
+        if chunks is None:
+            return(None)
+        try:
+            if field == "amino_acid_sequence": # The CDS is small, so just translate it
+                for _ in chunks:
+                    pass
+            elif field != "genomic_sequence" and self.locus[1] == "minus":
+                regions = {"sequence": [self.bounds], "exonic_sequence": self.exons, "coding_sequence": self.CDSs}[field]
+                base = self.genome.invalid_base(self.locus[0], self._clipped_regions(regions))
+                if base is not None:
+                    raise KeyError(base)
+        except KeyError as e:
+            return(f"The {field} has a base or codon that can't be used ({e.args[0]})")
+        except ValueError as e:
+            return(f"The {field} can't be made ({e})")
+        return(None)
+
+    def fasta_header(self, field: str):
+        """The header line of one of the transcript's FASTA records (without the >)"""
+        return(f"{self.ncbi_accession} {self.gene.symbol} {field}")
+
+    @property
+    def coordinates(self):
+        """Get the CoordinateMap between the transcript's genomic, transcript, CDS and protein positions (see coordinates.py)
+        The regions are clipped like they are for the sequences, so the positions line up with exonic_sequence etc.
+        """
+        def compute():
+            coding = self.biotype == "mRNA" and len(self.CDSs) > 0 # Same as when there's a coding_sequence
+            return(CoordinateMap(self._clipped_regions(self.exons), self._clipped_regions(self.CDSs) if coding else [],
+                                 minus=self.locus[1] == "minus"))
+        return(self._cached("coordinates", compute))
 
     # Probably should be a property of the Protein class
     # But without any other Protein operations needed, we just won't use a Protein class for now
     @property
     def amino_acid_sequence(self):
         """Get the protein sequence of the transcript"""
-        if self.biotype != "mRNA":
+        if self.biotype != "mRNA" or self.coding_sequence is None:
             return(None)
-        return(translate_rna(self.coding_sequence))
+        return(self._cached("protein", lambda: self._stored("amino_acid_sequence") or translate_rna(self.coding_sequence)))
     
     def write_fasta(self, filename):
-        """Write all the sequences to a FASTA file"""
+        """Write all the sequences to a FASTA file
+        Each one is streamed to the file a chunk at a time, so this doesn't need much memory even for huge transcripts
+        """
+        records = [("genomic_sequence", "sequence"), ("transcript_sequence", "sequence"),
+                   ("exonic_sequence", "exonic_sequence"), ("cds_sequence", "coding_sequence"),
+                   ("protein_sequence", "amino_acid_sequence")]
         with open(filename, "w") as f:
-            text = f">genomic_sequence\n{self.sequence}\n"
-            text += f">transcript_sequence\n{self.sequence}\n"
-            text += f">exonic_sequence\n{self.exonic_sequence}\n"
-            text += f">cds_sequence\n{self.coding_sequence}\n"
-            text += f">protein_sequence\n{self.amino_acid_sequence}\n"
-            f.write(text)
+            for header, field in records:
+                chunks = self.iter_sequence(field)
+                f.writelines(format_fasta(header, ["None"] if chunks is None else chunks, line_width=0))
+
+# Everything Transcript.summary_dict() can return (the /api/transcripts fields= parameter picks from these)
+TRANSCRIPT_METADATA_FIELDS = ["genome_name", "gene_symbol", "ncbi_accession", "biotype", "product", "predicted",
+                              "source", "xrefs", "bounds", "locus", "exons", "CDSs"]
+TRANSCRIPT_SEQUENCE_FIELDS = ["sequence", "exonic_sequence", "coding_sequence", "amino_acid_sequence"]
+TRANSCRIPT_FIELDS = TRANSCRIPT_METADATA_FIELDS + TRANSCRIPT_SEQUENCE_FIELDS
+# The sequences Transcript.iter_sequence() can stream (the genomic DNA too, which isn't in summary_dict)
+TRANSCRIPT_STREAM_FIELDS = ["genomic_sequence"] + TRANSCRIPT_SEQUENCE_FIELDS
 
 class Protein():
     def __init__(self, accession: str, name: str, sequence: str):
@@ -0,0 +1,159 @@
+"""
+Two-tier cache for responses that only depend on the data (gene pages, transcript JSON, sequence pages)
+    1. An in-process LRU (limited by the size of the bodies in it, not the number of them -- RESPONSE_CACHE_MB per worker)
+    2. The shared on-disk flask_caching cache from helper.py (so every gunicorn worker can use what one of them made)
+
+Everything is keyed by a "data version": a hash of the names, sizes and modification times of everything in DATA_DIR.
+If the data changes, the version changes, so old entries are never served again (they just age out)
+Responses get an ETag (made from the data version and the URL) and Cache-Control, and a request with a matching
+If-None-Match gets a 304 (without the view running, if the response is already cached)
+Only complete 200 responses are cached (see cacheable()), never errors or streamed responses
+Bodies bigger than GZIP_MIN_SIZE are stored gzipped, so a cache hit from a browser doesn't have to compress anything
+"""
+from flask import request, session, make_response, Response
+from collections import OrderedDict
+from functools import wraps
+from server.metrics import count, timed
+import gzip, hashlib, os, threading
+
+MEMORY_MAX_BYTES = 16 * 1024 * 1024 # Per worker, unless init_app() gets another size (RESPONSE_CACHE_MB in .env)
+GZIP_MIN_SIZE = 1024 # Bytes (smaller bodies aren't worth compressing)
+GZIP_LEVEL = 1 # Sequences barely compress better at higher levels, but it's ~10x slower (0.7s for a 5 MB transcript at 6)
+MAX_AGE = 3600 # Seconds browsers can use a response without checking its ETag
+
+def data_version(data_dir: str):
+    """Hash the names, sizes and modification times of every file in a directory (without reading the files)"""
+    digest = hashlib.blake2b(digest_size=8)
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, data_dir)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode("utf-8"))
+    return(digest.hexdigest())
+
+@timed("gzip")
+def compress_body(body: bytes):
+    return(gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0))
+
+class LRUCache():
+    def __init__(self, max_bytes: int):
+        """A thread-safe least-recently-used cache that evicts entries once their sizes add up to more than max_bytes"""
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # Key -> (size, value), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return(None)
+            self.entries.move_to_end(key)
+            return(entry[1])
+
+    def set(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[0]
+            self.entries[key] = (size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class ResponseCache():
+    def __init__(self, max_bytes: int = MEMORY_MAX_BYTES):
+        self.memory = LRUCache(max_bytes)
+        self.disk = None
+        self.version = None # Nothing is cached until init_app() works out the data version
+
+    def init_app(self, app, disk_cache=None, data_dir: str = None, memory_max_bytes: int = None):
+        """Work out the data version (once per process) and use disk_cache (a flask_caching Cache) as the second tier
+        memory_max_bytes is how big the in-process tier can get (0 turns it off)
+        """
+        if memory_max_bytes is not None:
+            self.memory.max_bytes = memory_max_bytes
+            self.memory.clear()
+        self.version = data_version(data_dir)
+        self.disk = disk_cache
+        app.config["DATA_VERSION"] = self.version
+
+    def cached(self, view):
+        """Decorator for views whose response only depends on the URL and the data"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if self.version is None:
+                return(view(*args, **kwargs))
+            key = f"response:{self.version}:{request.full_path}"
+            etag = hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+            entry = self.memory.get(key)
+            result = "memory_hit"
+            if entry is None and self.disk is not None:
+                entry = self.disk.get(key)
+                result = "disk_hit"
+                if entry is not None:
+                    self.memory.set(key, entry, len(entry[3]))
+            if entry is None:
+                result = "miss"
+                response = make_response(view(*args, **kwargs))
+                if not self.cacheable(response):
+                    return(response)
+                body = response.get_data()
+                compressed = len(body) >= GZIP_MIN_SIZE
+                entry = (response.status_code, response.mimetype, compressed,
+                         compress_body(body) if compressed else body)
+                self.memory.set(key, entry, len(entry[3]))
+                if self.disk is not None:
+                    self.disk.set(key, entry)
+            # Only answer with a 304 once we know the response is one we'd cache (and so would have sent an ETag with)
+            if request.if_none_match.contains_weak(etag):
+                result = "not_modified"
+                response = Response(status=304)
+            else:
+                response = self._response_from(entry)
+            count("egdb_response_cache_total", f'result="{result}"')
+            return(self._finish(response, etag))
+        return(wrapper)
+
+    @staticmethod
+    def cacheable(response):
+        """Only keep complete, plain successful responses that didn't touch the session (e.g. by flashing a message)
+        Streamed responses are never kept: they're made while they're sent, so one that fails partway through
+        (after its 200 went out) would be cached cut off
+        """
+        return(response.status_code == 200 and not response.is_streamed and not response.direct_passthrough
+               and not session.modified)
+
+    @staticmethod
+    def _response_from(entry):
+        """Make a response from a cache entry (sending the gzipped body as it is if the client can take it)"""
+        status, mimetype, compressed, body = entry
+        if not compressed:
+            return(Response(body, status=status, mimetype=mimetype))
+        if "gzip" in request.accept_encodings:
+            response = Response(body, status=status, mimetype=mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+            return(response)
+        return(Response(gzip.decompress(body), status=status, mimetype=mimetype))
+
+    @staticmethod
+    def _finish(response, etag):
+        response.set_etag(etag, weak=True) # Weak because the gzipped and plain bodies are "the same"
+        response.headers["Cache-Control"] = f"public, max-age={MAX_AGE}"
+        response.vary.add("Accept-Encoding")
+        return(response)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+response_cache = ResponseCache()
@@ -1,11 +1,17 @@
-from flask import Flask, request, jsonify, Blueprint
+from flask import Flask, request, jsonify, Blueprint, Response, stream_with_context
+import json, re
 
-from server.helper import settings, cache
-from server.models import Genome, Gene
+from server.helper import settings
+from server.models import Genome, Gene, genomes, TRANSCRIPT_FIELDS, TRANSCRIPT_METADATA_FIELDS, TRANSCRIPT_SEQUENCE_FIELDS, TRANSCRIPT_STREAM_FIELDS
+from server.dna_tools import format_fasta
+from server.response_cache import response_cache
+from server.coordinates import COORDINATE_SYSTEMS
+from server.kmer_index import INDEX_KINDS
 
 api = Blueprint("api", __name__)
 
 @api.route("/api/transcripts/<genome>/<gene_symbol>/<transcript_accession>")
+@response_cache.cached
 def get_transcripts(genome, gene_symbol, transcript_accession=None):
     genome = Genome.load(genome)
     if genome is None:
@@ -16,8 +22,352 @@ def get_transcripts(genome, gene_symbol, transcript_accession=None):
     transcript = gene.get_transcript_by_accession(transcript_accession)
     if transcript is None:
         return(jsonify({"error": "Transcript not found"}), 404)
-    return(jsonify(transcript.summary_dict()))
+    # Only compute (and send) the fields that were asked for, e.g. ?fields=metadata,amino_acid_sequence
+    fields = parse_fields(request.args.get("fields"))
+    if fields is None:
+        return(jsonify({"error": "Invalid fields", "valid_fields": TRANSCRIPT_FIELDS + list(FIELD_GROUPS)}), 400)
+    try:
+        summary = transcript.summary_dict(fields=fields)
+    except (KeyError, ValueError) as e: # Like the protein of a partial CDS, or a base we can't reverse complement
+        return(jsonify({"error": f"The sequences can't be made ({e!r})"}), 422)
+    return(jsonify(summary))
+
+# Shortcuts for the fields= parameter
+FIELD_GROUPS = {"metadata": TRANSCRIPT_METADATA_FIELDS, "sequences": TRANSCRIPT_SEQUENCE_FIELDS}
+
+def parse_fields(fields_arg):
+    """Turn a comma-separated fields= parameter into a list of fields (all of them if it's empty, None if it's invalid)"""
+    if not fields_arg:
+        return(TRANSCRIPT_FIELDS)
+    fields = []
+    for field in fields_arg.split(","):
+        field = field.strip()
+        if field in FIELD_GROUPS:
+            fields += FIELD_GROUPS[field]
+        elif field in TRANSCRIPT_FIELDS:
+            fields.append(field)
+        else:
+            return(None)
+    return(list(dict.fromkeys(fields)))
     
+# The most sequence we send in one response (the page asks for the rest with start=next_start)
+MAX_SEQUENCE_PAGE = 1_000_000
+
+@api.route("/api/sequence/<genome_name>/<gene_symbol>")
+@response_cache.cached
+def get_gene_sequence(genome_name, gene_symbol):
+    genome = Genome.load(genome_name)
+    if genome is None:
+        return(jsonify({"error": "Genome not found"}), 404)
+    gene = genome.get_gene_by_symbol(gene_symbol)
+    if gene is None:
+        return(jsonify({"error": "Gene not found"}), 404)
+    # start is a 0-based offset into the gene's sequence (5' to 3')
+    try:
+        start = int(request.args.get("start", 0))
+        length = int(request.args.get("length", MAX_SEQUENCE_PAGE))
+    except ValueError:
+        return(jsonify({"error": "start and length have to be integers"}), 400)
+    if start < 0 or length < 0:
+        return(jsonify({"error": "start and length can't be negative"}), 400)
+    length = min(length, MAX_SEQUENCE_PAGE, max(gene.length - start, 0))
+    return(jsonify({
+        "symbol": gene.symbol,
+        "start": start,
+        "length": length,
+        "total_length": gene.length,
+        "next_start": start + length if start + length < gene.length else None,
+        "sequence": gene.sequence_range(start, length),
+    }))
+
+# Features /api/region can return (genes and transcripts unless ?features= says otherwise)
+REGION_FEATURES = ["genes", "transcripts", "exons"]
+REGION_PATTERN = re.compile(r"^(?:chr)?([A-Za-z0-9_.]+)(?::([\d,]+)-([\d,]+))?$")
+
+def parse_region(region):
+    """Parse a region like chr1:1,000-2,000 or 1:1000-2000 (or just chr1 for the whole chromosome)
+    Returns (chromosome, start, end), with start and end None for a whole chromosome, or None if it's not a region
+    """
+    match = REGION_PATTERN.match(region.strip())
+    if match is None:
+        return(None)
+    chromosome, start, end = match.groups()
+    if start is None:
+        return((chromosome, None, None))
+    return((chromosome, int(start.replace(",", "")), int(end.replace(",", ""))))
+
+@api.route("/api/region/<genome_name>/<region>")
+@response_cache.cached
+def get_region(genome_name, region):
+    """Get the genes, transcripts and/or exons (?features=) that overlap a region, and its sequence with ?sequence=true
+    Coordinates are 1-based and inclusive, and the sequence is the plus strand
+    """
+    genome = Genome.load(genome_name)
+    if genome is None:
+        return(jsonify({"error": "Genome not found"}), 404)
+    parsed = parse_region(region)
+    if parsed is None:
+        return(jsonify({"error": "Invalid region (it should look like chr1:1000-2000)"}), 400)
+    chromosome, start, end = parsed
+    features = request.args.get("features")
+    features = [feature.strip() for feature in features.split(",")] if features else REGION_FEATURES[:2]
+    if any(feature not in REGION_FEATURES for feature in features):
+        return(jsonify({"error": "Invalid features", "valid_features": REGION_FEATURES}), 400)
+
+    index = genome.region_index()
+    if chromosome not in index.chromosomes:
+        return(jsonify({"error": "Chromosome not found"}), 404)
+    length = genome.chromosome_length(chromosome)
+    if start is None:
+        start, end = 1, length if length is not None else 2**31 - 1
+    if start < 1 or end < start:
+        return(jsonify({"error": "The region has to start at 1 or later and end after it starts"}), 400)
+    if length is not None:
+        end = min(end, length)
+
+    result = {"genome_name": genome.name, "chromosome": chromosome, "start": start, "end": end}
+    getters = {"genes": index.genes_in, "transcripts": index.transcripts_in, "exons": index.exons_in}
+    for feature in features:
+        result[feature] = getters[feature](chromosome, start, end)
+    if request.args.get("sequence", "").lower() in ("1", "true", "yes"):
+        if length is None:
+            return(jsonify({"error": "No sequence for this chromosome"}), 404)
+        if start > end or end - start + 1 > MAX_SEQUENCE_PAGE:
+            return(jsonify({"error": f"The region has to be at most {MAX_SEQUENCE_PAGE} bp (and on the chromosome) to get its sequence"}), 400)
+        result["sequence"] = genome.get_sequence_by_coord(chromosome, start, end)
+    return(jsonify(result))
+
+# The most positions one /api/coordinates request can map
+MAX_MAPPED_POSITIONS = 1_000_000
+
+@api.route("/api/coordinates/<genome_name>/<gene_symbol>/<transcript_accession>", methods=["GET", "POST"])
+def map_coordinates(genome_name, gene_symbol, transcript_accession):
+    """Map positions between a transcript's genomic, transcript, CDS and protein coordinates (1-based)
+    GET with ?from=genomic&positions=7675994,7676521 or POST {"from": "genomic", "positions": [...]} for long lists
+    Every coordinate system comes back as a list lined up with the positions (null where a position doesn't map)
+    """
+    gene, transcript, error = find_gene_and_transcript(genome_name, gene_symbol, transcript_accession)
+    if error is not None:
+        return(error)
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("positions"), list):
+            return(jsonify({"error": "Send a JSON object with a list of positions"}), 400)
+        system, positions = body.get("from", "genomic"), body["positions"]
+    else:
+        system, positions = request.args.get("from", "genomic"), request.args.get("positions", "")
+        positions = [position for position in positions.replace(" ", "").split(",") if position]
+    if system not in COORDINATE_SYSTEMS:
+        return(jsonify({"error": "Invalid coordinate system", "valid_systems": COORDINATE_SYSTEMS}), 400)
+    if len(positions) > MAX_MAPPED_POSITIONS:
+        return(jsonify({"error": f"Too many positions (the most is {MAX_MAPPED_POSITIONS})"}), 400)
+    try:
+        positions = [int(position) for position in positions]
+    except (TypeError, ValueError):
+        return(jsonify({"error": "Positions have to be integers"}), 400)
+    return(jsonify({
+        "gene_symbol": gene.symbol,
+        "ncbi_accession": transcript.ncbi_accession,
+        "strand": transcript.locus[1],
+        "from": system,
+        **transcript.coordinates.map(system, positions),
+    }))
+
+# The most hits /api/sequence_search sends back (and the default)
+MAX_SEARCH_HITS = 10_000
+DEFAULT_SEARCH_HITS = 1000
+
+@api.route("/api/sequence_search/<genome_name>")
+@response_cache.cached
+def sequence_search(genome_name):
+    """Find the transcripts that contain a nucleotide sequence (like a primer, both strands unless ?reverse_complement=false)
+    or the proteins that contain a peptide (?type=peptide), e.g. /api/sequence_search/hg38?query=GCTGGAGACCAAGGAGGA
+    Positions are 1-based in the exonic (spliced RNA) or protein sequence
+    """
+    genome = Genome.load(genome_name)
+    if genome is None:
+        return(jsonify({"error": "Genome not found"}), 404)
+    query, kind = request.args.get("query", ""), request.args.get("type", "nucleotide")
+    if kind not in INDEX_KINDS:
+        return(jsonify({"error": "Invalid type", "valid_types": list(INDEX_KINDS)}), 400)
+    try:
+        max_hits = int(request.args.get("max_hits", DEFAULT_SEARCH_HITS))
+    except ValueError:
+        return(jsonify({"error": "max_hits has to be an integer"}), 400)
+    if not 0 < max_hits <= MAX_SEARCH_HITS:
+        return(jsonify({"error": f"max_hits has to be between 1 and {MAX_SEARCH_HITS}"}), 400)
+    index = genome.kmer_index()
+    if index is None:
+        return(jsonify({"error": f"The sequence index hasn't been built for this genome (python -m server.cli build-kmer-index {genome.name})"}), 404)
+    try:
+        hits, method, truncated = index.search(query, kind, max_hits=max_hits,
+                                               reverse_complement_too=request.args.get("reverse_complement", "true").lower() != "false")
+    except ValueError as e:
+        return(jsonify({"error": str(e)}), 400)
+    return(jsonify({
+        "query": query,
+        "type": kind,
+        "method": method,
+        "truncated": truncated,
+        "hits": [{"ncbi_accession": accession, "gene_symbol": getattr(genome.get_gene_by_transcript(accession), "symbol", None),
+                  "strand": strand, "start": start, "end": end} for accession, strand, start, end in hits],
+    }))
+
+# Streaming endpoints: the sequence is read from the chromosome files and sent a chunk at a time,
+# so a request only ever holds about one chunk of it (no matter how long the gene is)
+FASTA_LINE_WIDTH = 70
+MAX_FASTA_LINE_WIDTH = 10_000
+
+def find_gene_and_transcript(genome_name, gene_symbol, transcript_accession=None):
+    """Look up what a streaming request is for, returning (gene, transcript, error response)"""
+    genome = Genome.load(genome_name)
+    if genome is None:
+        return(None, None, (jsonify({"error": "Genome not found"}), 404))
+    gene = genome.get_gene_by_symbol(gene_symbol)
+    if gene is None:
+        return(None, None, (jsonify({"error": "Gene not found"}), 404))
+    if transcript_accession is None:
+        return(gene, None, None)
+    transcript = gene.get_transcript_by_accession(transcript_accession)
+    if transcript is None:
+        return(None, None, (jsonify({"error": "Transcript not found"}), 404))
+    return(gene, transcript, None)
+
+@api.route("/api/fasta/<genome_name>/<gene_symbol>")
+@api.route("/api/fasta/<genome_name>/<gene_symbol>/<transcript_accession>")
+def stream_fasta(genome_name, gene_symbol, transcript_accession=None):
+    """Stream the gene's genomic sequence, or a transcript's sequences (?fields=, all of them by default), as FASTA"""
+    gene, transcript, error = find_gene_and_transcript(genome_name, gene_symbol, transcript_accession)
+    if error is not None:
+        return(error)
+    try:
+        line_width = int(request.args.get("line_width", FASTA_LINE_WIDTH))
+    except ValueError:
+        return(jsonify({"error": "line_width has to be an integer"}), 400)
+    if not 0 < line_width <= MAX_FASTA_LINE_WIDTH:
+        return(jsonify({"error": f"line_width has to be between 1 and {MAX_FASTA_LINE_WIDTH}"}), 400)
+
+    if transcript is None:
+        problem = gene.sequence_error()
+        if problem is not None:
+            return(jsonify({"error": problem}), 422)
+        records = [(gene.fasta_header(), gene.iter_sequence())]
+        filename = f"{gene.symbol}.fa"
+    else:
+        fields = request.args.get("fields")
+        if fields:
+            fields = [field.strip() for field in fields.split(",")]
+            if any(field not in TRANSCRIPT_STREAM_FIELDS for field in fields):
+                return(jsonify({"error": "Invalid fields", "valid_fields": TRANSCRIPT_STREAM_FIELDS}), 400)
+            # Check first, since once the stream has started there's no way to send an error
+            problems = [problem for problem in map(transcript.sequence_error, fields) if problem is not None]
+            if problems:
+                return(jsonify({"error": "; ".join(problems)}), 422)
+        else:
+            # All of them by default, leaving out any that can't be made (like the protein of a partial CDS)
+            fields = [field for field in TRANSCRIPT_STREAM_FIELDS if transcript.sequence_error(field) is None]
+        # The generators don't read anything until they're iterated, and transcripts without a sequence are skipped
+        records = [(transcript.fasta_header(field), transcript.iter_sequence(field)) for field in fields]
+        records = [(header, chunks) for header, chunks in records if chunks is not None]
+        filename = f"{transcript.ncbi_accession}.fa"
+
+    def generate():
+        for header, chunks in records:
+            yield from format_fasta(header, chunks, line_width=line_width)
+    return(Response(stream_with_context(generate()), mimetype="text/x-fasta",
+                    headers={"Content-Disposition": f"inline; filename={filename}"}))
+
+@api.route("/api/stream/<genome_name>/<gene_symbol>")
+@api.route("/api/stream/<genome_name>/<gene_symbol>/<transcript_accession>")
+def stream_sequence_json(genome_name, gene_symbol, transcript_accession=None):
+    """Stream one sequence as JSON ({..., "sequence": "..."}) -- the gene's, or a transcript's ?field= (pre-RNA by default)"""
+    gene, transcript, error = find_gene_and_transcript(genome_name, gene_symbol, transcript_accession)
+    if error is not None:
+        return(error)
+    if transcript is None:
+        info = {"symbol": gene.symbol, "length": gene.length}
+        chunks = gene.iter_sequence()
+    else:
+        field = request.args.get("field", "sequence")
+        if field not in TRANSCRIPT_STREAM_FIELDS:
+            return(jsonify({"error": "Invalid field", "valid_fields": TRANSCRIPT_STREAM_FIELDS}), 400)
+        info = {"symbol": gene.symbol, "ncbi_accession": transcript.ncbi_accession, "field": field}
+        chunks = transcript.iter_sequence(field)
+    # Check first, since once the stream has started there's no way to send an error
+    problem = gene.sequence_error() if transcript is None else transcript.sequence_error(field)
+    if problem is not None:
+        return(jsonify({"error": problem}), 422)
+
+    def generate():
+        # Sequences are only ever letters, so the chunks can go into the JSON string as they are
+        opening = json.dumps(info)[:-1]
+        if chunks is None:
+            yield f'{opening}, "sequence": null}}'
+            return
+        yield f'{opening}, "sequence": "'
+        yield from chunks
+        yield '"}'
+    return(Response(stream_with_context(generate()), mimetype="application/json"))
+
+# The most genes/transcripts one batch request can ask for
+MAX_BATCH_QUERIES = 10_000
+
+@api.route("/api/batch/<genome_name>", methods=["POST"])
+def batch_transcripts(genome_name):
+    """Look up lots of genes/transcripts in one request, e.g. {"queries": ["TP53", "NM_000546.6"], "fields": "metadata"}
+    A gene symbol means all of its transcripts. The results are streamed back as NDJSON, one transcript per line
+    (each with the query it answers) -- with sequence fields they come back in genome order, not the order asked for
+    """
+    genome = Genome.load(genome_name)
+    if genome is None:
+        return(jsonify({"error": "Genome not found"}), 404)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("queries"), list):
+        return(jsonify({"error": "Send a JSON object with a list of queries (gene symbols or transcript accessions)"}), 400)
+    queries = [str(query).strip() for query in body["queries"]]
+    if len(queries) > MAX_BATCH_QUERIES:
+        return(jsonify({"error": f"Too many queries (the most is {MAX_BATCH_QUERIES})"}), 400)
+    fields = body.get("fields")
+    if not (fields is None or isinstance(fields, str) or (isinstance(fields, list) and all(isinstance(field, str) for field in fields))):
+        return(jsonify({"error": "fields has to be a comma-separated string or a list of strings"}), 400)
+    fields = parse_fields(",".join(fields) if isinstance(fields, list) else fields)
+    if fields is None:
+        return(jsonify({"error": "Invalid fields", "valid_fields": TRANSCRIPT_FIELDS + list(FIELD_GROUPS)}), 400)
+
+    pairs, missing = genome.find_transcripts(queries)
+
+    def lines(transcript, queries):
+        """The NDJSON lines for one transcript (one per query that asked for it)
+        A transcript whose sequences can't be made (like the protein of a partial CDS) gets error lines, since the
+        200 has already been sent and raising would just cut the stream off there
+        """
+        try:
+            summary = transcript.summary_dict(fields=fields)
+        except (KeyError, ValueError) as e:
+            summary = {"ncbi_accession": transcript.ncbi_accession, "error": f"The sequences can't be made ({e!r})"}
+        return("".join(json.dumps({"query": query, **summary}) + "\n" for query in queries))
+
+    def generate():
+        for query in missing:
+            yield json.dumps({"query": query, "error": "Not found"}) + "\n"
+        if not any(field in TRANSCRIPT_SEQUENCE_FIELDS for field in fields):
+            for query, transcript in pairs:
+                yield lines(transcript, [query])
+            return
+        # Read the sequences a cluster of overlapping transcripts at a time (one read each), and let them go after
+        queries_by_transcript = {}
+        for query, transcript in pairs:
+            queries_by_transcript.setdefault(id(transcript), (transcript, []))[1].append(query)
+        for cluster in genome.coalesce_sequence_reads([transcript for transcript, _ in queries_by_transcript.values()]):
+            for transcript in cluster:
+                yield lines(transcript, queries_by_transcript[id(transcript)][1])
+    return(Response(stream_with_context(generate()), mimetype="application/x-ndjson"))
+
+@api.route("/api/status/genomes")
+def genomes_status():
+    """Which genomes this worker has loaded, how big they are, and how often they've been used, loaded and unloaded"""
+    return(jsonify(genomes.status()))
+
 @api.route("/api/dynamic_search/<genome_name>/")
 def dynamic_search(genome_name):
     query = request.args.get("query")
@@ -28,6 +378,6 @@ def dynamic_search(genome_name):
         return(jsonify({"error": "Please provide a query with at least 3 characters"}), 400)
     if genome is None:
         return(jsonify({"error": "Genome not found"}), 404)
-    results = genome.search(query)
+    results = genome.autocomplete(query)
     summarized_results = {gene.symbol: gene.name for gene in results}
     return(jsonify(summarized_results))
\ No newline at end of file
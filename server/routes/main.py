@@ -1,9 +1,8 @@
 from flask import Flask, request, jsonify, Blueprint, render_template, flash, redirect, url_for
 
-from server.helper import settings, cache
+from server.helper import settings
 from server.models import Genome, Gene
-
-import random
+from server.response_cache import response_cache
 
 main = Blueprint("main", __name__)
 
@@ -12,10 +11,10 @@ def index():
     return(render_template("index.html"))
 
 @main.route("/browse/<genome_name>/<gene_symbol>")
+@response_cache.cached
 def browse(genome_name, gene_symbol):
-    # I don't like that I'm loading the genome into memory each time
-    # But this seems like the most elegant is is more scalable :)
-    genome = Genome.load(genome_name) 
+    # Genomes are only loaded into memory once (see GenomeRegistry in models.py)
+    genome = Genome.load(genome_name)
     if genome is None:
         flash("Genome not found", "alert-danger")
         return(render_template("index.html"))
@@ -34,8 +33,11 @@ def random_gene(genome_name):
     if genome is None:
         flash("Genome not found", "alert-danger")
         return(render_template("index.html"))
-    gene = random.choice([gene for gene in genome.genes_table if gene["type"] in allowed_types])
-    return(redirect(url_for("main.browse", genome_name=genome_name, gene_symbol=gene["symbol"])))
+    gene = genome.random_gene(allowed_types)
+    if gene is None:
+        flash("Gene not found", "alert-danger")
+        return(render_template("index.html"))
+    return(redirect(url_for("main.browse", genome_name=genome_name, gene_symbol=gene.symbol)))
 
 @main.route("/search/<genome_name>", methods=["GET"])
 def search(genome_name):
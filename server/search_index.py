@@ -0,0 +1,75 @@
+"""
+Search index for the genes of a genome (used by /search and /api/dynamic_search)
+Results are ranked: exact matches first, then prefix matches, then substring matches
+    - Exact and prefix matches (on gene symbols and transcript accessions) use sorted lists + bisect
+    - Substring matches (on symbols, names and accessions) use a trigram inverted index
+Pseudogenes are never put in the index, so they can't show up in results
+"""
+from array import array
+from bisect import bisect_left
+
+class SearchIndex():
+    def __init__(self, genes: list):
+        """Build the index from a list of Gene objects (their order is the order of substring matches)"""
+        self.genes = [gene for gene in genes if gene.type != "pseudogene"]
+        self.texts = [] # Everything searchable about each gene (lowercase, tab-separated)
+        self.keys = [] # Sorted (lowercase symbol or accession, gene position) pairs for exact and prefix matches
+        trigrams = {}
+        for i, gene in enumerate(self.genes):
+            text = "\t".join([gene.symbol, gene.name] + gene.transcripts).lower()
+            self.texts.append(text)
+            self.keys.append((gene.symbol.lower(), i))
+            self.keys += [(accession.lower(), i) for accession in gene.transcripts]
+            for trigram in set(text[j:j+3] for j in range(len(text) - 2)):
+                trigrams.setdefault(trigram, []).append(i)
+        self.keys.sort()
+        # Postings lists are sorted (we add genes in order) and compact
+        self.trigrams = {trigram: array("I", positions) for trigram, positions in trigrams.items()}
+
+    def _prefix_matches(self, query):
+        """Yield the positions of genes with a key that starts with the query
+        Keys are sorted, so an exact match (the key is the query) always comes before the longer keys
+        """
+        i = bisect_left(self.keys, (query, -1))
+        while i < len(self.keys) and self.keys[i][0].startswith(query):
+            yield self.keys[i][1]
+            i += 1
+
+    def _substring_matches(self, query):
+        """Yield the positions of genes with the query somewhere in their text, in table order"""
+        if len(query) < 3: # Too short for trigrams (the routes don't allow this anyway)
+            candidates = range(len(self.genes))
+        else:
+            # Every trigram of the query has to be in the gene, so we only need to check the rarest one's genes
+            postings = [self.trigrams.get(query[j:j+3]) for j in range(len(query) - 2)]
+            if any(posting is None for posting in postings):
+                return
+            candidates = min(postings, key=len)
+        for i in candidates:
+            if query in self.texts[i]:
+                yield i
+
+    def search(self, query: str, max_results: int = 50, substrings: bool = True):
+        """Get a ranked list of Gene objects matching the query (set max_results to 0 for no limit)"""
+        query = query.lower().strip()
+        if not query:
+            return([])
+        ranked, seen = [], set()
+        matches = [self._prefix_matches(query)]
+        if substrings:
+            matches.append(self._substring_matches(query))
+        for i in (i for generator in matches for i in generator):
+            if i not in seen:
+                seen.add(i)
+                ranked.append(i)
+                # Everything is already in ranked order, so we can stop as soon as we have enough
+                if max_results > 0 and len(ranked) >= max_results:
+                    break
+        return([self.genes[i] for i in ranked])
+
+    def autocomplete(self, query: str, max_results: int = 50):
+        """Fast path for search-as-you-type: prefix matches only, unless there aren't enough of them"""
+        results = self.search(query, max_results, substrings=False)
+        if len(results) < max_results:
+            results = self.search(query, max_results)
+        return(results)
@@ -0,0 +1,251 @@
+"""
+Chromosome sequences, memory-mapped so reading a region doesn't open a file or copy anything it doesn't have to
+    - ASCII files (sequences/chr*.txt) are served as zero-copy memoryview slices of the mapping
+    - 2-bit packed files (sequences/chr*.2bit) are decoded straight out of the mapping
+
+2-bit packed chromosome sequences are about 4x smaller than the ASCII chr*.txt files
+Each base is 2 bits (A=0, C=1, G=2, T=3, 4 bases per byte), and the things that don't fit are in side tables:
+    - N runs: (start, length) of every run of Ns
+    - Soft-mask runs: (start, length) of every run of lowercase bases
+    - Exceptions: (position, byte) of anything else (IUPAC codes, newlines, etc.) so decoding is always exact
+
+Convert the ASCII files with:
+    python -m server.cli pack-sequences hg38
+
+File layout (numbers are in the byte order of the machine that built it):
+    MAGIC (8 bytes) | FORMAT_VERSION (uint32) | 0 (uint32) | sequence length (uint64)
+    | number of N runs, mask runs, exceptions (3 x uint64)
+    | N run starts, N run lengths, mask run starts, mask run lengths, exception positions (uint64 arrays)
+    | exception bytes (padded to 8 bytes) | packed bases
+All positions are 0-based (the 1-based coordinates are handled by Genome.get_sequence_by_coord)
+"""
+from array import array
+from bisect import bisect_right
+import mmap, os, re, struct, threading
+
+MAGIC = b"EGDB2BIT"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("8sIIQQQQ")
+CHUNK_SIZE = 1 << 22 # Bases per chunk when converting (has to be a multiple of 4)
+
+# Translation tables: ASCII -> 2-bit code, and packed byte -> the base at each of its 4 positions
+ENCODE = bytes(max(b"ACGT".find(i), 0) for i in range(256)) # Only used on uppercase sequences
+SHIFTS = [bytes((code << shift) & 0xFF for code in range(256)) for shift in (6, 4, 2, 0)]
+DECODE = [bytes(b"ACGT"[(byte >> shift) & 3] for byte in range(256)) for shift in (6, 4, 2, 0)]
+
+def pack_bases(sequence: bytes):
+    """Pack an ASCII sequence (a multiple of 4 long) into 2 bits per base"""
+    codes = sequence.translate(ENCODE)
+    # Shift the codes for each of the 4 positions into place, then OR them together as big integers
+    packed = 0
+    for position, shift_table in enumerate(SHIFTS):
+        packed |= int.from_bytes(codes[position::4].translate(shift_table), "big")
+    return(packed.to_bytes(len(sequence) // 4, "big"))
+
+def unpack_bases(packed: bytes):
+    """Unpack 2-bit bases into uppercase ASCII (4 per byte)"""
+    out = bytearray(4 * len(packed))
+    for position, decode_table in enumerate(DECODE):
+        out[position::4] = packed.translate(decode_table)
+    return(out)
+
+def find_runs(pattern, sequence: bytes, offset: int, starts: array, lengths: array):
+    """Add the runs matching a regex to the tables (merging with the last run if it continues it)"""
+    for match in pattern.finditer(sequence):
+        start, length = offset + match.start(), match.end() - match.start()
+        if len(starts) > 0 and starts[-1] + lengths[-1] == start:
+            lengths[-1] += length
+        else:
+            starts.append(start)
+            lengths.append(length)
+
+N_RUN = re.compile(rb"N+")
+MASK_RUN = re.compile(rb"[a-z]+")
+EXCEPTION = re.compile(rb"[^ACGTN]")
+
+def pack_sequence_file(in_path: str, out_path: str):
+    """Convert an ASCII chromosome file into the 2-bit format (in chunks, so it doesn't need much memory)"""
+    n_starts, n_lengths, mask_starts, mask_lengths = array("Q"), array("Q"), array("Q"), array("Q")
+    exception_positions, exception_bytes = array("Q"), bytearray()
+    tmp_path = f"{out_path}.tmp"
+    packed_path = f"{out_path}.packed.tmp"
+    length = 0
+    with open(in_path, "rb") as f, open(packed_path, "wb") as packed_file:
+        while chunk := f.read(CHUNK_SIZE):
+            upper = chunk.upper()
+            find_runs(N_RUN, upper, length, n_starts, n_lengths)
+            find_runs(MASK_RUN, chunk, length, mask_starts, mask_lengths)
+            for match in EXCEPTION.finditer(upper):
+                exception_positions.append(length + match.start())
+                exception_bytes.append(upper[match.start()])
+            length += len(chunk)
+            packed_file.write(pack_bases(upper + b"A" * (-len(upper) % 4)))
+
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, length, len(n_starts), len(mask_starts), len(exception_positions)))
+        for table in (n_starts, n_lengths, mask_starts, mask_lengths, exception_positions):
+            table.tofile(f)
+        f.write(bytes(exception_bytes) + b"\0" * (-len(exception_bytes) % 8))
+        with open(packed_path, "rb") as packed_file:
+            while chunk := packed_file.read(CHUNK_SIZE):
+                f.write(chunk)
+    os.remove(packed_path)
+    os.replace(tmp_path, out_path) # So a running worker never sees a half-written file
+    return(out_path)
+
+def check_bounds(start: int, end: int, length: int, path: str):
+    """Make sure [start, end) is inside a sequence (raises ValueError if it isn't)"""
+    if start < 0 or end > length or end < start:
+        raise ValueError(f"[{start}, {end}) is out of bounds for {path} (length {length})")
+
+class MappedSequence():
+    def __init__(self, path: str):
+        """Memory-map an ASCII chromosome file (one byte per base)"""
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.length = len(self.mmap)
+
+    def read_bytes(self, start: int, end: int):
+        """Get the bases in [start, end) (0-based) as a zero-copy memoryview"""
+        check_bounds(start, end, self.length, self.path)
+        return(self.view[start:end])
+
+    def read(self, start: int, end: int):
+        """Get the bases in [start, end) (0-based) as a string"""
+        return(str(self.read_bytes(start, end), "ascii"))
+
+class PackedSequence():
+    def __init__(self, path: str):
+        """Memory-map a 2-bit file and read its header
+        The side tables are zero-copy views of the mapping (like open_sections in annotation_store.py), so on a big
+        genome (millions of soft-mask runs) they're shared by the workers through the page cache instead of being
+        copied onto every worker's heap
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.length, n_count, mask_count, exception_count = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a 2-bit sequence file")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} is format version {version} but we need version {FORMAT_VERSION} (rebuild it)")
+        buffer, offset, tables = memoryview(self.mmap), HEADER.size, []
+        # The header is a multiple of 8 bytes, so the uint64 tables are aligned
+        for count in (n_count, n_count, mask_count, mask_count, exception_count):
+            tables.append(buffer[offset:offset + 8*count].cast("Q"))
+            offset += 8*count
+        self.n_starts, self.n_lengths, self.mask_starts, self.mask_lengths, self.exception_positions = tables
+        self.exception_bytes = buffer[offset:offset + exception_count]
+        self.bases_offset = offset + exception_count + (-exception_count % 8)
+
+    def read_bytes(self, start: int, end: int):
+        """Decode the bases in [start, end) (0-based) exactly as they are in the ASCII file"""
+        check_bounds(start, end, self.length, self.path)
+        if end == start:
+            return(bytearray())
+        packed = self.mmap[self.bases_offset + start // 4:self.bases_offset + (end + 3) // 4]
+        return(self.decode(packed, start, end))
+
+    def read(self, start: int, end: int):
+        """Decode the bases in [start, end) (0-based) as a string"""
+        return(self.read_bytes(start, end).decode("ascii"))
+
+    def decode(self, packed: bytes, start: int, end: int):
+        """Turn the packed bytes that cover [start, end) into the sequence, applying the side tables"""
+        out = unpack_bases(packed)
+        del out[:start % 4]
+        del out[end - start:]
+        for run_start, run_end in self._overlapping_runs(self.n_starts, self.n_lengths, start, end):
+            out[run_start - start:run_end - start] = b"N" * (run_end - run_start)
+        i = bisect_right(self.exception_positions, start - 1)
+        while i < len(self.exception_positions) and self.exception_positions[i] < end:
+            out[self.exception_positions[i] - start] = self.exception_bytes[i]
+            i += 1
+        for run_start, run_end in self._overlapping_runs(self.mask_starts, self.mask_lengths, start, end):
+            out[run_start - start:run_end - start] = out[run_start - start:run_end - start].lower()
+        return(out)
+
+    @staticmethod
+    def _overlapping_runs(starts, lengths, start, end):
+        """Yield the (clipped) runs that overlap [start, end) -- runs are sorted and don't overlap each other"""
+        i = max(bisect_right(starts, start) - 1, 0)
+        while i < len(starts) and starts[i] < end:
+            run_start, run_end = max(starts[i], start), min(starts[i] + lengths[i], end)
+            if run_start < run_end:
+                yield (run_start, run_end)
+            i += 1
+
+class SequencePool():
+    def __init__(self, sequences_dir: str):
+        """The chromosome sequences of a genome, each one opened (and mapped) the first time it's needed
+        Every worker process gets its own pool, but the mapped pages are shared through the page cache
+        """
+        self.dir = sequences_dir
+        self.sequences = {}
+        self.lock = threading.Lock()
+
+    def get(self, chromosome: str):
+        """Get the MappedSequence or PackedSequence of a chromosome (the 2-bit file wins if there are both)"""
+        sequence = self.sequences.get(chromosome)
+        if sequence is not None:
+            return(sequence)
+        with self.lock:
+            if chromosome not in self.sequences:
+                packed_path, ascii_path = f"{self.dir}/chr{chromosome}.2bit", f"{self.dir}/chr{chromosome}.txt"
+                if os.path.isfile(packed_path):
+                    self.sequences[chromosome] = PackedSequence(packed_path)
+                elif os.path.isfile(ascii_path):
+                    self.sequences[chromosome] = MappedSequence(ascii_path)
+                else:
+                    raise ValueError(f"No sequence found for chromosome {chromosome}")
+            return(self.sequences[chromosome])
+
+    def read_bytes(self, chromosome: str, start: int, end: int):
+        """Get the bases in [start, end) (0-based) of a chromosome as bytes (a memoryview if possible)"""
+        return(self.get(chromosome).read_bytes(start, end))
+
+    def read_many(self, chromosome: str, regions: list):
+        """Get the bases of many [start, end) (0-based) regions of a chromosome in one call"""
+        sequence = self.get(chromosome)
+        return([sequence.read_bytes(start, end) for start, end in regions])
+
+def sequence_files(genome_dir: str):
+    """The file each chromosome's sequence is read from (the 2-bit file if there are both, like SequencePool.get)
+    Whatever is built from the sequences (derived.bin, kmers.bin) fingerprints these to tell when it's stale
+    """
+    sequences_dir = f"{genome_dir}/sequences"
+    if not os.path.isdir(sequences_dir):
+        return([])
+    filenames = set(os.listdir(sequences_dir))
+    chromosomes = sorted({filename[len("chr"):].rsplit(".", 1)[0] for filename in filenames
+                          if filename.startswith("chr") and filename.endswith((".txt", ".2bit"))})
+    return([f"{sequences_dir}/chr{chromosome}.2bit" if f"chr{chromosome}.2bit" in filenames else
+            f"{sequences_dir}/chr{chromosome}.txt" for chromosome in chromosomes])
+
+def pack_genome_sequences(genome_dir: str, verify: bool = False):
+    """Convert every chr*.txt file of a genome into a chr*.2bit file next to it"""
+    sequences_dir = f"{genome_dir}/sequences"
+    packed = []
+    for filename in sorted(os.listdir(sequences_dir)):
+        if not (filename.startswith("chr") and filename.endswith(".txt")):
+            continue
+        in_path = f"{sequences_dir}/{filename}"
+        out_path = pack_sequence_file(in_path, f"{sequences_dir}/{filename[:-len('.txt')]}.2bit")
+        if verify:
+            verify_packed_file(in_path, out_path)
+        packed.append(out_path)
+    return(packed)
+
+def verify_packed_file(ascii_path: str, packed_path: str):
+    """Check that a 2-bit file decodes back to exactly the ASCII file (raises ValueError if not)"""
+    sequence = PackedSequence(packed_path)
+    with open(ascii_path, "rb") as f:
+        start = 0
+        while chunk := f.read(CHUNK_SIZE):
+            if sequence.read(start, start + len(chunk)).encode("ascii") != chunk:
+                raise ValueError(f"{packed_path} doesn't match {ascii_path} in [{start}, {start + len(chunk)})")
+            start += len(chunk)
+    if start != sequence.length:
+        raise ValueError(f"{packed_path} has {sequence.length} bases but {ascii_path} has {start}")
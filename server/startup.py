@@ -0,0 +1,135 @@
+"""
+Warming up the data before the app serves anything, and reporting how long startup took and how much memory it uses
+    - warm() loads every genome (and builds their indexes with WARM_INDEXES), then moves everything it made out of
+      the garbage collector's way with gc.freeze(). Under gunicorn --preload this runs once in the master, and the
+      workers forked from it share those pages copy-on-write (the freeze stops every worker's garbage collector from
+      writing to them, which would give each worker its own copy)
+    - With WARMUP=background the app starts answering straight away and warms up in a thread (a request for a genome
+      that isn't loaded yet just loads it), and with WARMUP=off everything is loaded on first use
+      The thread is started by each process's first request, so under gunicorn it runs in every worker after it's
+      forked: threads don't survive a fork, and one running in the --preload master would never make the workers
+      ready (and could be holding a genome's load lock when they're forked, so their first load would hang forever)
+      That means nothing is shared with the master, so each worker loads its own copy
+    - /ready answers 503 until warming up is done and 200 after (for load balancer/container readiness probes),
+      along with how long startup took and how much memory the worker that answered is using
+"""
+from flask import jsonify
+from server.metrics import metrics
+import gc, os, sys, threading, time
+
+IMPORTED = time.time() # If we can't find out when the process started, we count from here
+
+def process_start_time():
+    """When this process started (as a Unix time), from /proc on Linux"""
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19]) # Clock ticks after boot (the 22nd field)
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return(boot_time + ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return(IMPORTED)
+
+def memory_usage():
+    """How much memory this process is using, in bytes:
+    rss is every page it has in memory, pss splits the shared ones between the processes that share them,
+    and private is the pages only this process has (so for a worker, what it didn't get to share with the master)
+    Without /proc (e.g. on a Mac) we can only get the most it's ever used (max_rss)
+    """
+    try:
+        usage = {}
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                    usage[key] = int(value.split()[0]) * 1024
+        return({"rss": usage["Rss"], "pss": usage["Pss"], "private": usage["Private_Clean"] + usage["Private_Dirty"]})
+    except (OSError, KeyError, ValueError):
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return({"max_rss": max_rss if sys.platform == "darwin" else max_rss * 1024})
+
+def format_bytes(n):
+    return(f"{n / 2**20:.0f} MB")
+
+class Startup():
+    def __init__(self):
+        self.ready = False
+        self.error = None
+        self.mode = None
+        self.genomes = [] # What warming up loaded
+        self.timings = {} # Seconds each step took
+        self.warmed_by = None # The process that warmed up (the gunicorn master with --preload)
+        self.indexes = True
+        self.warming_pid = None # The process a background warmup was started in (if it's this one, it's been started)
+        self.start_lock = threading.Lock()
+
+    def init_app(self, app, mode: str = "blocking", indexes: bool = True):
+        """Warm up (see the top of this file) and add the /ready endpoint"""
+        if mode not in ("blocking", "background", "off"):
+            raise ValueError(f"WARMUP has to be blocking, background or off (not {mode})")
+        self.mode = mode
+        self.indexes = indexes
+        app.add_url_rule("/ready", "ready", self.ready_view)
+        metrics.add_gauge("egdb_ready", lambda: int(self.ready))
+        metrics.add_gauge("egdb_process_resident_bytes", lambda: memory_usage().get("rss", 0))
+        metrics.add_gauge("egdb_process_private_bytes", lambda: memory_usage().get("private", 0))
+        if mode == "off":
+            self.ready = True
+        elif mode == "background":
+            app.before_request(self._start_warming)
+        else:
+            self.warm(indexes)
+
+    def _start_warming(self):
+        """Start warming up in a thread, once per process (this runs before every request with WARMUP=background)"""
+        if self.warming_pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.warming_pid != os.getpid():
+                self.warming_pid = os.getpid()
+                threading.Thread(target=self.warm, args=(self.indexes,), name="warmup", daemon=True).start()
+
+    def warm(self, indexes: bool = True):
+        """Load every genome (and build their indexes), then freeze what we made so forked workers keep sharing it"""
+        from server.models import genomes
+        self.warmed_by = os.getpid()
+        try:
+            start = time.perf_counter()
+            self.genomes = genomes.warm(indexes=indexes)
+            self.timings["warmup"] = round(time.perf_counter() - start, 3)
+        except Exception as e:
+            self.error = repr(e)
+            if self.mode != "background":
+                raise
+            from server.helper import log_error
+            log_error(f"Warming up failed: {e!r}\n")
+            print(f"Warming up failed: {e!r} ⚠️")
+            return
+        gc.freeze()
+        self.ready = True
+        print(f"Genomes loaded{' (with their indexes)' if indexes else ''} in {self.timings['warmup']:.2f}s: "
+              f"{', '.join(self.genomes) or 'none'} 🧬")
+
+    def app_created(self):
+        """Record (and print) how long it took to start up (from the start of the process to the app being made)"""
+        self.timings["startup"] = round(time.time() - process_start_time(), 3)
+        print(f"Started in {self.timings['startup']:.2f}s, using {format_bytes(memory_usage().get('rss', memory_usage().get('max_rss', 0)))} ⏱️")
+
+    def status(self):
+        return({
+            "ready": self.ready,
+            "error": self.error,
+            "warmup": self.mode,
+            "genomes": self.genomes,
+            "timings": self.timings,
+            "warmed_by": self.warmed_by,
+            "pid": os.getpid(), # The worker that answered (it's not the one that warmed up if it was forked after)
+            "uptime": round(time.time() - process_start_time(), 3),
+            "memory": memory_usage(),
+        })
+
+    def ready_view(self):
+        return(jsonify(self.status()), 200 if self.ready else 503)
+
+startup = Startup()
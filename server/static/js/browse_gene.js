@@ -38,6 +38,26 @@ async function fetch_transcript_annotation(genome_name, gene_symbol, transcript_
     return(res);
 }
 
+// Fetch the gene's genomic DNA sequence one page at a time (so the page itself doesn't have to include it)
+async function load_gene_sequence(gene_data) {
+    let sequence = "";
+    let start = 0;
+    while (start !== null) {
+        const url = `/api/sequence/${gene_data.genome_name}/${gene_data.symbol}?start=${start}`;
+        let res = await fetch(url, {method: "GET"});
+        if (res.status !== 200) {
+            $(`#${DNA_SEQ_DIV} #seq`)[0].setAttribute("value", "Not Available");
+            $(`#${DNA_SEQ_DIV}`).children().prop("disabled", true);
+            return(false);
+        }
+        res = await res.json();
+        sequence += res.sequence;
+        start = res.next_start;
+    }
+    $(`#${DNA_SEQ_DIV} #seq`)[0].setAttribute("value", sequence);
+    return(true);
+}
+
 // Reindex the transcript annotations to be relative to the gene start
 // Or (if normalize is false) to be floats between 0 and 1
 // Good to note: gene_start always seems to be less than gene_end (even on the minus strand)
@@ -450,4 +470,5 @@ $(document).ready(function() {
     // Then load whichever transcript is selected by default
     update_transcript_list(gene_data, transcripts, force_main_variant=true);
     load_transcript($(`#${ALL_TRANSCRIPTS}`).val());
+    load_gene_sequence(gene_data);
 });
\ No newline at end of file
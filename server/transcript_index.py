@@ -0,0 +1,76 @@
+"""
+Byte-offset index over the transcript shards (transcripts/file_N.tsv)
+We scan the shards once (without parsing them) and remember where each transcript's row starts and ends,
+so getting all the transcripts of a gene is one seek + read instead of re-parsing index.tsv and a whole shard
+
+This is also where the duplicated/missing accessions get sorted out (see LRFN1 in NOTES.md):
+    - If an accession shows up more than once, we only keep its first row
+    - If genes.tsv lists an accession that isn't in the gene's shard, we look for it in the other shards
+    - If it's not in any shard, it's dropped from the gene's list of transcripts
+"""
+from server.helper import load_tsv_data
+import csv, io
+
+class TranscriptIndex():
+    def __init__(self, genome_dir: str):
+        self.dir = f"{genome_dir}/transcripts"
+        # Which shard each gene's transcripts are in (from index.tsv)
+        self.file_indexes = {row["gene_symbol"]: row["file_index"] for row in load_tsv_data(f"{self.dir}/index.tsv")}
+        self.headers = {} # Column names of each shard
+        self.locations = {} # Accession -> (file_index, start byte, end byte)
+        self.accessions_by_gene = {} # Gene symbol -> accessions of the rows for that gene (in file order)
+        self.duplicates = [] # Accessions that had more than one row
+        for file_index in sorted(set(self.file_indexes.values())):
+            self._scan_shard(file_index)
+
+    def _scan_shard(self, file_index):
+        """Record the byte range of every row of a shard (only the first two columns are looked at)"""
+        with open(f"{self.dir}/{file_index}.tsv", "rb") as f:
+            data = f.read()
+        header_end = data.find(b"\n") + 1
+        self.headers[file_index] = next(csv.reader([data[:header_end].decode("utf-8-sig")], delimiter="\t"))
+        gene_column = self.headers[file_index].index("gene")
+        accession_column = self.headers[file_index].index("transcript")
+        start = header_end
+        while start < len(data):
+            end = data.find(b"\n", start) + 1 or len(data)
+            fields = data[start:end].split(b"\t", max(gene_column, accession_column) + 1)
+            if len(fields) > max(gene_column, accession_column):
+                gene = fields[gene_column].decode("utf-8")
+                accession = fields[accession_column].decode("utf-8")
+                if accession in self.locations:
+                    self.duplicates.append(accession)
+                else:
+                    self.locations[accession] = (file_index, start, end)
+                    self.accessions_by_gene.setdefault(gene, []).append(accession)
+            start = end
+
+    def gene_accessions(self, symbol: str, listed: list = ()):
+        """Get the accessions of a gene's transcripts that actually have rows
+        These are the ones listed in genes.tsv (wherever they are) and then any others in the gene's own rows
+        """
+        accessions = [accession for accession in listed if accession in self.locations]
+        accessions += self.accessions_by_gene.get(symbol, [])
+        return(list(dict.fromkeys(accessions)))
+
+    def read_rows(self, accessions: list):
+        """Read the rows for some accessions (as dicts like load_tsv_data gives)
+        Rows in the same shard are read all at once with one seek, since a gene's rows are next to each other
+        """
+        by_shard = {}
+        for accession in accessions:
+            if accession in self.locations:
+                file_index, start, end = self.locations[accession]
+                by_shard.setdefault(file_index, []).append((accession, start, end))
+        rows = {}
+        for file_index, locations in by_shard.items():
+            span_start = min(start for _, start, _ in locations)
+            span_end = max(end for _, _, end in locations)
+            with open(f"{self.dir}/{file_index}.tsv", "rb") as f:
+                f.seek(span_start)
+                data = f.read(span_end - span_start)
+            for accession, start, end in locations:
+                line = data[start - span_start:end - span_start].decode("utf-8")
+                values = next(csv.reader(io.StringIO(line), delimiter="\t"))
+                rows[accession] = dict(zip(self.headers[file_index], values))
+        return([rows[accession] for accession in accessions if accession in rows])
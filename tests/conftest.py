@@ -0,0 +1,63 @@
+"""
+Shared setup for the tests (run them from the root of the project with python -m pytest)
+They run on a small synthetic genome (see benchmarks/synthetic_genome.py) in a temporary DATA_DIR, plus BROKEN,
+a minus strand gene whose transcripts can't all be made:
+    - NM_900001.1 has a CDS that isn't a whole number of codons (so there's no protein)
+    - NM_900002.1 has an IUPAC code (R) in an exon (so it can't be reverse complemented)
+The settings are read from the environment the first time one is used, so this has to happen before that
+"""
+from benchmarks.synthetic_genome import generate_genome, make_transcript, TRANSCRIPT_COLUMNS
+import os, random, shutil, tempfile
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="easygenedb-tests-")
+GENOME = "hg38"
+os.environ["DATA_DIR"] = DATA_DIR
+os.environ.setdefault("FLASK_SECRET_KEY", "tests")
+os.environ.setdefault("ENVIRONMENT", "local")
+os.environ["RESPONSE_DISK_CACHE"] = "false" # Don't write a cache into server/temp
+os.environ["WARMUP"] = "off"
+
+BROKEN_START, BROKEN_END, IUPAC_POSITION = 600_001, 603_000, 602_500
+
+def touch(path):
+    """Move a file's modification time forward (so the change shows up whatever the filesystem's resolution is)"""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def add_broken_gene(genome_dir):
+    rng = random.Random(1)
+    gene = {"ncbi_gene_id": "999999", "symbol": "BROKEN", "name": "gene with sequences that can't be made",
+            "type": "protein-coding", "locus": str(("1", "minus", BROKEN_START, BROKEN_END)),
+            "transcripts": str(["NM_900001.1", "NM_900002.1"])}
+    partial = make_transcript(rng, gene, "NM_900001.1", "mRNA", BROKEN_START, BROKEN_START + 999)
+    partial.update(exons=str([(BROKEN_START, BROKEN_START + 999)]), CDSs=str([(BROKEN_START + 10, BROKEN_START + 110)]))
+    iupac = make_transcript(rng, gene, "NM_900002.1", "mRNA", BROKEN_START + 2000, BROKEN_END)
+    iupac.update(exons=str([(BROKEN_START + 2000, BROKEN_END)]), CDSs=str([(BROKEN_START + 2010, BROKEN_START + 2909)]))
+
+    with open(f"{genome_dir}/genes.tsv", "a", encoding="utf-8") as f:
+        f.write("\t".join(gene[column] for column in ["ncbi_gene_id", "symbol", "name", "type", "locus", "transcripts"]) + "\n")
+    with open(f"{genome_dir}/transcripts/file_0.tsv", "a", encoding="utf-8") as f:
+        for row in (partial, iupac):
+            f.write("\t".join(str(row[column]) for column in TRANSCRIPT_COLUMNS) + "\n")
+    with open(f"{genome_dir}/transcripts/index.tsv", "a", encoding="utf-8") as f:
+        f.write("BROKEN\tfile_0\n")
+    with open(f"{genome_dir}/sequences/chr1.txt", "r+b") as f:
+        f.seek(IUPAC_POSITION - 1)
+        f.write(b"R")
+
+generate_genome(f"{DATA_DIR}/{GENOME}", n_genes=100, chromosome_length=1_000_000, long_gene_length=200_000,
+                many_transcripts=20)
+add_broken_gene(f"{DATA_DIR}/{GENOME}")
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def app():
+    from server import create_app
+    return(create_app())
+
+@pytest.fixture
+def client(app):
+    return(app.test_client())
@@ -0,0 +1,25 @@
+from tests.conftest import GENOME
+import json
+
+def post_batch(client, body):
+    response = client.post(f"/api/batch/{GENOME}", json=body)
+    return(response, [json.loads(line) for line in response.get_data(as_text=True).splitlines()])
+
+def test_batch_keeps_going_after_a_transcript_that_cant_be_made(client):
+    # BROKEN's first transcript has a partial CDS, so its protein can't be made
+    response, lines = post_batch(client, {"queries": ["BROKEN", "MANYTX"], "fields": ["ncbi_accession", "amino_acid_sequence"]})
+    assert response.status_code == 200
+    errors = [line for line in lines if "error" in line]
+    assert [line["ncbi_accession"] for line in errors] == ["NM_900001.1", "NM_900002.1"]
+    assert all(line["query"] == "BROKEN" for line in errors)
+    assert "Invalid codon" in errors[0]["error"]
+    assert len([line for line in lines if line["query"] == "MANYTX" and "error" not in line]) == 20
+
+def test_batch_metadata_of_a_broken_transcript_is_fine(client):
+    _, lines = post_batch(client, {"queries": ["NM_900001.1"], "fields": "metadata"})
+    assert lines[0]["ncbi_accession"] == "NM_900001.1" and "error" not in lines[0]
+
+def test_batch_fields_have_to_be_a_string_or_a_list_of_strings(client):
+    for fields in (5, {"a": 1}, [1, 2], True):
+        response = client.post(f"/api/batch/{GENOME}", json={"queries": ["BROKEN"], "fields": fields})
+        assert response.status_code == 400, fields
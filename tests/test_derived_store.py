@@ -0,0 +1,39 @@
+from tests.conftest import DATA_DIR, touch
+from benchmarks.synthetic_genome import generate_genome
+from server.derived_store import build_derived_store
+from server.sequence_store import pack_genome_sequences
+import os
+
+NAME = "derived"
+
+def test_derived_store_is_ignored_when_the_sequences_change():
+    from server.models import Genome
+    genome_dir = f"{DATA_DIR}/{NAME}"
+    generate_genome(genome_dir, n_chromosomes=2, chromosome_length=200_000, n_genes=10, long_gene_length=50_000,
+                    many_transcripts=5)
+    build_derived_store(Genome(NAME))
+    assert Genome(NAME).derived is not None
+
+    # Complement chromosome 1 (same size, only the sequence changes)
+    path = f"{genome_dir}/sequences/chr1.txt"
+    with open(path, "rb") as f:
+        sequence = f.read()
+    with open(path, "wb") as f:
+        f.write(sequence.translate(bytes.maketrans(b"ACGTacgt", b"TGCAtgca")))
+    touch(path)
+    genome = Genome(NAME)
+    assert genome.derived is None
+    transcript = next(t for t in genome.iter_transcripts() if t.locus[0] == "1" and t.exons)
+    build_derived_store(genome)
+    genome = Genome(NAME)
+    assert genome.derived is not None
+    assert genome.derived.get(transcript, "exonic_sequence") == transcript.exonic_sequence
+
+    # Packing changes which file the sequences are read from, and then the 2-bit file is the one that counts
+    pack_genome_sequences(genome_dir)
+    assert Genome(NAME).derived is None
+    build_derived_store(Genome(NAME))
+    os.remove(path)
+    assert Genome(NAME).derived is not None
+    touch(f"{genome_dir}/sequences/chr1.2bit")
+    assert Genome(NAME).derived is None
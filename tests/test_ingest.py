@@ -0,0 +1,51 @@
+from tests.conftest import DATA_DIR
+from server.helper import load_tsv_data
+from server.ingest import ingest_genome
+import random
+
+NAME = "ingested"
+
+def write_inputs(directory):
+    """A one chromosome RefSeq-like GFF3 whose %-escapes decode to tabs, newlines and quotes (and an empty Dbxref)"""
+    gff = [
+        "##gff-version 3",
+        "NC_000001.11\tRefSeq\tregion\t1\t200\t.\t+\t.\tID=NC_000001.11:1..200;Dbxref=taxon:9606;Name=1;chromosome=1;genome=chromosome",
+        "NC_000001.11\tBestRefSeq\tgene\t11\t100\t.\t+\t.\tID=gene-TEST1;Dbxref=GeneID:1,HGNC:HGNC:5;Name=TEST1;"
+        "description=first line%0Asecond line%09tabbed%0D;gene_biotype=protein_coding",
+        "NC_000001.11\tBestRefSeq\tmRNA\t11\t100\t.\t+\t.\tID=rna-NM_000001.1;Parent=gene-TEST1;Dbxref=;"
+        "product=%22quoted%22 product%09with a tab;transcript_id=NM_000001.1",
+        "NC_000001.11\tBestRefSeq\texon\t11\t100\t.\t+\t.\tID=exon-NM_000001.1-1;Parent=rna-NM_000001.1",
+        "NC_000001.11\tBestRefSeq\tCDS\t20\t55\t.\t+\t0\tID=cds-NP_000001.1;Parent=rna-NM_000001.1",
+        "NC_000001.11\tBestRefSeq\tmRNA\t11\t100\t.\t+\t.\tID=rna-NM_000002.1;Parent=gene-TEST1;"
+        "Dbxref=GeneID:1,Genbank:NM_000002.1;product=\"starts with a quote;transcript_id=NM_000002.1",
+        "NC_000001.11\tBestRefSeq\texon\t11\t100\t.\t+\t.\tID=exon-NM_000002.1-1;Parent=rna-NM_000002.1",
+    ]
+    rng = random.Random(1)
+    with open(f"{directory}/test.gff", "w") as f:
+        f.write("\n".join(gff) + "\n")
+    with open(f"{directory}/test.fna", "w") as f:
+        f.write(">NC_000001.11 chromosome 1\n" + "".join(rng.choice("ACGT") for _ in range(200)) + "\n")
+
+def test_ingested_values_round_trip(tmp_path):
+    write_inputs(tmp_path)
+    ingest_genome(f"{DATA_DIR}/{NAME}", f"{tmp_path}/test.gff", f"{tmp_path}/test.fna", processes=1)
+
+    genes = load_tsv_data(f"{DATA_DIR}/{NAME}/genes.tsv")
+    assert len(genes) == 1
+    assert genes[0]["name"] == "first line second line tabbed "
+    assert genes[0]["ncbi_gene_id"] == "1"
+
+    rows = load_tsv_data(f"{DATA_DIR}/{NAME}/transcripts/file_1.tsv")
+    assert [row["transcript"] for row in rows] == ["NM_000001.1", "NM_000002.1"]
+    assert rows[0]["product"] == '"quoted" product with a tab'
+    assert rows[0]["xref"] == ""
+    assert rows[1]["product"] == '"starts with a quote'
+
+    # And through the models (which read the shards a row at a time)
+    from server.models import Genome
+    genome = Genome(NAME)
+    gene = genome.get_gene_by_symbol("TEST1")
+    first, second = genome.get_transcripts(gene)
+    assert (first.product, first.xrefs) == ('"quoted" product with a tab', {})
+    assert (second.product, second.xrefs) == ('"starts with a quote', {"GeneID": "1", "Genbank": "NM_000002.1"})
+    assert len(first.coding_sequence) == 36
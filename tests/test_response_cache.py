@@ -0,0 +1,60 @@
+from server.response_cache import ResponseCache, response_cache
+from tests.conftest import DATA_DIR, GENOME
+from flask import Flask, Response
+import hashlib, pytest
+
+@pytest.fixture
+def cached_app():
+    """A throwaway app with its own response cache and views that count how often they run"""
+    app = Flask(__name__)
+    app.secret_key = "tests"
+    cache = ResponseCache()
+    cache.init_app(app, data_dir=DATA_DIR)
+    app.calls = {"stream": 0, "json": 0}
+
+    @app.route("/stream")
+    @cache.cached
+    def stream():
+        app.calls["stream"] += 1
+        def generate():
+            yield "partial"
+            raise ValueError("Invalid codon: G")
+        return(Response(generate()))
+
+    @app.route("/json")
+    @cache.cached
+    def json_view():
+        app.calls["json"] += 1
+        return({"ok": True})
+    return(app)
+
+def test_failed_streamed_response_is_not_cached(cached_app):
+    client = cached_app.test_client()
+    for calls in (1, 2):
+        with pytest.raises(ValueError):
+            client.get("/stream").get_data()
+        assert cached_app.calls["stream"] == calls # It ran again, so nothing was cached
+
+def test_complete_response_is_cached(cached_app):
+    client = cached_app.test_client()
+    first = client.get("/json")
+    second = client.get("/json", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 304
+    assert client.get("/json").get_json() == {"ok": True}
+    assert cached_app.calls["json"] == 1
+
+def test_memory_tier_size_is_set_by_init_app(app, cached_app):
+    cache = ResponseCache()
+    cache.init_app(cached_app, data_dir=DATA_DIR, memory_max_bytes=0)
+    cache.memory.set("key", b"body", 4)
+    assert cache.memory.get("key") is None # Nothing fits, so the memory tier is off
+    assert response_cache.memory.max_bytes == 16 * 2**20 # RESPONSE_CACHE_MB's default
+
+def test_errors_are_not_cached_and_dont_get_304s(client):
+    url = f"/api/transcripts/{GENOME}/BROKEN/NM_900001.1?fields=amino_acid_sequence"
+    response = client.get(url)
+    assert response.status_code == 422
+    assert "ETag" not in response.headers
+    # The ETag it would have had if it were cached
+    etag = hashlib.blake2b(f"response:{response_cache.version}:{url}".encode("utf-8"), digest_size=12).hexdigest()
+    assert client.get(url, headers={"If-None-Match": f'W/"{etag}"'}).status_code == 422
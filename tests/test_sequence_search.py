@@ -0,0 +1,48 @@
+from tests.conftest import DATA_DIR, GENOME, touch
+from benchmarks.synthetic_genome import generate_genome
+from server.kmer_index import build_kmer_index, KmerIndex
+import pytest
+
+@pytest.fixture(scope="module")
+def kmer_index(app):
+    """Build kmers.bin for the test genome (the app opens it the first time there's a search)"""
+    from server.models import Genome
+    build_kmer_index(Genome(GENOME))
+
+def test_search_finds_a_transcript(client, kmer_index):
+    from server.models import Genome
+    genome = Genome.load(GENOME)
+    transcript = genome.get_transcript(genome.get_gene_by_symbol("BROKEN"), "NM_900001.1")
+    response = client.get(f"/api/sequence_search/{GENOME}?query={transcript.exonic_sequence[100:130]}")
+    assert response.status_code == 200
+    assert response.get_json()["method"] == "index"
+    assert {"ncbi_accession": "NM_900001.1", "gene_symbol": "BROKEN", "strand": "+", "start": 101, "end": 130} \
+        in response.get_json()["hits"]
+
+def test_search_with_iupac_codes_is_a_bad_request(client, kmer_index):
+    response = client.get(f"/api/sequence_search/{GENOME}?query=ACGTRYACGT")
+    assert response.status_code == 400
+    assert "A, C, G, T" in response.get_json()["error"]
+    response = client.get(f"/api/sequence_search/{GENOME}?query=ACGTRYACGT&reverse_complement=false")
+    assert response.status_code == 400
+
+def test_search_for_a_peptide_without_the_type_is_a_bad_request(client, kmer_index):
+    response = client.get(f"/api/sequence_search/{GENOME}?query=MKVLAAGGW")
+    assert response.status_code == 400
+    assert "type=peptide" in response.get_json()["error"]
+    assert client.get(f"/api/sequence_search/{GENOME}?query=MKVLAAGGW&type=peptide").status_code == 200
+
+def test_index_is_ignored_when_the_sequences_change():
+    from server.models import Genome
+    genome_dir = f"{DATA_DIR}/kmers"
+    generate_genome(genome_dir, n_chromosomes=2, chromosome_length=200_000, n_genes=10, long_gene_length=50_000,
+                    many_transcripts=5)
+    build_kmer_index(Genome("kmers"))
+    assert KmerIndex.open(genome_dir) is not None
+    path = f"{genome_dir}/sequences/chr1.txt"
+    with open(path, "rb") as f:
+        sequence = f.read()
+    with open(path, "wb") as f:
+        f.write(sequence.translate(bytes.maketrans(b"ACGTacgt", b"TGCAtgca")))
+    touch(path)
+    assert KmerIndex.open(genome_dir) is None
@@ -0,0 +1,33 @@
+from tests.conftest import GENOME
+
+def test_fasta_of_a_partial_cds_protein_is_an_error(client):
+    response = client.get(f"/api/fasta/{GENOME}/BROKEN/NM_900001.1?fields=amino_acid_sequence")
+    assert response.status_code == 422
+    assert "Invalid codon" in response.get_json()["error"]
+
+def test_fasta_leaves_out_what_cant_be_made_by_default(client):
+    response = client.get(f"/api/fasta/{GENOME}/BROKEN/NM_900001.1")
+    assert response.status_code == 200
+    headers = [line for line in response.get_data(as_text=True).splitlines() if line.startswith(">")]
+    assert headers == [f">NM_900001.1 BROKEN {field}" for field in
+                       ["genomic_sequence", "sequence", "exonic_sequence", "coding_sequence"]]
+
+def test_stream_of_a_partial_cds_protein_is_an_error(client):
+    response = client.get(f"/api/stream/{GENOME}/BROKEN/NM_900001.1?field=amino_acid_sequence")
+    assert response.status_code == 422
+
+def test_stream_with_a_base_that_cant_be_complemented_is_an_error(client):
+    response = client.get(f"/api/stream/{GENOME}/BROKEN/NM_900002.1?field=exonic_sequence")
+    assert response.status_code == 422
+    assert "(R)" in response.get_json()["error"]
+    assert client.get(f"/api/stream/{GENOME}/BROKEN").status_code == 422
+    assert client.get(f"/api/fasta/{GENOME}/BROKEN").status_code == 422
+    # The genomic sequence is the plus strand, so it doesn't need complementing
+    response = client.get(f"/api/stream/{GENOME}/BROKEN/NM_900002.1?field=genomic_sequence")
+    assert response.status_code == 200
+    assert "R" in response.get_json()["sequence"]
+
+def test_stream_still_works(client):
+    response = client.get(f"/api/stream/{GENOME}/BROKEN/NM_900001.1?field=coding_sequence")
+    assert response.status_code == 200
+    assert len(response.get_json()["sequence"]) == 101